@@ -0,0 +1,309 @@
+import time
+import heapq
+import random
+import logging
+import threading
+from collections import deque
+from typing import Deque, Dict, List, Tuple
+
+from utils import jsoncodec
+from utils.http import get_transport
+from utils.db import add_deliveries, finish_delivery, get_deliveries, get_latency_buckets
+from utils.histogram import HistogramSet
+from utils.metrics import metrics
+from utils.health import health
+from .discordlib import DiscordWebhook, DiscordMessage
+
+# Constants
+DISCORD_SENDERS = 4
+DISCORD_MAX_ATTEMPTS = 5
+
+
+class Delivery:
+    """A message waiting to be posted to a webhook"""
+
+    __slots__ = ("row_id", "url", "payload", "attempts")
+
+    def __init__(self, row_id: int, url: str, payload: str):
+        self.row_id = row_id
+        self.url = url
+        self.payload = payload
+        self.attempts = 0
+
+    def __repr__(self):
+        return f"Delivery(id={self.row_id}, attempts={self.attempts})"
+
+
+class DeliveryQueue:
+    """
+    Outbound Discord message queue
+    - One FIFO lane per webhook, sent in order, one at a time
+    - Different webhooks are sent in parallel
+    - Honors Discord's per-bucket and global rate limits
+    - Messages are persisted until sent, so restarts don't drop them
+    """
+
+    def __init__(self):
+        """Constructor"""
+
+        self._lanes: Dict[str, Deque[Delivery]] = {}
+        self._ready: Deque[str] = deque()
+        self._busy = set()
+        self._blocked: List[Tuple[float, str]] = []
+        self._blocked_urls = set()
+        self._global_until = 0.0
+        self._condition = threading.Condition()
+
+        # Metrics
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.rate_limited = 0
+
+    #
+    # Producers
+    #
+
+    def push(self, webhook: DiscordWebhook, message: DiscordMessage):
+        """Queues a message for a webhook, never blocks on Discord"""
+
+        if message.content == "" and len(message.embeds) == 0:
+            logging.error("Cannot send empty webhook!")
+            return
+
+        self.push_raw(webhook.url, jsoncodec.dumps(webhook.payload(message)))
+
+    def push_raw(self, url: str, payload: str):
+        """Queues an already serialized payload, e.g. a rendered template"""
+        self.push_many([(url, payload)])
+
+    def push_many(self, items: List[Tuple[str, str]], broadcaster_id: str = None, origin: float = None):
+        """
+        Queues many (url, payload) messages, persisted in one commit
+        'origin' is when the triggering event happened, for latency tracking
+        """
+
+        if not items:
+            return
+        row_ids = add_deliveries(items, broadcaster_id, origin)
+        for row_id, (url, payload) in zip(row_ids, items):
+            self._enqueue(Delivery(row_id, url, payload))
+
+    def restore(self, rows: List[dict] = None):
+        """Requeues messages left undelivered by a previous run, or a dead shard"""
+
+        if rows is None:
+            rows = get_deliveries()
+        for row in rows:
+            self._enqueue(Delivery(row['id'], row['url'], row['payload']))
+        if rows:
+            logging.info(f"Restored {len(rows)} undelivered Discord messages!")
+
+    def _enqueue(self, item: Delivery):
+        """Adds to the webhook's lane, waking a sender if it's idle"""
+
+        with self._condition:
+            lane = self._lanes.setdefault(item.url, deque())
+            lane.append(item)
+            self._wake(item.url)
+
+    def _wake(self, url: str):
+        """Marks a lane ready if it has work and nobody owns it"""
+
+        if url in self._busy or url in self._blocked_urls or url in self._ready:
+            return
+        if self._lanes.get(url):
+            self._ready.append(url)
+            self._condition.notify()
+
+    def _block(self, url: str, delay: float):
+        """Holds a lane for a while"""
+
+        self._blocked_urls.add(url)
+        heapq.heappush(self._blocked, (time.monotonic() + delay, url))
+        self._condition.notify()
+
+    #
+    # Consumers
+    #
+
+    def pop(self):
+        """Waits for the next lane that may send, returns its head"""
+
+        with self._condition:
+            while True:
+                now = time.monotonic()
+
+                # Unblock lanes whose wait is over
+                while self._blocked and self._blocked[0][0] <= now:
+                    _, url = heapq.heappop(self._blocked)
+                    self._blocked_urls.discard(url)
+                    self._wake(url)
+
+                wait_for = self._blocked[0][0] - now if self._blocked else None
+                if self._global_until > now:
+                    wait_for = self._global_until - now
+                elif self._ready:
+                    url = self._ready.popleft()
+                    self._busy.add(url)
+                    return self._lanes[url].popleft()
+
+                self._condition.wait(wait_for)
+
+    def send(self, item: Delivery):
+        """
+        Posts one message
+        Returns secs to hold its lane, or None if done with it
+        """
+
+        item.attempts += 1
+        start = time.perf_counter()
+        try:
+            res = get_transport().post(
+                f"{item.url}?wait=true",
+                data=item.payload,
+                headers={"Content-Type": "application/json"}
+            )
+        except Exception as e:
+            logging.error(f"Webhook post raised! {e}")
+            discord_requests.inc("error")
+            return self._retry(item)
+        discord_seconds.observe(time.perf_counter() - start)
+        discord_requests.inc(str(res.status_code))
+
+        # Rate limited, Discord tells us how long to wait
+        if res.status_code == 429:
+            self.rate_limited += 1
+            try:
+                body = res.json()
+            except ValueError:
+                body = {}
+            delay = float(body.get("retry_after", res.headers.get("Retry-After", 1)))
+            if body.get("global") or res.headers.get("X-RateLimit-Global"):
+                with self._condition:
+                    self._global_until = time.monotonic() + delay
+            logging.warning(f"Webhook rate limited for {delay:.2f}s!")
+            item.attempts -= 1
+            return delay
+
+        # Server trouble, try again later
+        if res.status_code >= 500:
+            logging.error(f"Webhook post failed with code {res.status_code}!")
+            return self._retry(item)
+
+        # Anything else is final
+        self._finish(item, res.status_code)
+        if res.status_code >= 300:
+            logging.error(f"Webhook post failed with code {res.status_code}, dropping!")
+            return None
+
+        # Bucket's dry, hold the lane until it resets
+        if res.headers.get("X-RateLimit-Remaining") == "0":
+            return float(res.headers.get("X-RateLimit-Reset-After", 0))
+        return None
+
+    def _retry(self, item: Delivery):
+        """Backs off exponentially, or gives up after too many attempts"""
+
+        if item.attempts >= DISCORD_MAX_ATTEMPTS:
+            logging.error(f"Giving up on {item} after {item.attempts} attempts!")
+            self._finish(item, None)
+            return None
+
+        self.retried += 1
+        return 0.5 * (2 ** item.attempts) + random.uniform(0, 0.5)
+
+    def _finish(self, item: Delivery, status: int):
+        """Moves a message to the delivery history once sent or given up on"""
+
+        broadcaster_id, latency = finish_delivery(item.row_id, status, item.attempts)
+        if latency is not None:
+            latencies.record(broadcaster_id or "", latency)
+            golive_seconds.observe(latency)
+        if status is not None and status < 300:
+            self.sent += 1
+        else:
+            self.failed += 1
+        item.row_id = None
+
+    def done(self, item: Delivery, delay: float = None):
+        """Releases a lane after sending its head"""
+
+        with self._condition:
+            self._busy.discard(item.url)
+
+            # Not finished, put it back in front
+            if item.row_id is not None:
+                self._lanes[item.url].appendleft(item)
+
+            if delay:
+                self._block(item.url, delay)
+            else:
+                self._wake(item.url)
+
+    def depth(self):
+        """Number of messages waiting, across all webhooks"""
+        with self._condition:
+            return sum(len(lane) for lane in self._lanes.values())
+
+
+class SenderThread(threading.Thread):
+    """Posts queued Discord messages"""
+
+    def __init__(self, name):
+        """Constructor"""
+
+        super().__init__()
+        self.name = name
+        self.daemon = True
+
+    def run(self):
+        """
+        Main thread event loop
+        NOTE: This function should never be called directly
+        """
+        global deliveries
+
+        logging.info("Starting...")
+        while True:
+            item = deliveries.pop()
+            delay = None
+            try:
+                delay = deliveries.send(item)
+            except Exception:
+                logging.exception(f"Sending {item} raised!")
+                delay = deliveries._retry(item)
+            finally:
+                deliveries.done(item, delay)
+
+
+def start_senders(count: int = DISCORD_SENDERS):
+    """Restores persisted messages and spawns the sender threads"""
+
+    latencies.load(get_latency_buckets())
+    deliveries.restore()
+    senders = [SenderThread(f"Discord-{i + 1}") for i in range(count)]
+    for sender in senders:
+        sender.start()
+    return senders
+
+
+# Static Initialization
+deliveries = DeliveryQueue()
+latencies = HistogramSet()  # event -> Discord latency, per broadcaster
+discord_requests = metrics.counter("twitchbot_discord_requests_total", "Discord webhook posts by status", ("status",))
+discord_seconds = metrics.histogram("twitchbot_discord_request_seconds", "Discord webhook post latency")
+golive_seconds = metrics.histogram(
+    "twitchbot_golive_seconds", "Twitch go-live to Discord post latency",
+    buckets=(0.25, 0.5, 1.0, 2.0, 5.0, 10.0, 30.0, 60.0, 300.0)
+)
+metrics.gauge("twitchbot_discord_pending", "Discord messages waiting to be sent", lambda: deliveries.depth())
+metrics.counter_func(
+    "twitchbot_discord_deliveries_total", "Discord messages by outcome",
+    lambda: {
+        ("sent",): deliveries.sent, ("failed",): deliveries.failed,
+        ("retried",): deliveries.retried, ("rate_limited",): deliveries.rate_limited
+    },
+    ("outcome",)
+)
+health.register("discord", lambda: {"ok": True, "pending": deliveries.depth()})
@@ -16,18 +16,22 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import os
+import re
+import json
 import logging
-import requests
 from enum import Enum
 from typing import List
 
 # Constants
-WEBHOOK_BASE = "https://discord.com/api/webhooks"
+WEBHOOK_BASE = os.environ.get("DISCORD_WEBHOOK_BASE", "https://discord.com/api/webhooks")
 
 
 class DiscordEmbed():
     """Internal Class that represents a Discord Embed"""
 
+    __slots__ = ("title", "description", "image", "color", "timestamp", "footer", "url")
+
     class Colors(int, Enum):
         """Main Color Enum, used in Discord embeds"""
 
@@ -74,13 +78,13 @@ class DiscordEmbed():
         footer = data['footer']['text'] if 'footer' in data.keys() else None
 
         return DiscordEmbed(
-            title=data["title"],
-            description=data["description"],
-            color=data["color"],
+            title=data.get("title", ""),
+            description=data.get("description", ""),
+            color=data.get("color", DiscordEmbed.Colors.PRIMARY),
             image=image,
             timestamp=timestamp,
             footer=footer,
-            url=data["url"]
+            url=data.get("url", "")
         )
 
     def to_dict(self):
@@ -110,6 +114,8 @@ class DiscordEmbed():
 class DiscordMessage():
     """Internal Class that represents a Discord Message"""
 
+    __slots__ = ("content", "embeds", "flags", "id")
+
     class Flags(int, Enum):
         """Extra Flags for Allowed Mentions"""
 
@@ -121,12 +127,12 @@ class DiscordMessage():
     def __init__(
             self,
             content: str = "",
-            embeds: List[DiscordEmbed] = [],
+            embeds: List[DiscordEmbed] = None,
             flags: int = 0,
             id: str = ""):
 
         self.content = content
-        self.embeds = embeds
+        self.embeds = embeds if embeds is not None else []
         self.flags = flags
         self.id = id
 
@@ -154,7 +160,8 @@ class DiscordMessage():
                 tempflag |= DiscordMessage.Flags.ALLOW_MENTION_EVERYONE
 
         return DiscordMessage(
-            data["content"], data["embeds"],
+            data["content"],
+            [DiscordEmbed.from_dict(e) for e in data["embeds"]],
             tempflag, data["id"]
         )
 
@@ -181,6 +188,34 @@ class DiscordMessage():
         return temp_dict
 
 
+class MessageTemplate():
+    """
+    A webhook payload with {fields}, serialized to JSON once
+    Rendering only escapes and splices in the field values
+    """
+
+    __slots__ = ("fields", "_parts")
+
+    def __init__(self, payload: dict, fields: List[str]):
+
+        self.fields = fields
+
+        # Split the serialized JSON around each known {field}
+        pattern = re.compile(r"\{(" + "|".join(map(re.escape, fields)) + r")\}")
+        self._parts = pattern.split(json.dumps(payload))
+
+    def __repr__(self):
+        return f"MessageTemplate(fields={self.fields})"
+
+    def render(self, **values):
+        """Returns the JSON body with the given field values filled in"""
+
+        parts = self._parts[:]
+        for i in range(1, len(parts), 2):
+            parts[i] = json.dumps(str(values[parts[i]]))[1:-1]
+        return "".join(parts)
+
+
 class DiscordWebhook():
     """Main Discord Webhook Post Class"""
 
@@ -188,7 +223,8 @@ class DiscordWebhook():
             self,
             url: str,
             name: str = "Python Webhook",
-            pfp_url: str = ""):
+            pfp_url: str = "",
+            session=None):
 
         # Error checking
         if not url:
@@ -203,6 +239,12 @@ class DiscordWebhook():
         self.pfp = pfp_url
         self.url = url
 
+        # Reuse a pooled session if given, else plain requests
+        if session is None:
+            import requests
+            session = requests
+        self.http = session
+
     #
     # Sends
     #
@@ -211,6 +253,21 @@ class DiscordWebhook():
         """Text-only Discord Message Function"""
         return self.send_rich(DiscordMessage(content, flags=flags))
 
+    def payload(self, message: DiscordMessage):
+        """Returns the JSON body for sending a message via this webhook"""
+
+        json = message.to_dict()
+        json['username'] = self.name
+        json['avatar_url'] = self.pfp
+        return json
+
+    def compile(self, message: DiscordMessage, fields: List[str]):
+        """
+        Returns a MessageTemplate for this webhook
+        Any {field} in the message's strings is filled in on render
+        """
+        return MessageTemplate(self.payload(message), fields)
+
     def send_rich(self, message: DiscordMessage):
         """Rich Discord Message Function"""
 
@@ -218,15 +275,16 @@ class DiscordWebhook():
             logging.error("Cannot send empty webhook!")
             return
 
-        json = message.to_dict()
-        json['username'] = self.name
-        json['avatar_url'] = self.pfp
-
-        res = requests.post(
+        res = self.http.post(
             f"{self.url}?wait=true",
-            json=json
+            json=self.payload(message)
         )
 
+        # If bad response, error
+        if res.status_code != 200:
+            logging.error(f"Webhook send failed with code {res.status_code}!")
+            return None
+
         return DiscordMessage.from_dict(res.json())
 
     #
@@ -240,7 +298,7 @@ class DiscordWebhook():
         """
 
         # update the message
-        return requests.patch(
+        return self.http.patch(
             f"{self.url}/messages/{message.id}",
             json=message.to_dict()
         ).json()
@@ -256,7 +314,7 @@ class DiscordWebhook():
         """
 
         # delete the message
-        return requests.delete(
+        return self.http.delete(
             f"{self.url}/messages/{message.id}"
         )
 
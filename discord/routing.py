@@ -0,0 +1,156 @@
+import logging
+from typing import Dict, List, Tuple
+
+from utils.config import get_config
+from utils.db import get_destinations
+from .webhooks import generate_webhook
+from .discordlib import DiscordMessage, DiscordEmbed, MessageTemplate
+
+# Constants
+DEFAULT_CONTENT = "**{name}** is now live on Twitch!"
+TEMPLATE_FIELDS = ["title", "game", "thumbnail"]
+
+
+class Destination:
+    """
+    A Discord webhook that go-live posts are routed to
+    Each destination has its own message template and mention flags
+    """
+
+    __slots__ = ("webhook", "content", "flags", "broadcasters", "_templates")
+
+    def __init__(
+            self,
+            url: str,
+            content: str = DEFAULT_CONTENT,
+            flags: int = 0,
+            broadcasters: List[str] = None
+            ):
+
+        self.webhook = generate_webhook(url)
+        self.content = content
+        self.flags = flags
+        self.broadcasters = broadcasters if broadcasters is not None else ["*"]
+        self._templates: Dict[Tuple[str, str], MessageTemplate] = {}
+
+    @staticmethod
+    def from_dict(data: dict):
+        """Parses a destination from its config entry"""
+
+        # Set flags
+        flags = 0
+        if data.get("silent"):
+            flags |= DiscordMessage.Flags.SILENT_MESSAGE
+        mentions = data.get("mentions", [])
+        if "roles" in mentions:
+            flags |= DiscordMessage.Flags.ALLOW_MENTION_ROLE
+        if "users" in mentions:
+            flags |= DiscordMessage.Flags.ALLOW_MENTION_USER
+        if "everyone" in mentions:
+            flags |= DiscordMessage.Flags.ALLOW_MENTION_EVERYONE
+
+        return Destination(
+            data["webhook"],
+            data.get("content", DEFAULT_CONTENT),
+            flags, data.get("broadcasters")
+        )
+
+    def __repr__(self):
+        return f"Destination(broadcasters={self.broadcasters})"
+
+    @property
+    def url(self):
+        return self.webhook.url
+
+    def template(self, name: str, login: str):
+        """
+        Returns the compiled go-live template for a broadcaster
+        Only title, game and thumbnail change between go-lives
+        """
+
+        key = (name, login)
+        template = self._templates.get(key)
+        if template is None:
+            content = self.content.replace("{name}", name).replace("{login}", login)
+            template = self._templates[key] = self.webhook.compile(DiscordMessage(
+                content=content,
+                embeds=[
+                    DiscordEmbed(
+                        title="{title}",
+                        description="Playing: {game}",
+                        image="{thumbnail}",
+                        footer="This message is from Azure's Twitchbot!",
+                        url=f"https://twitch.tv/{login}",
+                        color=0x6441a5
+                    )
+                ],
+                flags=self.flags
+            ), TEMPLATE_FIELDS)
+        return template
+
+
+class RoutingTable:
+    """
+    Maps broadcasters to the destinations their go-lives are posted to
+    - Broadcasters are matched by user ID or login, "*" matches everyone
+    - Broadcasters with no route fall back to the default destination
+    """
+
+    def __init__(self):
+        """Constructor"""
+
+        self.default: Destination = None
+        self._routes: Dict[str, List[Destination]] = {}
+        self._wildcard: List[Destination] = []
+
+    def add(self, destination: Destination):
+        """Routes a destination's broadcasters to it"""
+
+        for broadcaster in destination.broadcasters:
+            if broadcaster == "*":
+                self._wildcard.append(destination)
+            else:
+                self._routes.setdefault(broadcaster.lower(), []).append(destination)
+
+    def lookup(self, broadcaster_id: str, login: str):
+        """Returns every destination for a broadcaster, each webhook once"""
+
+        found = {}
+        for key in (broadcaster_id, login.lower()):
+            for destination in self._routes.get(key, ()):
+                found.setdefault(destination.url, destination)
+        for destination in self._wildcard:
+            found.setdefault(destination.url, destination)
+
+        # If nothing matched, use the default
+        if not found and self.default is not None:
+            return [self.default]
+        return list(found.values())
+
+    def __len__(self):
+        return len(self._wildcard) + sum(len(d) for d in self._routes.values())
+
+
+# Static Initialization
+routes = RoutingTable()
+
+
+def init_routes():
+    """Builds the routing table from config and stored destinations"""
+
+    config = get_config()
+    routes.default = Destination(config.d_webhook)
+    for data in config.d_routes:
+        routes.add(Destination.from_dict(data))
+    for row in get_destinations():
+        routes.add(Destination(
+            row['url'], row['content'] or DEFAULT_CONTENT,
+            row['flags'], [row['broadcaster_id']]
+        ))
+    logging.info(f"Loaded {len(routes)} Discord routes")
+    return routes
+
+
+def get_routes():
+    """Returns the routing table"""
+    return routes
@@ -1,4 +1,5 @@
 from utils.config import get_config
+from utils.http import get_transport
 from .discordlib import DiscordWebhook, DiscordMessage, DiscordEmbed
 
 
@@ -7,7 +8,8 @@ def generate_webhook(url: str):
     return DiscordWebhook(
         url,
         name="Twitch Notifier",
-        pfp_url="https://static-cdn.jtvnw.net/jtv_user_pictures/8a6381c7-d0c0-4576-b179-38bd5ce1d6af-profile_image-300x300.png"
+        pfp_url="https://static-cdn.jtvnw.net/jtv_user_pictures/8a6381c7-d0c0-4576-b179-38bd5ce1d6af-profile_image-300x300.png",
+        session=get_transport()
     )
 
 
@@ -1,14 +1,22 @@
 import os
+import hmac
 import logging
+from functools import wraps
 from flask import Blueprint, request, render_template, \
-    redirect, abort, url_for
+    redirect, abort, url_for, jsonify
 
 from utils.threads import queue
-from utils.db import clear_token
+from utils.metrics import metrics
+from utils.startup import startup
+from utils.health import health
+from utils.config import get_config
+from utils.db import clear_token, store_broadcaster, forget_broadcaster, get_stream_history
 from twitch.oauth import request_token
-from twitch.websocket import ws_event_loop, stop_ws_event_loop
-from twitch.rest import format_auth_url, get_cur_user
+from twitch.websocket import ws_event_loop, stop_ws_event_loop, manager, \
+    watch_broadcaster, unwatch_broadcaster
+from twitch.rest import format_auth_url, get_cur_user, get_users, helix_cache
 from discord.webhooks import send_status_notif
+from discord.delivery import latencies
 
 routes = Blueprint(
     "main", __name__,
@@ -16,6 +24,29 @@ routes = Blueprint(
 )
 
 
+def require_admin(view):
+    """
+    Only lets requests carrying admin.secret through, as a 'secret' form field or bearer token
+    A cross-site form can't know it, so this covers CSRF too
+    """
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        secret = get_config().admin_secret
+        if not secret:
+            return "Set admin.secret to manage broadcasters.", 403
+
+        given = request.form.get("secret", "")
+        auth = request.headers.get("Authorization", "")
+        if auth.startswith("Bearer "):
+            given = auth[len("Bearer "):]
+        if not hmac.compare_digest(given.encode(), secret.encode()):
+            return "Bad admin secret.", 403
+        return view(*args, **kwargs)
+
+    return wrapper
+
+
 @routes.route("/")
 def index():
     user = get_cur_user()
@@ -25,7 +56,8 @@ def index():
     return render_template(
         "index.html",
         auth_url=auth_url,
-        user=user
+        user=user,
+        broadcasters=manager.broadcasters
     )
 
 
@@ -39,6 +71,7 @@ def oauth_callback():
     if res is None:
         return "Server-side error. Check Logs.", 500
 
+    helix_cache.invalidate()
     logging.info("User has logged in!")
     send_status_notif("User has logged in! Starting WebSocket...")
     queue.push(ws_event_loop)
@@ -54,6 +87,7 @@ def logout():
         return "Already logged out.", 400
 
     clear_token()
+    helix_cache.invalidate()
     stop_ws_event_loop()
 
     logging.info("User has logged out!")
@@ -61,6 +95,85 @@ def logout():
     return redirect("/")
 
 
+@routes.route("/broadcasters/add", methods=["POST"])
+@require_admin
+def add_broadcaster():
+    """Subscribes to another broadcaster at runtime"""
+
+    users = get_users(logins=[request.form.get("login", "")])
+    if not users:
+        return "Unknown broadcaster.", 404
+
+    user = users[0]
+    if watch_broadcaster(user['id']) is None:
+        return "Server-side error. Check Logs.", 500
+
+    # Keep them across restarts
+    store_broadcaster(user['id'], user['login'], user['display_name'])
+    return redirect("/")
+
+
+@routes.route("/broadcasters/remove", methods=["POST"])
+@require_admin
+def remove_broadcaster():
+    """Unsubscribes from a broadcaster at runtime"""
+
+    # Forget first, so no shard picks them back up from the DB
+    # Sharded, whichever shard holds them unsubscribes on its next tick
+    broadcaster_id = request.form.get("id", "")
+    forgotten = forget_broadcaster(broadcaster_id)
+    if unwatch_broadcaster(broadcaster_id) is None and not forgotten:
+        return "Not subscribed to that broadcaster.", 404
+
+    return redirect("/")
+
+
+@routes.route("/metrics")
+def prometheus_metrics():
+    """Prometheus scrape endpoint"""
+    return metrics.render(), 200, {"Content-Type": "text/plain; version=0.0.4"}
+
+
+@routes.route("/healthz")
+def healthz():
+    """Liveness, fails only if the workers are dead or stuck"""
+    ok, checks = health.run()
+    return jsonify(ok=ok, checks=checks), 200 if ok else 503
+
+
+@routes.route("/readyz")
+def readyz():
+    """Readiness, fails if any check does"""
+    ok, checks = health.run(readiness=True)
+    return jsonify(ok=ok, checks=checks), 200 if ok else 503
+
+
+@routes.route("/stats/latency")
+def latency_stats():
+    """Go-live to Discord latency per broadcaster, in secs"""
+    return jsonify(latencies.summary())
+
+
+@routes.route("/stats/startup")
+def startup_stats():
+    """Time spent in each startup phase, in secs"""
+    return jsonify(startup.stats())
+
+
+@routes.route("/stats/history")
+def stream_history():
+    """Go-live and offline events, newest first"""
+
+    try:
+        since = float(request.args.get("since", 0))
+        until = float(request.args["until"]) if "until" in request.args else None
+        limit = min(int(request.args.get("limit", 100)), 1000)
+    except ValueError:
+        return "Bad query.", 400
+
+    return jsonify(get_stream_history(request.args.get("broadcaster"), since, until, limit))
+
+
 @routes.route("/debug-get-token")
 def debug_get_token():
     """For Local Testing"""
@@ -72,6 +185,7 @@ def debug_get_token():
     if res is None:
         return "Server-side error. Check Logs.", 500
 
+    helix_cache.invalidate()
     queue.push(ws_event_loop)
 
     return redirect("/")
@@ -0,0 +1,94 @@
+import pytest
+
+from utils import db as dbmod
+
+
+@pytest.fixture
+def db(tmp_path):
+    """A fresh, fully migrated DB, closed afterwards"""
+
+    conn = dbmod.init_db(str(tmp_path / "twitch.db"))
+    yield conn
+    with dbmod.db_lock:
+        conn.close()
+        dbmod.db = None
+
+
+class FakeResponse:
+    """Just enough of requests.Response"""
+
+    def __init__(self, status_code: int = 200, body=None, headers: dict = None):
+        self.status_code = status_code
+        self._body = body
+        self.headers = headers or {}
+
+    def json(self):
+        if self._body is None:
+            raise ValueError("No JSON body")
+        return self._body
+
+
+class FakeTransport:
+    """
+    Stands in for utils.http.Transport, recording every request
+    'reply' is called with (method, url, kwargs) and returns a FakeResponse
+    """
+
+    def __init__(self, reply):
+        self.reply = reply
+        self.calls = []
+
+    def request(self, method, url, **kwargs):
+        self.calls.append((method, url, kwargs))
+        return self.reply(method, url, kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+
+@pytest.fixture
+def http(monkeypatch):
+    """Installs a FakeTransport, set its reply before making requests"""
+
+    from utils import http as httpmod
+
+    transport = FakeTransport(lambda method, url, kwargs: FakeResponse(500))
+    monkeypatch.setattr(httpmod, "transport", transport)
+    return transport
+
+
+@pytest.fixture
+def helix(http, monkeypatch):
+    """A logged-in Helix client on a FakeTransport, with a fresh cache and rate limiter"""
+
+    from types import SimpleNamespace
+    from twitch import rest
+    from twitch.cache import TTLCache
+    from twitch.ratelimit import HelixRateLimiter
+
+    monkeypatch.setattr(rest, "get_token", lambda: {"access": "token"})
+    monkeypatch.setattr(rest, "get_config", lambda: SimpleNamespace(t_clientid="client"))
+    monkeypatch.setattr(rest, "helix_cache", TTLCache(rest.HELIX_CACHE_SIZE))
+    monkeypatch.setattr(rest, "helix_limiter", HelixRateLimiter())
+    return http
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Freezes time.time() and time.monotonic(), move both with clock.advance(secs)"""
+
+    import time
+
+    class Clock:
+        now = 1_000_000.0
+
+        def advance(self, secs: float):
+            self.now += secs
+
+    c = Clock()
+    monkeypatch.setattr(time, "time", lambda: c.now)
+    monkeypatch.setattr(time, "monotonic", lambda: c.now)
+    return c
@@ -0,0 +1,124 @@
+import pytest
+
+from twitch import batch, rest
+from twitch.batch import LookupBatcher
+from utils.threads import WorkQueue
+
+from .conftest import FakeResponse
+
+
+@pytest.fixture
+def queue(monkeypatch):
+    """A private work queue for the batcher, run by run_jobs()"""
+
+    queue = WorkQueue()
+    monkeypatch.setattr(batch, "queue", queue)
+    monkeypatch.setattr(rest, "queue", queue)
+    return queue
+
+
+def run_jobs(queue: WorkQueue, idle: float = 0.05):
+    """Runs jobs, timers included, until none show up for 'idle' secs"""
+
+    while (job := queue.pop(idle)) is not None:
+        job()
+        queue.done(job)
+
+
+def test_lookups_close_together_share_a_request(queue):
+    fetches, results = [], {}
+
+    def fetch(ids):
+        fetches.append(ids)
+        return [{"user_id": i} for i in ids if i != "missing"]
+
+    batcher = LookupBatcher(fetch, key="user_id", window=0.01)
+    for item_id in ["1", "2", "missing", "1"]:
+        batcher.submit(item_id, lambda result, item_id=item_id: results.setdefault(item_id, []).append(result))
+    run_jobs(queue)
+
+    assert fetches == [["1", "2", "missing"]]
+    assert results == {"1": [{"user_id": "1"}] * 2, "2": [{"user_id": "2"}], "missing": [None]}
+    assert (batcher.lookups, batcher.batches) == (4, 1)
+
+
+def test_full_batch_goes_right_away(queue):
+    fetches = []
+    batcher = LookupBatcher(lambda ids: fetches.append(ids) or [], key="user_id", window=60, size=3)
+    for item_id in "abc":
+        batcher.submit(item_id, lambda result: None)
+
+    job = queue.pop(0)
+    assert job is not None
+    job()
+    assert fetches == [["a", "b", "c"]]
+
+
+def test_lookups_during_a_request_go_in_the_next(queue):
+    fetches = []
+
+    def fetch(ids):
+        fetches.append(ids)
+        if len(fetches) == 1:
+            batcher.submit("late-1", lambda result: None)
+            batcher.submit("late-2", lambda result: None)
+        return []
+
+    batcher = LookupBatcher(fetch, key="user_id", window=0.01)
+    batcher.submit("first", lambda result: None)
+    run_jobs(queue)
+
+    assert fetches == [["first"], ["late-1", "late-2"]]
+
+
+def test_failed_fetch_answers_none(queue):
+    results = []
+
+    def fetch(ids):
+        raise RuntimeError("Helix is down")
+
+    batcher = LookupBatcher(fetch, key="user_id", window=0.01)
+    batcher.submit("1", results.append)
+    batcher.submit("2", results.append)
+    run_jobs(queue)
+
+    assert results == [None, None]
+
+
+def test_get_streams_asks_for_100_at_a_time(helix):
+    def reply(method, url, kwargs):
+        ids = [v for k, v in kwargs["params"] if k == "user_id"]
+        return FakeResponse(200, {"data": [{"user_id": i, "id": f"s{i}"} for i in ids if int(i) % 2 == 0]})
+
+    helix.reply = reply
+    user_ids = [str(i) for i in range(250)]
+    streams = rest.get_streams(user_ids)
+
+    assert [len([p for p in kwargs["params"] if p[0] == "user_id"]) for _, _, kwargs in helix.calls] == [100, 100, 50]
+    assert all(("first", "100") in kwargs["params"] for _, _, kwargs in helix.calls)
+    assert len(streams) == 125
+
+    # Each one is cached for single lookups
+    assert rest.get_stream("42") == {"user_id": "42", "id": "s42"}
+    assert len(helix.calls) == 3
+
+
+def test_lookup_stream_batches_go_lives(helix, queue, monkeypatch):
+    monkeypatch.setattr(rest, "stream_batcher", LookupBatcher(rest.get_streams, key="user_id", window=0.01))
+    helix.reply = lambda method, url, kwargs: FakeResponse(200, {"data": [
+        {"user_id": v, "id": f"s{v}"} for k, v in kwargs["params"] if k == "user_id" and v != "offline"
+    ]})
+
+    results = {}
+    for user_id in ["1", "2", "offline"]:
+        rest.lookup_stream(user_id, lambda stream, user_id=user_id: results.__setitem__(user_id, stream))
+    run_jobs(queue)
+
+    assert len(helix.calls) == 1
+    assert results == {"1": {"user_id": "1", "id": "s1"}, "2": {"user_id": "2", "id": "s2"}, "offline": None}
+
+    # Cached now, answered without another request
+    rest.lookup_stream("1", lambda stream: results.__setitem__("again", stream))
+    run_jobs(queue)
+    assert results["again"] == {"user_id": "1", "id": "s1"}
+    assert len(helix.calls) == 1
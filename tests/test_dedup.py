@@ -0,0 +1,62 @@
+from twitch.dedup import DedupIndex
+from utils import db as dbmod
+
+
+def test_second_sighting_is_a_duplicate(clock):
+    dedup = DedupIndex()
+
+    assert not dedup.check("msg:1")
+    assert dedup.check("msg:1")
+    assert not dedup.check("msg:2")
+    assert dedup.duplicates == 1
+
+
+def test_any_key_matching_is_a_duplicate(clock):
+    dedup = DedupIndex()
+
+    # A retried stream.online has a new message ID but the same stream
+    assert not dedup.check("msg:1", "stream:42:9000")
+    assert dedup.check("msg:2", "stream:42:9000")
+
+    # Nothing from a duplicate is recorded
+    assert not dedup.check("msg:2")
+
+
+def test_keys_expire_after_the_window(clock):
+    dedup = DedupIndex(window=60)
+
+    dedup.check("msg:1")
+    clock.advance(30)
+    dedup.check("msg:2")
+    clock.advance(31)
+
+    assert not dedup.check("msg:1")
+    assert dedup.check("msg:2")
+
+
+def test_oldest_keys_are_evicted_past_maxsize(clock):
+    dedup = DedupIndex(maxsize=3)
+
+    for i in range(5):
+        dedup.check(f"msg:{i}")
+        clock.advance(1)
+
+    assert len(dedup) == 3
+    assert not dedup.check("msg:0")
+    assert dedup.check("msg:4")
+
+
+def test_persisted_keys_survive_a_restart(db, clock):
+    dbmod.commit_outbox([("1", "stream.online", "{}")], [], ["msg:1", "stream:42:9000"])
+    clock.advance(700)
+    dbmod.commit_outbox([("2", "stream.online", "{}")], [], ["msg:2"])
+
+    dedup = DedupIndex(window=600)
+    dedup.enable_persistence()
+
+    assert dedup.persist
+    assert dedup.check("msg:2")
+    assert not dedup.check("msg:1")
+
+    # Stale keys were pruned from the DB too
+    assert [key for key, _ in dbmod.get_seen(0)] == ["msg:2"]
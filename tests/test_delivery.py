@@ -0,0 +1,132 @@
+import time
+import random
+
+import pytest
+
+from discord import delivery
+from discord.delivery import DeliveryQueue
+from utils.db import get_deliveries
+
+from .conftest import FakeResponse
+
+HOOK_A = "https://discord/api/webhooks/a"
+HOOK_B = "https://discord/api/webhooks/b"
+
+
+@pytest.fixture
+def deliveries(db, http, monkeypatch):
+    monkeypatch.setattr(random, "uniform", lambda a, b: a)
+    return DeliveryQueue()
+
+
+def send_next(queue: DeliveryQueue):
+    """What a sender thread does once, returns the delivery and the delay its lane got"""
+
+    item = queue.pop()
+    delay = queue.send(item)
+    queue.done(item, delay)
+    return item, delay
+
+
+def history(db):
+    return [tuple(r) for r in db.execute("SELECT url, status, attempts FROM delivery_history ORDER BY id")]
+
+
+def test_lanes_send_in_order_one_at_a_time(deliveries, http, db):
+    http.reply = lambda method, url, kwargs: FakeResponse(200, {})
+    deliveries.push_many([(HOOK_A, '{"n": 1}'), (HOOK_A, '{"n": 2}'), (HOOK_B, '{"n": 3}')])
+
+    first = deliveries.pop()
+    second = deliveries.pop()
+    assert (first.url, first.payload) == (HOOK_A, '{"n": 1}')
+    assert second.url == HOOK_B, "A's lane is busy until its head is done"
+
+    for item in (first, second):
+        deliveries.done(item, deliveries.send(item))
+    send_next(deliveries)
+
+    assert [url for _, url, _ in http.calls] == [f"{HOOK_A}?wait=true", f"{HOOK_B}?wait=true", f"{HOOK_A}?wait=true"]
+    assert http.calls[2][2]["data"] == '{"n": 2}'
+    assert get_deliveries() == []
+    assert history(db) == [(HOOK_A, 200, 1), (HOOK_B, 200, 1), (HOOK_A, 200, 1)]
+    assert deliveries.sent == 3
+
+
+def test_429_holds_only_that_webhook(deliveries, http, db):
+    replies = {HOOK_A: [FakeResponse(429, {"retry_after": 0.1, "global": False}), FakeResponse(200, {})]}
+    http.reply = lambda method, url, kwargs: replies[HOOK_A].pop(0) if url.startswith(HOOK_A) else FakeResponse(200, {})
+    deliveries.push_many([(HOOK_A, "{}"), (HOOK_B, "{}")])
+
+    item, delay = send_next(deliveries)
+    assert (item.url, delay) == (HOOK_A, 0.1)
+
+    # B goes straight away, A waits out its bucket then resends the same message
+    started = time.monotonic()
+    item, _ = send_next(deliveries)
+    assert item.url == HOOK_B and time.monotonic() - started < 0.05
+    item, _ = send_next(deliveries)
+    assert item.url == HOOK_A and time.monotonic() - started >= 0.09
+
+    # Rate limits aren't failed attempts
+    assert history(db) == [(HOOK_B, 200, 1), (HOOK_A, 200, 1)]
+    assert deliveries.rate_limited == 1
+
+
+def test_global_429_holds_every_webhook(deliveries, http):
+    replies = [FakeResponse(429, {"retry_after": 0.1, "global": True})]
+    http.reply = lambda method, url, kwargs: replies.pop(0) if replies else FakeResponse(200, {})
+    deliveries.push_many([(HOOK_A, "{}"), (HOOK_B, "{}")])
+
+    send_next(deliveries)
+    started = time.monotonic()
+    item, _ = send_next(deliveries)
+    assert item.url == HOOK_B
+    assert time.monotonic() - started >= 0.09
+
+
+def test_dry_bucket_holds_the_lane_until_reset(deliveries, http):
+    http.reply = lambda method, url, kwargs: FakeResponse(200, {}, {
+        "X-RateLimit-Remaining": "0", "X-RateLimit-Reset-After": "0.1"
+    })
+    deliveries.push_many([(HOOK_A, "{}"), (HOOK_A, "{}")])
+
+    _, delay = send_next(deliveries)
+    assert delay == 0.1
+    started = time.monotonic()
+    send_next(deliveries)
+    assert time.monotonic() - started >= 0.09
+
+
+def test_server_errors_retry_then_give_up(deliveries, http, db, monkeypatch):
+    monkeypatch.setattr(delivery, "DISCORD_MAX_ATTEMPTS", 3)
+    http.reply = lambda method, url, kwargs: FakeResponse(502)
+    deliveries.push_many([(HOOK_A, "{}")])
+
+    item = deliveries.pop()
+    delays = []
+    for _ in range(3):
+        delays.append(deliveries.send(item))
+    assert delays == [1.0, 2.0, None]
+    assert history(db) == [(HOOK_A, None, 3)]
+    assert (deliveries.retried, deliveries.failed) == (2, 1)
+
+
+def test_client_errors_are_dropped(deliveries, http, db):
+    http.reply = lambda method, url, kwargs: FakeResponse(404, {"message": "Unknown Webhook"})
+    deliveries.push_many([(HOOK_A, "{}")])
+
+    _, delay = send_next(deliveries)
+    assert delay is None
+    assert history(db) == [(HOOK_A, 404, 1)]
+    assert deliveries.depth() == 0
+
+
+def test_restore_resends_persisted_messages(deliveries, http, db):
+    deliveries.push_many([(HOOK_A, '{"n": 1}')])
+
+    restarted = DeliveryQueue()
+    restarted.restore()
+    http.reply = lambda method, url, kwargs: FakeResponse(204)
+    item, _ = send_next(restarted)
+    assert item.payload == '{"n": 1}'
+    assert get_deliveries() == []
@@ -0,0 +1,111 @@
+import pytest
+
+from twitch import websocket
+from twitch.events import EventRegistry, NotReady
+from twitch.websocket import Notification, dispatch, handle_notification
+from utils.outbox import OutboxEntry
+
+
+@pytest.fixture
+def registry():
+    registry = EventRegistry()
+
+    @registry.register("stream.offline")
+    def on_offline(event, sent_at):
+        pass
+
+    @registry.register("channel.raid", condition="to_broadcaster_user_id", optional=True)
+    def on_raid(event, sent_at):
+        pass
+
+    return registry
+
+
+@pytest.fixture
+def retries(monkeypatch):
+    """Records finished entries and scheduled retries instead of running them"""
+
+    done, later = [], []
+    monkeypatch.setattr(websocket.outbox, "done", done.append)
+    monkeypatch.setattr(websocket.queue, "push_later", lambda delay, func, *args, **kwargs: later.append(args[0]))
+    return done, later
+
+
+def notification(registry, name):
+    return Notification(OutboxEntry("m1", name, "{}", row_id=1), registry.get("notification", name), {}, 100.0)
+
+
+def test_lookups(registry):
+    assert registry.get("notification", "stream.offline").handler.__name__ == "on_offline"
+    assert registry.get("notification", "stream.online") is None
+    assert registry.get("revocation", "stream.offline") is None
+    assert registry.get("notification", "channel.raid").conditions("42") == {"to_broadcaster_user_id": "42"}
+
+
+def test_optional_types_are_opt_in(registry):
+    assert [t.name for t in registry.subscriptions()] == ["stream.offline"]
+    assert [t.name for t in registry.subscriptions(everything=True)] == ["stream.offline", "channel.raid"]
+
+    registry.enable(["channel.raid", "channel.bogus"])
+    assert registry.enabled == {"channel.raid"}
+    assert [t.name for t in registry.subscriptions()] == ["stream.offline", "channel.raid"]
+
+
+def test_dispatch_waits_on_prefetch(registry):
+    lookups = []
+
+    @registry.register("stream.online", prefetch=lambda event, then: lookups.append(then))
+    def on_online(event, sent_at, stream):
+        pass
+
+    assert dispatch(notification(registry, "stream.online")) is None
+    assert len(lookups) == 1
+    assert dispatch(notification(registry, "stream.offline")) is not None
+
+
+def test_success_finishes_the_entry(registry, retries):
+    done, later = retries
+    n = notification(registry, "stream.offline")
+
+    handle_notification(n)
+    assert done == [n.entry]
+    assert later == []
+
+
+def test_not_ready_retries_then_falls_back(registry, retries):
+    done, later = retries
+    fallbacks = []
+
+    @registry.register("stream.online")
+    def on_online(event, sent_at, stream):
+        raise NotReady("Helix is behind")
+
+    @registry.fallback("stream.online")
+    def on_online_fallback(event, sent_at):
+        fallbacks.append(sent_at)
+
+    n = notification(registry, "stream.online")
+    for attempt in range(1, websocket.NOTIFY_MAX_ATTEMPTS):
+        handle_notification(n, None)
+        assert later == [n] * attempt
+        assert done == []
+
+    # Last attempt, the fallback posts what it can
+    handle_notification(n, None)
+    assert fallbacks == [100.0]
+    assert done == [n.entry]
+
+
+def test_no_fallback_leaves_it_in_the_outbox(registry, retries):
+    done, later = retries
+
+    @registry.register("stream.online")
+    def on_online(event, sent_at):
+        raise RuntimeError("Boom")
+
+    n = notification(registry, "stream.online")
+    for _ in range(websocket.NOTIFY_MAX_ATTEMPTS):
+        handle_notification(n)
+
+    assert len(later) == websocket.NOTIFY_MAX_ATTEMPTS - 1
+    assert done == []
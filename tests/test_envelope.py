@@ -0,0 +1,89 @@
+import json
+from datetime import datetime, timezone
+
+import pytest
+
+from twitch.envelope import decode_envelope
+from utils import jsoncodec
+
+FRAME = json.dumps({
+    "metadata": {
+        "message_id": "abc",
+        "message_type": "notification",
+        "message_timestamp": "2023-07-19T14:56:51.634234626Z",
+        "subscription_type": "stream.online",
+    },
+    "payload": {"event": {"broadcaster_user_id": "42", "metadata": {"message_type": "nested"}}},
+})
+
+
+@pytest.fixture(params=["installed", "json"])
+def backend(request, monkeypatch):
+    """Runs a test with the installed JSON library, and again with stdlib's"""
+
+    if request.param == "json":
+        monkeypatch.setattr(jsoncodec, "BACKEND", "json")
+        monkeypatch.setattr(jsoncodec, "loads", json.loads)
+    return request.param
+
+
+def test_metadata_up_front(backend):
+    envelope = decode_envelope(FRAME)
+
+    assert envelope.message_id == "abc"
+    assert envelope.message_type == "notification"
+    assert envelope.subscription_type == "stream.online"
+    assert envelope.event == {"broadcaster_user_id": "42", "metadata": {"message_type": "nested"}}
+
+
+def test_stdlib_payload_is_lazy(backend):
+    envelope = decode_envelope(FRAME)
+    if backend == "json":
+        assert envelope._payload is None
+
+    assert envelope.event["broadcaster_user_id"] == "42"
+    assert envelope._payload is envelope.payload
+
+
+def test_only_top_level_metadata_counts(backend):
+    # A nested metadata key first in the text must not win
+    raw = '{"payload": {"metadata": {"message_type": "nested"}}, "metadata": {"message_type": "session_keepalive"}}'
+
+    envelope = decode_envelope(raw)
+    assert envelope.message_type == "session_keepalive"
+    assert envelope.payload == {"metadata": {"message_type": "nested"}}
+
+
+def test_bytes_frames(backend):
+    assert decode_envelope(FRAME.encode()).event["broadcaster_user_id"] == "42"
+
+
+def test_sent_at_keeps_nanoseconds():
+    base = datetime(2023, 7, 19, 14, 56, 51, tzinfo=timezone.utc).timestamp()
+
+    assert decode_envelope(FRAME).sent_at == pytest.approx(base + 0.634234626)
+
+
+@pytest.mark.parametrize("timestamp, offset", [
+    ("2023-07-19T14:56:51Z", 0.0),
+    ("2023-07-19T14:56:51.5Z", 0.5),
+    ("2023-07-19T14:56:51.123456", 0.123456),
+])
+def test_sent_at_formats(timestamp, offset):
+    base = datetime(2023, 7, 19, 14, 56, 51, tzinfo=timezone.utc).timestamp()
+    raw = json.dumps({"metadata": {"message_timestamp": timestamp}})
+
+    assert decode_envelope(raw).sent_at == pytest.approx(base + offset)
+
+
+def test_bad_sent_at_is_now(clock):
+    raw = json.dumps({"metadata": {"message_timestamp": "yesterday"}})
+
+    assert decode_envelope(raw).sent_at == clock.now
+
+
+def test_codec_round_trip():
+    obj = {"a": [1, 2.5, None, True], "b": "é"}
+
+    assert jsoncodec.loads(jsoncodec.dumps(obj)) == obj
+    assert " " not in jsoncodec.dumps(obj)
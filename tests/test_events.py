@@ -0,0 +1,69 @@
+import pytest
+
+from twitch import events as events_module
+from twitch.events import on_stream_online, on_stream_online_fallback, on_stream_offline, NotReady
+from utils.db import get_stream_history
+
+EVENT = {
+    "id": "9001",
+    "broadcaster_user_id": "42",
+    "broadcaster_user_login": "azure",
+    "broadcaster_user_name": "Azure",
+}
+STREAM = {
+    "id": "9001",
+    "title": "Hello",
+    "game_name": "Chess",
+    "thumbnail_url": "https://example/{width}x{height}.jpg",
+}
+
+
+@pytest.fixture
+def posts(monkeypatch):
+    """Records go-live posts, the first one fails like a Discord error would"""
+
+    posted = []
+
+    def post_golive(event, sent_at, title, game, thumbnail):
+        posted.append(title)
+        if len(posted) == 1:
+            raise RuntimeError("Discord is down")
+
+    monkeypatch.setattr(events_module, "post_golive", post_golive)
+    return posted
+
+
+def test_retried_golive_records_one_row(db, posts):
+    with pytest.raises(RuntimeError):
+        on_stream_online(EVENT, 100.0, STREAM)
+    on_stream_online(EVENT, 100.0, STREAM)
+
+    assert posts == ["Hello", "Hello"]
+    rows = get_stream_history("42")
+    assert [(r['stream_id'], r['kind'], r['title']) for r in rows] == [("9001", "online", "Hello")]
+
+
+def test_not_ready_records_nothing(db, posts):
+    with pytest.raises(NotReady):
+        on_stream_online(EVENT, 100.0, None)
+    assert get_stream_history("42") == []
+
+
+def test_fallback_shares_the_streams_row(db, posts):
+    with pytest.raises(RuntimeError):
+        on_stream_online_fallback(EVENT, 100.0)
+    on_stream_online_fallback(EVENT, 100.0)
+    on_stream_online(EVENT, 100.0, STREAM)
+
+    rows = get_stream_history("42")
+    assert [(r['stream_id'], r['kind']) for r in rows] == [("9001", "online")]
+
+
+def test_each_stream_gets_its_own_row(db, posts):
+    posts.append("skip the failure")
+    on_stream_online(EVENT, 100.0, STREAM)
+    on_stream_offline(EVENT, 200.0)
+    on_stream_online(dict(EVENT, id="9002"), 300.0, dict(STREAM, id="9002"))
+
+    rows = get_stream_history("42")
+    assert [(r['stream_id'], r['kind']) for r in rows] == [("9002", "online"), (None, "offline"), ("9001", "online")]
@@ -0,0 +1,100 @@
+from twitch import rest
+from twitch.cache import TTLCache
+
+from .conftest import FakeResponse
+
+USER = {"id": "42", "login": "azure"}
+
+
+def test_entries_go_stale_but_stay(clock):
+    cache = TTLCache(ttl=10)
+    cache.set("k", "v", etag='"1"')
+
+    assert cache.get("k").fresh(clock.now)
+    clock.advance(10)
+    entry = cache.get("k")
+    assert entry.value == "v" and entry.etag == '"1"'
+    assert not entry.fresh(clock.now)
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    cache.touch("k")
+    assert cache.get("k").fresh(clock.now)
+    assert cache.revalidated == 1
+
+
+def test_least_recently_used_is_evicted(clock):
+    cache = TTLCache(maxsize=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+    cache.set("c", 3)
+
+    assert cache.get("b") is None
+    assert cache.get("a").value == 1 and cache.get("c").value == 3
+    assert len(cache) == 2
+
+
+def test_invalidate(clock):
+    cache = TTLCache()
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.invalidate("a")
+    assert cache.get("a") is None and len(cache) == 1
+    cache.invalidate()
+    assert len(cache) == 0
+
+
+def test_fresh_responses_skip_helix(helix, clock):
+    helix.reply = lambda method, url, kwargs: FakeResponse(200, {"data": [USER]}, {"ETag": '"v1"'})
+
+    assert rest.helix_get("/users", [("id", "42")], ttl=60) == [USER]
+    assert rest.helix_get("/users", [("id", "42")], ttl=60) == [USER]
+    assert len(helix.calls) == 1
+
+    # Other params are another entry
+    rest.helix_get("/users", [("id", "43")], ttl=60)
+    assert len(helix.calls) == 2
+
+
+def test_stale_entry_revalidates_with_etag(helix, clock):
+    helix.reply = lambda method, url, kwargs: FakeResponse(200, {"data": [USER]}, {"ETag": '"v1"'})
+    rest.helix_get("/users", [("id", "42")], ttl=60)
+    assert "If-None-Match" not in helix.calls[0][2]["headers"]
+
+    # Unchanged: Helix answers 304 with no body, and the cached copy is reused
+    clock.advance(61)
+    helix.reply = lambda method, url, kwargs: FakeResponse(304)
+    assert rest.helix_get("/users", [("id", "42")], ttl=60) == [USER]
+    assert helix.calls[1][2]["headers"]["If-None-Match"] == '"v1"'
+
+    # And it's fresh again for another TTL
+    clock.advance(30)
+    assert rest.helix_get("/users", [("id", "42")], ttl=60) == [USER]
+    assert len(helix.calls) == 2
+
+
+def test_changed_entry_is_replaced(helix, clock):
+    helix.reply = lambda method, url, kwargs: FakeResponse(200, {"data": [USER]}, {"ETag": '"v1"'})
+    rest.helix_get("/users", [("id", "42")], ttl=60)
+
+    clock.advance(61)
+    renamed = dict(USER, login="azure2")
+    helix.reply = lambda method, url, kwargs: FakeResponse(200, {"data": [renamed]}, {"ETag": '"v2"'})
+    assert rest.helix_get("/users", [("id", "42")], ttl=60) == [renamed]
+    assert rest.helix_cache.get(("/users", (("id", "42"),))).etag == '"v2"'
+
+
+def test_empty_and_failed_results_are_not_cached(helix, clock):
+    helix.reply = lambda method, url, kwargs: FakeResponse(200, {"data": []})
+    assert rest.helix_get("/streams", [("user_id", "42")], ttl=60) == []
+    helix.reply = lambda method, url, kwargs: FakeResponse(500, {"error": "oops"})
+    assert rest.helix_get("/streams", [("user_id", "42")], ttl=60) is None
+    assert len(rest.helix_cache) == 0
+
+
+def test_uncached_calls_always_go_out(helix, clock):
+    helix.reply = lambda method, url, kwargs: FakeResponse(200, {"data": [USER]}, {"ETag": '"v1"'})
+    rest.helix_get("/users", [("id", "42")])
+    rest.helix_get("/users", [("id", "42")])
+    assert len(helix.calls) == 2
+    assert len(rest.helix_cache) == 0
@@ -0,0 +1,96 @@
+import pytest
+from flask import Flask
+
+import routes as routes_module
+from utils import db as dbmod
+from utils.histogram import Histogram, HistogramSet, BUCKETS
+
+
+@pytest.fixture
+def client(db):
+    app = Flask(__name__)
+    app.register_blueprint(routes_module.routes)
+    return app.test_client()
+
+
+def test_percentiles_are_bucket_bounds():
+    histogram = Histogram()
+    assert histogram.summary() == {"count": 0, "mean": None, "p50": None, "p99": None, "max": None}
+
+    for _ in range(98):
+        histogram.record(0.5)
+    histogram.record(2.0)
+    histogram.record(30.0)
+
+    summary = histogram.summary()
+    assert summary["count"] == 100
+    assert summary["mean"] == pytest.approx((98 * 0.5 + 32.0) / 100)
+    assert summary["p50"] == BUCKETS[Histogram.bucket(0.5)]
+    assert summary["p99"] == BUCKETS[Histogram.bucket(2.0)]
+    assert summary["max"] == 30.0
+
+
+def test_percentiles_never_pass_the_max():
+    histogram = Histogram()
+    histogram.record(0.011)
+
+    assert histogram.percentile(0.5) == 0.011
+
+    # Past the last bucket, only the max is known
+    histogram.record(10_000.0)
+    assert histogram.percentile(1.0) == 10_000.0
+
+
+def test_latency_survives_a_restart(db, clock):
+    ids = dbmod.add_deliveries([("https://discord/a", "{}"), ("https://discord/b", "{}")], "42", clock.now)
+    clock.advance(1.5)
+
+    assert dbmod.finish_delivery(ids[0], 204, 1) == ("42", 1.5)
+    assert dbmod.finish_delivery(ids[1], 404, 3) == ("42", None)
+    assert dbmod.finish_delivery(ids[1], 204, 1) == (None, None)
+
+    latencies = HistogramSet()
+    latencies.load(dbmod.get_latency_buckets())
+    summary = latencies.summary()["42"]
+    assert summary["count"] == 1
+    assert summary["max"] == 1.5
+
+
+def test_deliveries_without_an_origin_have_no_latency(db):
+    ids = dbmod.add_deliveries([("https://discord/a", "{}")])
+
+    assert dbmod.finish_delivery(ids[0], 204, 1) == (None, None)
+    assert dbmod.get_latency_buckets() == []
+
+
+def test_history_ranges(db):
+    for i, kind in enumerate(["online", "offline", "online", "offline"]):
+        dbmod.add_stream_event("42", kind, 100.0 * (i + 1), str(i) if kind == "online" else None)
+    dbmod.add_stream_event("7", "online", 250.0, "x")
+
+    def at(**kwargs):
+        return [row['at'] for row in dbmod.get_stream_history(**kwargs)]
+
+    assert at() == [400.0, 300.0, 250.0, 200.0, 100.0]
+    assert at(broadcaster_id="42", since=200, until=400) == [300.0, 200.0]
+    assert at(limit=2) == [400.0, 300.0]
+
+
+def test_history_endpoint(client):
+    dbmod.add_stream_event("42", "online", 100.0, "1", "Hello", "Chess")
+    dbmod.add_stream_event("7", "online", 200.0, "2")
+
+    res = client.get("/stats/history?broadcaster=42")
+    assert res.status_code == 200
+    assert [(row['stream_id'], row['title']) for row in res.get_json()] == [("1", "Hello")]
+
+    assert client.get("/stats/history?since=150").get_json()[0]['stream_id'] == "2"
+    assert client.get("/stats/history?limit=lots").status_code == 400
+
+
+def test_latency_endpoint(client, monkeypatch):
+    latencies = HistogramSet()
+    latencies.record("42", 2.0)
+    monkeypatch.setattr(routes_module, "latencies", latencies)
+
+    assert client.get("/stats/latency").get_json()["42"]["max"] == 2.0
@@ -0,0 +1,105 @@
+import logging
+import threading
+
+from utils.metrics import Registry
+
+
+def parse(text: str):
+    """Splits exposition text into {name: type} and sample lines"""
+
+    types, samples = {}, []
+    for line in text.splitlines():
+        if line.startswith("# TYPE "):
+            _, _, name, kind = line.split(" ")
+            types[name] = kind
+        elif line and not line.startswith("#"):
+            samples.append(line)
+    return types, samples
+
+
+def test_counter_merges_thread_shards():
+    registry = Registry()
+    frames = registry.counter("test_frames_total", "Frames", ("type",))
+
+    def count():
+        for _ in range(1000):
+            frames.inc("notification")
+
+    threads = [threading.Thread(target=count) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    frames.inc("keepalive", amount=2)
+
+    types, samples = parse(registry.render())
+    assert types == {"test_frames_total": "counter"}
+    assert samples == ['test_frames_total{type="keepalive"} 2', 'test_frames_total{type="notification"} 4000']
+
+
+def test_histogram_buckets_are_cumulative():
+    registry = Registry()
+    latency = registry.histogram("test_seconds", "Latency", buckets=(0.1, 1.0))
+    for value in (0.05, 0.5, 0.5, 5.0):
+        latency.observe(value)
+
+    types, samples = parse(registry.render())
+    assert types == {"test_seconds": "histogram"}
+    assert samples == [
+        'test_seconds_bucket{le="0.1"} 1',
+        'test_seconds_bucket{le="1.0"} 3',
+        'test_seconds_bucket{le="+Inf"} 4',
+        "test_seconds_sum 6.05",
+        "test_seconds_count 4",
+    ]
+
+
+def test_gauges_and_counter_funcs_read_callbacks():
+    registry = Registry()
+    state = {"depth": 3, "sent": 7}
+    registry.gauge("test_depth", "Depth", lambda: state["depth"])
+    registry.counter_func("test_sent_total", "Sent", lambda: {("ok",): state["sent"], ("skip",): None}, ("outcome",))
+
+    types, samples = parse(registry.render())
+    assert types == {"test_depth": "gauge", "test_sent_total": "counter"}
+    assert samples == ["test_depth 3", 'test_sent_total{outcome="ok"} 7']
+
+    state["depth"] = 1
+    assert "test_depth 1" in registry.render()
+
+
+def test_labels_are_escaped():
+    registry = Registry()
+    registry.counter("test_total", "Test", ("name",)).inc('a "b"\\\nc')
+    assert 'test_total{name="a \\"b\\"\\\\\\nc"} 1' in registry.render()
+
+
+def test_broken_metric_is_left_out_and_logged_once(caplog):
+    registry = Registry()
+    broken = {"raise": True}
+
+    def read():
+        if broken["raise"]:
+            raise RuntimeError("boom")
+        return 1
+
+    registry.gauge("test_broken", "Broken", read)
+    registry.gauge("test_fine", "Fine", lambda: 2)
+
+    with caplog.at_level(logging.ERROR):
+        for _ in range(3):
+            types, samples = parse(registry.render())
+            assert types == {"test_fine": "gauge"}
+            assert samples == ["test_fine 2"]
+    assert [r.getMessage() for r in caplog.records].count(
+        "Metric test_broken failed to render, leaving it out!"
+    ) == 1
+
+    # Logged again if it breaks again after recovering
+    broken["raise"] = False
+    assert "test_broken 1" in registry.render()
+    broken["raise"] = True
+    caplog.clear()
+    with caplog.at_level(logging.ERROR):
+        registry.render()
+    assert len(caplog.records) == 1
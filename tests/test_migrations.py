@@ -0,0 +1,117 @@
+import sqlite3
+import multiprocessing
+
+import pytest
+
+from utils.migrations import MIGRATIONS, migrate
+
+
+def version(conn: sqlite3.Connection):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def tables(conn: sqlite3.Connection):
+    return {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+
+
+@pytest.fixture
+def baseline(tmp_path):
+    """A DB as the bot left it before migrations, one untyped token table and a token"""
+
+    conn = sqlite3.connect(str(tmp_path / "twitch.db"))
+    conn.row_factory = sqlite3.Row
+    conn.execute("CREATE TABLE twitch_token(type, access, expires, refresh)")
+    conn.execute("INSERT INTO twitch_token values ('bearer', 'old', 1, 'r0')")
+    conn.execute("INSERT INTO twitch_token values ('bearer', 'abc', 1700000000, 'r1')")
+    conn.commit()
+    yield conn
+    conn.close()
+
+
+def test_fresh_db_gets_latest_version(tmp_path):
+    conn = sqlite3.connect(str(tmp_path / "fresh.db"))
+    assert migrate(conn) == len(MIGRATIONS)
+    assert version(conn) == len(MIGRATIONS)
+    assert {"twitch_token", "shard_members", "shard_leases", "shard_slots"} <= tables(conn)
+
+
+def test_baseline_keeps_latest_token(baseline):
+    assert migrate(baseline) == len(MIGRATIONS)
+    assert version(baseline) == len(MIGRATIONS)
+
+    rows = [dict(r) for r in baseline.execute("SELECT user_id, type, access, expires, refresh FROM twitch_token")]
+    assert rows == [{"user_id": "", "type": "bearer", "access": "abc", "expires": 1700000000, "refresh": "r1"}]
+    assert "twitch_token_old" not in tables(baseline)
+
+    # Sharding columns default to unsharded
+    columns = {row["name"]: row["dflt_value"] for row in baseline.execute("PRAGMA table_info(eventsub_outbox)")}
+    assert columns["shard"] == "''"
+
+
+def test_migrating_twice_changes_nothing(baseline):
+    migrate(baseline)
+    before = baseline.execute("SELECT * FROM twitch_token").fetchall()
+    schema = baseline.execute("SELECT sql FROM sqlite_master ORDER BY name").fetchall()
+
+    assert migrate(baseline) == len(MIGRATIONS)
+    assert version(baseline) == len(MIGRATIONS)
+    assert baseline.execute("SELECT * FROM twitch_token").fetchall() == before
+    assert baseline.execute("SELECT sql FROM sqlite_master ORDER BY name").fetchall() == schema
+
+
+def test_failed_migration_rolls_back(baseline, monkeypatch):
+    broken = MIGRATIONS[:1] + ["CREATE TABLE half(id); SELECT * FROM missing;"]
+    monkeypatch.setattr("utils.migrations.MIGRATIONS", broken)
+
+    with pytest.raises(sqlite3.OperationalError):
+        migrate(baseline)
+    assert version(baseline) == 1
+    assert "half" not in tables(baseline)
+
+
+def migrate_at_once(path: str, barrier, results):
+    """Runs in a child process, migrating as soon as every process is ready"""
+
+    conn = sqlite3.connect(path, timeout=30)
+    conn.execute("PRAGMA journal_mode=WAL")
+    barrier.wait()
+    try:
+        results.put(migrate(conn))
+    except Exception as e:
+        results.put(repr(e))
+    finally:
+        conn.close()
+
+
+@pytest.mark.parametrize("trial", range(5))
+def test_concurrent_migrations(tmp_path, trial):
+    path = str(tmp_path / "twitch.db")
+    ctx = multiprocessing.get_context("fork")
+    barrier, results = ctx.Barrier(4), ctx.Queue()
+    procs = [ctx.Process(target=migrate_at_once, args=(path, barrier, results)) for _ in range(4)]
+    for proc in procs:
+        proc.start()
+    outcomes = [results.get(timeout=60) for _ in procs]
+    for proc in procs:
+        proc.join()
+
+    assert outcomes == [len(MIGRATIONS)] * 4
+    conn = sqlite3.connect(path)
+    assert version(conn) == len(MIGRATIONS)
+    conn.close()
+
+
+def test_duplicate_history_is_collapsed(tmp_path, monkeypatch):
+    conn = sqlite3.connect(str(tmp_path / "twitch.db"))
+    monkeypatch.setattr("utils.migrations.MIGRATIONS", MIGRATIONS[:5])
+    migrate(conn)
+    rows = [("42", "9001", "online", 1.0), ("42", "9001", "online", 2.0), ("42", None, "offline", 3.0),
+            ("42", None, "offline", 4.0), ("42", "9002", "online", 5.0)]
+    conn.executemany("INSERT INTO stream_history(broadcaster_id, stream_id, kind, at) values (?, ?, ?, ?)", rows)
+    conn.commit()
+
+    monkeypatch.setattr("utils.migrations.MIGRATIONS", MIGRATIONS)
+    assert migrate(conn) == len(MIGRATIONS)
+    kept = conn.execute("SELECT stream_id, kind, at FROM stream_history ORDER BY at").fetchall()
+    assert kept == [("9001", "online", 1.0), (None, "offline", 3.0), (None, "offline", 4.0), ("9002", "online", 5.0)]
+    conn.close()
@@ -0,0 +1,51 @@
+import threading
+
+import pytest
+
+from twitch import oauth
+from utils.threads import WorkQueue
+
+
+@pytest.fixture
+def queue(monkeypatch):
+    """A private queue, with a token that expires in an hour"""
+
+    queue = WorkQueue()
+    monkeypatch.setattr(oauth, "queue", queue)
+    monkeypatch.setattr(oauth, "refresh_job", None)
+    monkeypatch.setattr(oauth, "get_token", lambda: {"expires": oauth.time.time() + 3600})
+    return queue
+
+
+def test_reschedule_replaces_the_timer(queue):
+    first = oauth.schedule_refresh()
+    second = oauth.schedule_refresh(60)
+
+    assert first.cancelled and not second.cancelled
+    assert oauth.refresh_job is second
+
+
+def test_concurrent_reschedules_leave_one_timer(queue):
+    barrier = threading.Barrier(8)
+    jobs = []
+
+    def reschedule():
+        barrier.wait()
+        for _ in range(50):
+            jobs.append(oauth.schedule_refresh(60))
+
+    threads = [threading.Thread(target=reschedule) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    live = [job for job in jobs if not job.cancelled]
+    assert live == [oauth.refresh_job]
+
+
+def test_no_token_no_timer(queue, monkeypatch):
+    oauth.schedule_refresh()
+    monkeypatch.setattr(oauth, "get_token", lambda: None)
+    assert oauth.schedule_refresh() is None
+    assert oauth.refresh_job is None
@@ -0,0 +1,103 @@
+import pytest
+
+from utils import db as dbmod
+from utils import outbox as outbox_module
+from utils.outbox import Outbox
+
+
+def rows():
+    return [(row['message_id'], row['type']) for row in dbmod.get_outbox()]
+
+
+def test_appends_are_group_committed(db):
+    outbox = Outbox()
+    entries = [outbox.append(f"m{i}", "stream.online", "{}") for i in range(3)]
+    assert not any(entry.wait(0) for entry in entries)
+
+    outbox.flush()
+    assert outbox.batches == 1
+    assert outbox.committed == 3
+    assert all(entry.wait(0) and entry.row_id is not None for entry in entries)
+    assert rows() == [("m0", "stream.online"), ("m1", "stream.online"), ("m2", "stream.online")]
+
+
+def test_done_rows_are_deleted_on_the_next_commit(db):
+    outbox = Outbox()
+    first, second = outbox.append("m1", "stream.online", "{}"), outbox.append("m2", "stream.online", "{}")
+    outbox.flush()
+
+    outbox.done(first)
+    assert len(rows()) == 2
+    outbox.flush()
+    assert rows() == [("m2", "stream.online")]
+    assert second.row_id is not None
+
+
+def test_finished_before_commit_is_never_written(db):
+    outbox = Outbox()
+    entry = outbox.append("m1", "stream.online", "{}", ["msg:m1"])
+    outbox.done(entry)
+    outbox.flush()
+
+    # The write is skipped, but its dedup key still lands
+    assert entry.wait(0)
+    assert rows() == []
+    assert outbox.committed == 0
+    assert [key for key, _ in dbmod.get_seen(0)] == ["msg:m1"]
+
+
+def test_failed_commit_keeps_everything(db, monkeypatch):
+    outbox = Outbox()
+    entry = outbox.append("m1", "stream.online", "{}")
+
+    def broken(*args):
+        raise RuntimeError("Disk full")
+
+    monkeypatch.setattr(outbox_module, "commit_outbox", broken)
+    with pytest.raises(RuntimeError):
+        outbox.flush()
+    assert outbox.pending() == 1
+    assert not entry.wait(0)
+
+    monkeypatch.undo()
+    outbox.flush()
+    assert rows() == [("m1", "stream.online")]
+
+
+def test_full_batches_skip_the_window(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(outbox_module.time, "sleep", sleeps.append)
+    outbox = Outbox(window=0.5, size=2)
+
+    outbox.append("m1", "stream.online", "{}")
+    outbox.wait_work()
+    assert sleeps == [0.5]
+
+    outbox.append("m2", "stream.online", "{}")
+    outbox.wait_work()
+    assert sleeps == [0.5]
+
+
+def test_restart_restores_unfinished(db):
+    outbox = Outbox()
+    done = outbox.append("m1", "stream.online", "{}")
+    outbox.append("m2", "stream.offline", "{}")
+    outbox.flush()
+    outbox.done(done)
+    outbox.flush()
+
+    restored = Outbox().restore()
+    assert [(e.message_id, e.kind) for e in restored] == [("m2", "stream.offline")]
+    assert restored[0].wait(0)
+
+
+def test_exit_flushes(db, monkeypatch):
+    import twitchbot
+
+    outbox = Outbox()
+    monkeypatch.setattr(twitchbot, "outbox", outbox)
+    monkeypatch.setattr(twitchbot, "send_status_notif", lambda *args, **kwargs: None)
+    outbox.append("m1", "stream.online", "{}")
+
+    twitchbot.at_exit()
+    assert rows() == [("m1", "stream.online")]
@@ -0,0 +1,96 @@
+import time
+import random
+import threading
+
+import pytest
+
+from twitch import rest
+from twitch.ratelimit import HelixRateLimiter
+
+from .conftest import FakeResponse
+
+
+@pytest.fixture(autouse=True)
+def no_jitter(monkeypatch):
+    monkeypatch.setattr(random, "uniform", lambda a, b: a)
+
+
+def test_full_bucket_never_waits():
+    limiter = HelixRateLimiter(limit=10, period=60)
+    started = time.monotonic()
+    for _ in range(10):
+        limiter.acquire()
+    assert time.monotonic() - started < 0.05
+    assert limiter.throttled == 0
+
+
+def test_empty_bucket_waits_for_a_refill():
+    limiter = HelixRateLimiter(limit=20, period=1.0)
+    for _ in range(20):
+        limiter.acquire()
+
+    started = time.monotonic()
+    limiter.acquire()
+    waited = time.monotonic() - started
+    assert 0.03 < waited < 0.5
+    assert limiter.throttled == 1
+    assert limiter.throttled_time == pytest.approx(waited, abs=0.01)
+
+
+def test_waiters_are_served_by_priority():
+    limiter = HelixRateLimiter(limit=10, period=1.0)
+    limiter.block(0.1)
+    order = []
+
+    def call(priority, name):
+        limiter.acquire(priority)
+        order.append(name)
+
+    threads = []
+    for priority, name in [(limiter.PRIORITY_DASHBOARD, "dashboard"), (limiter.PRIORITY_DEFAULT, "default"),
+                           (limiter.PRIORITY_NOTIFY, "notify")]:
+        threads.append(threading.Thread(target=call, args=(priority, name)))
+        threads[-1].start()
+        time.sleep(0.01)
+    for thread in threads:
+        thread.join()
+
+    assert order == ["notify", "default", "dashboard"]
+
+
+def test_headers_resync_the_bucket():
+    limiter = HelixRateLimiter(limit=800, period=60)
+    limiter.update({"Ratelimit-Limit": "800", "Ratelimit-Remaining": "0", "Ratelimit-Reset": str(time.time() + 0.1)})
+
+    started = time.monotonic()
+    limiter.acquire()
+    assert time.monotonic() - started >= 0.09
+
+    # Missing or bad headers change nothing
+    limiter.update({"Ratelimit-Limit": "abc"})
+    limiter.update({})
+    assert limiter.limit == 800
+
+
+def test_429_is_retried_after_reset(helix):
+    replies = iter([
+        FakeResponse(429, {}, {"Ratelimit-Reset": str(time.time() + 0.05)}),
+        FakeResponse(200, {"data": [{"id": "42"}]}),
+    ])
+    helix.reply = lambda method, url, kwargs: next(replies)
+
+    started = time.monotonic()
+    assert rest.helix_get("/users") == [{"id": "42"}]
+    assert time.monotonic() - started >= 0.04
+    assert len(helix.calls) == 2
+    assert rest.helix_limiter.retries == 1
+
+
+def test_429_gives_up_after_max_retries(helix, monkeypatch):
+    monkeypatch.setattr(rest, "HELIX_MAX_RETRIES", 2)
+    helix.reply = lambda method, url, kwargs: FakeResponse(429, {"error": "Too Many Requests"}, {
+        "Ratelimit-Reset": str(time.time())
+    })
+
+    assert rest.helix_get("/users") is None
+    assert len(helix.calls) == 3
@@ -0,0 +1,191 @@
+import json
+import time
+import random
+import threading
+
+import pytest
+from websockets.sync.server import serve
+
+from twitch import websocket
+from twitch.websocket import EventSubSession
+
+
+def frame(message_type: str, payload: dict):
+    return json.dumps({
+        "metadata": {
+            "message_id": f"{message_type}-{time.monotonic()}",
+            "message_type": message_type,
+            "message_timestamp": "2023-07-19T14:56:51.634234626Z",
+        },
+        "payload": payload,
+    })
+
+
+def welcome(session_id: str, keepalive: float = 10):
+    return frame("session_welcome", {"session": {"id": session_id, "keepalive_timeout_seconds": keepalive}})
+
+
+class FakeManager:
+    """Records what a session asks of its manager"""
+
+    def __init__(self):
+        self.resubscribed = []
+        self.closed = threading.Event()
+
+    def resubscribe(self, session):
+        self.resubscribed.append(session.session_id)
+
+    def on_session_closed(self, session):
+        self.closed.set()
+
+
+class FakeTwitch:
+    """
+    A local EventSub WebSocket server
+    Each connection runs the next script, a function of (connection, url)
+    """
+
+    def __init__(self, *scripts):
+        self.scripts = list(scripts)
+        self.connections = 0
+        self.server = serve(self.handle, "localhost", 0)
+        self.url = f"ws://localhost:{self.server.socket.getsockname()[1]}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def handle(self, connection):
+        self.connections += 1
+        script = self.scripts.pop(0) if self.scripts else hold
+        # Give the client time to finish its handshake, a frame riding along with the 101 response can get lost
+        time.sleep(0.05)
+        script(connection, self.url)
+
+
+def hold(connection, url):
+    """Keeps a connection open until the client goes away"""
+    try:
+        for _ in connection:
+            pass
+    except Exception:
+        pass
+
+
+def wait_for(condition, timeout: float = 5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "Timed out"
+        time.sleep(0.01)
+
+
+@pytest.fixture
+def twitch(monkeypatch):
+    """Starts a FakeTwitch with the given scripts, pointing sessions at it"""
+
+    servers = []
+    monkeypatch.setattr(random, "uniform", lambda a, b: a)
+    monkeypatch.setattr(websocket, "EVENTSUB_BACKOFF_BASE", 0.02)
+    monkeypatch.setattr(websocket, "EVENTSUB_KEEPALIVE_GRACE", 0.1)
+    websocket.STOP_EVTLOOP_EVENT.clear()
+
+    def start(*scripts):
+        server = FakeTwitch(*scripts)
+        monkeypatch.setattr(websocket, "TWITCH_WS", server.url)
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.server.shutdown()
+
+
+@pytest.fixture
+def session():
+    manager = FakeManager()
+    session = EventSubSession("EventSub-test", manager)
+    yield session
+    session.close()
+    manager.closed.wait(5)
+
+
+def test_handoff_keeps_the_session(twitch, session):
+    def first(connection, url):
+        connection.send(welcome("abc"))
+        connection.send(frame("session_reconnect", {"session": {"id": "abc", "reconnect_url": f"{url}/moved"}}))
+        hold(connection, url)
+
+    def moved(connection, url):
+        assert connection.request.path == "/moved"
+        connection.send(welcome("abc"))
+        hold(connection, url)
+
+    server = twitch(first, moved)
+    session.subscriptions = {"42": ["sub-1"]}
+    session.start()
+
+    wait_for(lambda: server.connections == 2 and session.reconnect_url is None and session.state == "connected")
+    assert session.session_id == "abc"
+    assert session.reconnects == 0
+    assert session.manager.resubscribed == []
+
+
+def test_dropped_socket_reconnects_and_resubscribes(twitch, session):
+    def dropped(connection, url):
+        connection.send(welcome("first"))
+        connection.close()
+
+    def fresh(connection, url):
+        connection.send(welcome("second"))
+        hold(connection, url)
+
+    twitch(dropped, fresh)
+    session.subscriptions = {"42": ["sub-1"]}
+    session.start()
+
+    wait_for(lambda: session.session_id == "second" and session.state == "connected")
+    assert session.reconnects == 1
+    assert session.manager.resubscribed == ["second"]
+
+
+def test_silence_past_keepalive_reconnects(twitch, session):
+    def silent(connection, url):
+        connection.send(welcome("quiet", keepalive=0.2))
+        hold(connection, url)
+
+    def fresh(connection, url):
+        connection.send(welcome("loud"))
+        hold(connection, url)
+
+    twitch(silent, fresh)
+    session.start()
+
+    started = time.monotonic()
+    wait_for(lambda: session.session_id == "loud")
+    assert time.monotonic() - started >= 0.3
+    assert session.reconnects == 1
+
+
+def test_keepalives_hold_the_socket_open(twitch, session):
+    def chatty(connection, url):
+        connection.send(welcome("chatty", keepalive=0.2))
+        for _ in range(6):
+            time.sleep(0.1)
+            connection.send(frame("session_keepalive", {}))
+        hold(connection, url)
+
+    server = twitch(chatty)
+    session.start()
+    time.sleep(0.7)
+    assert server.connections == 1
+    assert session.reconnects == 0
+
+
+def test_backoff_grows_then_caps(monkeypatch):
+    monkeypatch.setattr(random, "uniform", lambda a, b: b)
+    session = EventSubSession("EventSub-test", FakeManager())
+
+    delays = [session.backoff() for _ in range(12)]
+    assert delays[:3] == [0.25, 0.5, 1.0]
+    assert max(delays) == websocket.EVENTSUB_BACKOFF_MAX
+
+    # A welcome starts it over
+    session.on_welcome(welcome("abc"))
+    assert session.backoff() == 0.25
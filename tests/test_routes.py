@@ -0,0 +1,84 @@
+from types import SimpleNamespace
+
+import pytest
+from flask import Flask
+
+import routes as routes_module
+from utils.db import store_broadcaster, get_broadcasters
+
+SECRET = "hunter2"
+
+
+@pytest.fixture
+def client(db, monkeypatch):
+    """Flask test client, with Twitch and the subscription manager stubbed out"""
+
+    config = SimpleNamespace(admin_secret=SECRET)
+    watched = set()
+
+    def unwatch(broadcaster_id):
+        if broadcaster_id not in watched:
+            return None
+        watched.discard(broadcaster_id)
+        return broadcaster_id
+
+    monkeypatch.setattr(routes_module, "get_config", lambda: config)
+    monkeypatch.setattr(routes_module, "get_users", lambda logins: [
+        {"id": "42", "login": login, "display_name": login.title()} for login in logins if login == "azure"
+    ])
+    monkeypatch.setattr(routes_module, "watch_broadcaster", lambda broadcaster_id: watched.add(broadcaster_id) or 1)
+    monkeypatch.setattr(routes_module, "unwatch_broadcaster", unwatch)
+
+    app = Flask(__name__)
+    app.register_blueprint(routes_module.routes)
+    client = app.test_client()
+    client.config = config
+    client.watched = watched
+    return client
+
+
+def test_add_needs_the_secret(client):
+    assert client.post("/broadcasters/add", data={"login": "azure"}).status_code == 403
+    assert client.post("/broadcasters/add", data={"login": "azure", "secret": "wrong"}).status_code == 403
+    assert client.watched == set()
+    assert get_broadcasters() == []
+
+    res = client.post("/broadcasters/add", data={"login": "azure", "secret": SECRET})
+    assert res.status_code == 302
+    assert client.watched == {"42"}
+    assert [b['id'] for b in get_broadcasters()] == ["42"]
+
+
+def test_bearer_token_works(client):
+    res = client.post("/broadcasters/add", data={"login": "azure"}, headers={"Authorization": f"Bearer {SECRET}"})
+    assert res.status_code == 302
+
+
+def test_unset_secret_refuses_everything(client):
+    client.config.admin_secret = ""
+    assert client.post("/broadcasters/add", data={"login": "azure", "secret": ""}).status_code == 403
+    assert client.post("/broadcasters/remove", data={"id": "42", "secret": ""}).status_code == 403
+
+
+def test_remove_needs_the_secret(client):
+    store_broadcaster("42", "azure", "Azure")
+    client.watched.add("42")
+
+    assert client.post("/broadcasters/remove", data={"id": "42"}).status_code == 403
+    assert client.watched == {"42"}
+
+    assert client.post("/broadcasters/remove", data={"id": "42", "secret": SECRET}).status_code == 302
+    assert client.watched == set()
+    assert get_broadcasters() == []
+
+
+def test_remove_held_by_another_shard(client):
+    """Only stored, this shard doesn't watch them, another one drops them on its next tick"""
+
+    store_broadcaster("42", "azure", "Azure")
+    assert client.post("/broadcasters/remove", data={"id": "42", "secret": SECRET}).status_code == 302
+    assert get_broadcasters() == []
+
+
+def test_remove_unknown(client):
+    assert client.post("/broadcasters/remove", data={"id": "7", "secret": SECRET}).status_code == 404
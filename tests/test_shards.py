@@ -0,0 +1,196 @@
+import time
+
+import pytest
+
+from utils import db as dbmod
+from utils.db import heartbeat_member, get_members, leave_member, claim_orphans, renew_leases, \
+    acquire_leases, release_leases, claim_slot, renew_slots, release_slot, add_deliveries, commit_outbox, \
+    add_subscriptions
+from utils.shards import HashRing, ShardCoordinator, SQLiteBackend
+
+TTL = 30.0
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Freezes time.time(), move it with clock.advance(secs)"""
+
+    class Clock:
+        now = 1_000_000.0
+
+        def advance(self, secs: float):
+            self.now += secs
+
+    c = Clock()
+    monkeypatch.setattr(time, "time", lambda: c.now)
+    return c
+
+
+@pytest.fixture
+def shard(monkeypatch):
+    """Queues rows under a shard ID, as set_shard() would"""
+
+    def use(member_id: str):
+        monkeypatch.setattr(dbmod, "shard_id", member_id)
+    return use
+
+
+def test_acquire_free_and_own_leases(db, clock):
+    assert acquire_leases(["1", "2"], "a", TTL) == ["1", "2"]
+    assert acquire_leases(["2", "3"], "b", TTL) == ["3"]
+
+    # Our own lease is just extended
+    assert acquire_leases(["1"], "a", TTL) == ["1"]
+    assert sorted(renew_leases("a", TTL)) == ["1", "2"]
+    assert renew_leases("b", TTL) == ["3"]
+
+
+def test_renew_keeps_leases_alive(db, clock):
+    acquire_leases(["1"], "a", TTL)
+    for _ in range(5):
+        clock.advance(TTL - 1)
+        assert renew_leases("a", TTL) == ["1"]
+    assert acquire_leases(["1"], "b", TTL) == []
+
+
+def test_expired_lease_is_taken_over(db, clock):
+    acquire_leases(["1"], "a", TTL)
+    clock.advance(TTL - 1)
+    assert acquire_leases(["1"], "b", TTL) == []
+
+    clock.advance(2)
+    assert acquire_leases(["1"], "b", TTL) == ["1"]
+    assert renew_leases("a", TTL) == []
+    assert renew_leases("b", TTL) == ["1"]
+
+
+def test_release_frees_only_own_leases(db, clock):
+    acquire_leases(["1", "2"], "a", TTL)
+    release_leases(["1"], "a")
+    release_leases(["2"], "b")
+
+    assert renew_leases("a", TTL) == ["2"]
+    assert acquire_leases(["1"], "b", TTL) == ["1"]
+
+
+def test_heartbeat_reports_stalls(db, clock):
+    assert heartbeat_member("a", "host", TTL) is False
+    clock.advance(TTL - 1)
+    assert heartbeat_member("a", "host", TTL) is True
+    clock.advance(TTL + 1)
+    assert heartbeat_member("a", "host", TTL) is False
+
+
+def test_members_need_a_session_slot(db, clock):
+    for member_id in ("a", "b", "c"):
+        heartbeat_member(member_id, "host", TTL)
+    assert get_members() == []
+
+    assert claim_slot("a", 2, TTL) == 0
+    assert claim_slot("b", 2, TTL) == 1
+    assert claim_slot("c", 2, TTL) is None
+    assert get_members() == ["a", "b"]
+
+    # A slot frees up once released, or once its owner stops renewing
+    release_slot(1, "b")
+    assert claim_slot("c", 2, TTL) == 1
+    clock.advance(TTL + 1)
+    heartbeat_member("c", "host", TTL)
+    assert renew_slots("c", TTL) == [1]
+    assert claim_slot("b", 2, TTL) == 0
+    assert renew_slots("a", TTL) == []
+
+
+def test_leave_frees_leases_and_slots(db, clock):
+    heartbeat_member("a", "host", TTL)
+    claim_slot("a", 3, TTL)
+    acquire_leases(["1"], "a", TTL)
+
+    leave_member("a")
+    assert get_members() == []
+    assert acquire_leases(["1"], "b", TTL) == ["1"]
+    assert claim_slot("b", 1, TTL) == 0
+
+
+def test_claim_orphans_takes_dead_shards_work(db, clock, shard):
+    heartbeat_member("dead", "host", TTL)
+    heartbeat_member("alive", "host", TTL)
+    claim_slot("dead", 3, TTL)
+    acquire_leases(["1"], "dead", TTL)
+
+    shard("dead")
+    add_deliveries([("https://discord/1", "{}")], "1")
+    commit_outbox([("m1", "stream.online", "{}")], [])
+    add_subscriptions([("sub1", "1", "stream.online", "1", "session")])
+    shard("alive")
+    add_deliveries([("https://discord/2", "{}")], "2")
+
+    # Still alive, nothing to claim
+    clock.advance(TTL - 1)
+    heartbeat_member("alive", "host", TTL)
+    assert claim_orphans("alive") == ([], [], [])
+
+    clock.advance(2)
+    dead, deliveries, notifications = claim_orphans("alive")
+    assert dead == ["dead"]
+    assert [d['url'] for d in deliveries] == ["https://discord/1"]
+    assert [n['message_id'] for n in notifications] == ["m1"]
+
+    # Its rows are ours now, its leases, slots and subscriptions are gone
+    rows = db.execute("SELECT shard FROM discord_delivery ORDER BY id").fetchall()
+    assert [r['shard'] for r in rows] == ["alive", "alive"]
+    assert db.execute("SELECT shard FROM eventsub_outbox").fetchone()['shard'] == "alive"
+    assert db.execute("SELECT COUNT(*) FROM subscriptions").fetchone()[0] == 0
+    assert acquire_leases(["1"], "alive", TTL) == ["1"]
+    assert claim_slot("alive", 1, TTL) == 0
+
+    # Only claimed once
+    assert claim_orphans("alive") == ([], [], [])
+
+
+def test_claim_orphans_unsharded_leftovers(db, clock, shard):
+    heartbeat_member("a", "host", TTL)
+    shard("")
+    commit_outbox([("m1", "stream.online", "{}")], [])
+
+    assert claim_orphans("a") == ([], [], [])
+    dead, deliveries, notifications = claim_orphans("a", unsharded=True)
+    assert dead == [] and deliveries == []
+    assert [n['message_id'] for n in notifications] == ["m1"]
+    assert claim_orphans("a", unsharded=True) == ([], [], [])
+
+
+def test_claim_orphans_never_claims_itself(db, clock):
+    heartbeat_member("a", "host", TTL)
+    clock.advance(TTL + 1)
+    assert claim_orphans("a") == ([], [], [])
+
+
+def test_hash_ring_moves_few_keys():
+    keys = [str(i) for i in range(2000)]
+    before = HashRing(["a", "b", "c"])
+    after = HashRing(["a", "b", "c", "d"])
+
+    moved = [k for k in keys if before.owner(k) != after.owner(k)]
+    assert all(after.owner(k) == "d" for k in moved)
+    assert len(moved) < len(keys) / 2
+    assert HashRing().owner("1") is None
+
+
+def test_on_tick_runs_without_the_lock(db):
+    """on_tick can stop the manager, which holds its own lock around take_slot()"""
+
+    coordinator = ShardCoordinator("a", SQLiteBackend())
+    coordinator.on_claim = lambda deliveries, notifications: None
+    locked = []
+
+    def on_tick():
+        free = coordinator._lock.acquire(blocking=False)
+        if free:
+            coordinator._lock.release()
+        locked.append(not free)
+
+    coordinator.on_tick = on_tick
+    coordinator.join()
+    coordinator.tick()
+    assert locked == [False]
@@ -0,0 +1,62 @@
+import json
+
+import pytest
+
+from discord.discordlib import MessageTemplate
+
+PAYLOAD = {
+    "content": "{name} is live!",
+    "embeds": [{"title": "{title}", "description": "Playing {game} {unknown}", "color": 1}],
+}
+FIELDS = ["name", "title", "game"]
+
+
+def render(**values):
+    return json.loads(MessageTemplate(PAYLOAD, FIELDS).render(**values))
+
+
+def test_plain_values_are_filled_in():
+    body = render(name="Azure", title="Hello", game="Chess")
+    assert body == {
+        "content": "Azure is live!",
+        "embeds": [{"title": "Hello", "description": "Playing Chess {unknown}", "color": 1}],
+    }
+
+
+@pytest.mark.parametrize("value", [
+    'say "hi"',
+    "back\\slash \\n \\u0041",
+    "two\nlines\tand\ttabs\r",
+    "emoji 🎮 and ünïcödé",
+    "\x00\x1f control",
+    "</script>",
+])
+def test_values_are_escaped(value):
+    body = render(name=value, title=value, game=value)
+    assert body["content"] == f"{value} is live!"
+    assert body["embeds"][0]["title"] == value
+    assert body["embeds"][0]["description"] == f"Playing {value} {{unknown}}"
+
+
+def test_values_are_not_expanded_again():
+    body = render(name="{title}", title="{game}", game="{name}")
+    assert body["content"] == "{title} is live!"
+    assert body["embeds"][0]["title"] == "{game}"
+    assert body["embeds"][0]["description"] == "Playing {name} {unknown}"
+
+
+def test_non_string_values_are_stringified():
+    body = render(name=42, title=None, game=1.5)
+    assert body["content"] == "42 is live!"
+    assert body["embeds"][0]["title"] == "None"
+    assert body["embeds"][0]["description"] == "Playing 1.5 {unknown}"
+
+
+def test_payload_text_is_kept_verbatim():
+    template = MessageTemplate({"content": 'a "quoted" {name}\n\\'}, ["name"])
+    assert json.loads(template.render(name="x")) == {"content": 'a "quoted" x\n\\'}
+
+
+def test_missing_field_raises():
+    with pytest.raises(KeyError):
+        MessageTemplate(PAYLOAD, FIELDS).render(name="Azure")
@@ -0,0 +1,145 @@
+import time
+
+import pytest
+
+from utils.threads import WorkQueue
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Freezes time.monotonic(), move it with clock.advance(secs)"""
+
+    class Clock:
+        now = 1000.0
+
+        def advance(self, secs: float):
+            self.now += secs
+
+    c = Clock()
+    monkeypatch.setattr(time, "monotonic", lambda: c.now)
+    return c
+
+
+@pytest.fixture
+def queue():
+    return WorkQueue()
+
+
+def drain(queue: WorkQueue):
+    """Pops and runs every ready job without waiting, returns what they returned"""
+
+    results = []
+    while (job := queue.pop(0)) is not None:
+        results.append(job())
+        queue.done(job)
+    return results
+
+
+def echo(value):
+    return value
+
+
+def test_lanes_run_by_priority_then_fifo(queue, clock):
+    queue.push(echo, "low", priority=queue.PRIORITY_LOW)
+    queue.push(echo, "normal-1")
+    queue.push(echo, "high", priority=queue.PRIORITY_HIGH)
+    queue.push(echo, "normal-2")
+
+    assert queue.depth() == [1, 2, 1]
+    assert drain(queue) == ["high", "normal-1", "normal-2", "low"]
+    assert queue.depth() == [0, 0, 0]
+
+
+def test_kwargs_are_passed_through(queue, clock):
+    queue.push(lambda a, b=0: a + b, 1, b=2)
+    assert drain(queue) == [3]
+
+
+def test_delayed_jobs_wait_for_their_time(queue, clock):
+    queue.push_later(2.0, echo, "later")
+    queue.push_later(1.0, echo, "sooner")
+    assert queue.scheduled() == 2
+    assert drain(queue) == []
+
+    clock.advance(1.0)
+    assert drain(queue) == ["sooner"]
+    clock.advance(1.0)
+    assert drain(queue) == ["later"]
+    assert queue.scheduled() == 0
+
+
+def test_due_timers_keep_their_priority(queue, clock):
+    queue.push(echo, "normal")
+    queue.push_later(1.0, echo, "high", priority=queue.PRIORITY_HIGH)
+    clock.advance(1.0)
+    assert drain(queue) == ["high", "normal"]
+
+
+def test_recurring_job_rearms_after_it_runs(queue, clock):
+    job = queue.push_every(5.0, echo, "tick")
+
+    clock.advance(5.0)
+    popped = queue.pop(0)
+    assert popped is job
+
+    # Still running: a late tick must not queue a second copy
+    clock.advance(20.0)
+    assert queue.pop(0) is None
+    assert queue.scheduled() == 0
+
+    popped()
+    queue.done(popped)
+    assert queue.scheduled() == 1
+
+    # Overran, so it reruns right away, then every interval again
+    assert drain(queue) == ["tick"]
+    clock.advance(4.9)
+    assert drain(queue) == []
+    clock.advance(0.1)
+    assert drain(queue) == ["tick"]
+
+
+def test_recurring_job_does_not_drift(queue, clock):
+    queue.push_every(5.0, echo, "tick")
+    clock.advance(6.0)
+    assert drain(queue) == ["tick"]
+
+    # Next run is 5s after the planned time, not after it actually ran
+    clock.advance(3.9)
+    assert drain(queue) == []
+    clock.advance(0.1)
+    assert drain(queue) == ["tick"]
+
+
+def test_cancelled_timer_never_runs(queue, clock):
+    job = queue.push_later(1.0, echo, "cancelled")
+    job.cancel()
+    clock.advance(1.0)
+    assert drain(queue) == []
+    assert queue.scheduled() == 0
+
+
+def test_cancelled_queued_job_is_skipped(queue, clock):
+    job = queue.push(echo, "cancelled")
+    queue.push(echo, "kept")
+    job.cancel()
+    assert drain(queue) == ["kept"]
+
+
+def test_recurring_job_cancelled_while_running_stops(queue, clock):
+    job = queue.push_every(1.0, echo, "tick")
+    clock.advance(1.0)
+    popped = queue.pop(0)
+    job.cancel()
+    queue.done(popped)
+
+    clock.advance(10.0)
+    assert drain(queue) == []
+    assert queue.scheduled() == 0
+
+
+def test_pop_times_out_when_empty():
+    queue = WorkQueue()
+    started = time.monotonic()
+    assert queue.pop(0.05) is None
+    assert time.monotonic() - started >= 0.05
@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+"""
+End-to-end benchmark: runs the real bot against tools/simulator.py
+Reports go-live throughput, p50/p99 go-live to webhook latency, CPU and memory
+Results can be saved as a JSON baseline, later runs fail if any of them regress
+
+    python -m tools.bench --channels 50 --rate 20 --duration 30
+    python -m tools.bench --save                    # record a baseline
+    python -m tools.bench --compare                 # fail if >25% worse
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import logging
+import argparse
+import tempfile
+import subprocess
+from pathlib import Path
+
+import requests
+
+from tools.simulator import Simulator
+
+# Constants
+REPO = Path(__file__).resolve().parent.parent
+EVENT_TYPES = 2  # subscriptions per broadcaster by default, see twitch/events.py
+DEFAULT_BASELINE = "tools/baselines/bench.json"
+DEFAULT_THRESHOLD = 0.25
+
+# Results compared against a baseline, and whether higher is better
+COMPARED = {"throughput": True, "p50": False, "p99": False, "cpu_util": False, "peak_rss_mb": False}
+PARAMETERS = ("channels", "rate", "duration", "workers", "runtime")
+
+
+def proc_usage(pid: int):
+    """CPU secs and current/peak RSS in MiB of a process, from /proc"""
+
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        cpu = (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+        mem = {}
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                if key in ("VmRSS", "VmHWM"):
+                    mem[key] = int(value.split()[0]) / 1024
+        return cpu, mem.get("VmRSS"), mem.get("VmHWM")
+    except (OSError, IndexError, ValueError):
+        return None, None, None
+
+
+def start_bot(sim: Simulator, args, workdir: str):
+    """Launches twitchbot:main under waitress, pointed at the simulator"""
+
+    hooks = f"{sim.base_url}/api/webhooks"
+    env = dict(
+        os.environ,
+        DEBUG="1",
+        PYTHONPATH=str(REPO),
+        TWITCH_WS=f"ws://127.0.0.1:{sim.ws_port}/ws",
+        TWITCH_HELIX=f"{sim.base_url}/mock",
+        TWITCH_AUTH=f"{sim.base_url}/auth",
+        TWITCH_EVENTSUB=sim.base_url,
+        DISCORD_WEBHOOK_BASE=hooks,
+        CONFIG__HOSTNAME=f"http://127.0.0.1:{args.bot_port}",
+        CONFIG__WORKERS=str(args.workers),
+        CONFIG__RUNTIME=args.runtime,
+        CONFIG__DISCORD__WEBHOOK=f"{hooks}/1/golive",
+        CONFIG__DISCORD__STATUS=f"{hooks}/2/status",
+        CONFIG__TWITCH__CLIENTID="simulator",
+        CONFIG__TWITCH__SECRET="simulator",
+        CONFIG__TWITCH__BROADCASTERS=",".join(c.login for c in sim.channels[1:]),
+    )
+    return subprocess.Popen(
+        [sys.executable, "-m", "waitress", f"--port={args.bot_port}", "--call", "twitchbot:main"],
+        cwd=workdir, env=env,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+
+
+def wait_for(check, timeout: float, what: str):
+    """Polls until check() is truthy"""
+
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if check():
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    raise TimeoutError(f"Timed out waiting for {what}")
+
+
+def run(args):
+    """Runs one benchmark, returns its results"""
+
+    sim = Simulator(args.channels, args.http_port, args.ws_port)
+    sim.start()
+    workdir = tempfile.mkdtemp(prefix="twitchbot-bench-")
+    bot = start_bot(sim, args, workdir)
+    bot_url = f"http://127.0.0.1:{args.bot_port}"
+
+    try:
+        # Log in and wait for every channel to be subscribed
+        started = time.monotonic()
+        wait_for(lambda: requests.get(f"{bot_url}/metrics", timeout=1).ok, 30, "the bot to start")
+        startup = time.monotonic() - started
+        requests.get(f"{bot_url}/debug-get-token", allow_redirects=False, timeout=10)
+        wait_for(lambda: sim.subscriptions >= args.channels * EVENT_TYPES, 60, "subscriptions")
+
+        # Warm up caches and connections, then measure
+        sim.fire(min(args.rate, 10), 1)
+        sim.wait_drained(10)
+        sim.reset()
+
+        cpu_before, _, _ = proc_usage(bot.pid)
+        fired = time.monotonic()
+        sim.fire(args.rate, args.duration)
+        drained = sim.wait_drained(args.drain)
+        elapsed = time.monotonic() - fired
+        cpu_after, rss, peak = proc_usage(bot.pid)
+
+        results = dict(sim.stats())
+        results.update({
+            "channels": args.channels,
+            "rate": args.rate,
+            "duration": args.duration,
+            "workers": args.workers,
+            "runtime": args.runtime,
+            "drained": drained,
+            "startup": startup,
+            "cpu": cpu_after - cpu_before if cpu_after is not None else None,
+            "cpu_util": (cpu_after - cpu_before) / elapsed if cpu_after is not None else None,
+            "rss_mb": rss,
+            "peak_rss_mb": peak,
+        })
+        return results
+
+    finally:
+        bot.terminate()
+        try:
+            bot.wait(10)
+        except subprocess.TimeoutExpired:
+            bot.kill()
+        sim.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def report(results: dict):
+    """Prints results as a table"""
+
+    def fmt(value, unit="", scale=1):
+        if value is None:
+            return "n/a"
+        if isinstance(value, float):
+            return f"{value * scale:.2f}{unit}"
+        return f"{value}{unit}"
+
+    rows = [
+        ("go-lives sent / delivered", f"{results['sent']} / {results['delivered']}"),
+        ("throughput", fmt(results["throughput"], "/s")),
+        ("latency p50", fmt(results["p50"], "ms", 1000)),
+        ("latency p99", fmt(results["p99"], "ms", 1000)),
+        ("latency max", fmt(results["max"], "ms", 1000)),
+        ("startup", fmt(results["startup"], "s")),
+        ("cpu", f"{fmt(results['cpu'], 's')} ({fmt(results['cpu_util'], '%', 100)})"),
+        ("rss / peak", f"{fmt(results['rss_mb'], 'MiB')} / {fmt(results['peak_rss_mb'], 'MiB')}"),
+    ]
+    width = max(len(name) for name, _ in rows)
+    for name, value in rows:
+        print(f"{name:<{width}}  {value}")
+
+
+def compare(results: dict, baseline: dict, threshold: float):
+    """Prints each compared result against the baseline, returns names that regressed"""
+
+    old_results = baseline.get("results", {})
+    changed = [name for name in PARAMETERS if old_results.get(name) != results[name]]
+    if changed:
+        print(f"\nWARNING: baseline ran with different {', '.join(changed)}, comparing anyway")
+
+    regressed = []
+    print()
+    for name, higher_is_better in COMPARED.items():
+        new, old = results.get(name), old_results.get(name)
+        if not new or not old:
+            print(f"{name:<24} {'n/a':>10}")
+            continue
+
+        change = new / old - 1
+        worse = -change if higher_is_better else change
+        flag = ""
+        if worse > threshold:
+            regressed.append(name)
+            flag = "  REGRESSED"
+        print(f"{name:<24} {change:>+10.1%}{flag}")
+    return regressed
+
+
+def main():
+    """CLI Entrypoint"""
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--channels", type=int, default=50, help="fake broadcasters, at most 450")
+    parser.add_argument("--rate", type=float, default=20, help="go-lives per sec")
+    parser.add_argument("--duration", type=float, default=30, help="secs to fire go-lives for")
+    parser.add_argument("--drain", type=float, default=60, help="secs to wait for stragglers")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--runtime", choices=["threads", "async"], default="threads")
+    parser.add_argument("--http-port", type=int, default=18080)
+    parser.add_argument("--ws-port", type=int, default=18081)
+    parser.add_argument("--bot-port", type=int, default=18090)
+    parser.add_argument("--output", help="also write results to this JSON file")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE, help="baseline JSON file")
+    parser.add_argument("--save", action="store_true", help="write results as the new baseline")
+    parser.add_argument("--compare", action="store_true", help="fail if worse than the baseline")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD, help="allowed regression, 0.25 = 25%%")
+    args = parser.parse_args()
+
+    if args.compare and not os.path.exists(args.baseline):
+        print(f"No baseline at {args.baseline}, run with --save first")
+        return 2
+
+    logging.basicConfig(level=logging.WARNING)
+    results = run(args)
+    report(results)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=4)
+
+    status = 0 if results["drained"] else 1
+    if args.compare:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressed = compare(results, baseline, args.threshold)
+        if regressed:
+            print(f"\n{len(regressed)} result(s) regressed past {args.threshold:.0%}: {', '.join(regressed)}")
+            status = 1
+
+    if args.save:
+        if not results["drained"]:
+            print("\nNot saving a baseline, some go-lives never arrived")
+            return status
+        os.makedirs(os.path.dirname(args.baseline) or ".", exist_ok=True)
+        with open(args.baseline, "w") as f:
+            json.dump({
+                "python": sys.version.split()[0],
+                "machine": platform.platform(),
+                "created": time.time(),
+                "results": results,
+            }, f, indent=4)
+        print(f"\nSaved baseline to {args.baseline}")
+
+    return status
+
+
+if __name__ == "__main__":
+    exit(main())
@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmarks for the bot's hot paths
+Results are saved as a JSON baseline, later runs fail if any path regresses
+
+    python -m tools.microbench --save               # record a baseline
+    python -m tools.microbench --compare            # fail if >25% slower
+    python -m tools.microbench -k queue -k db       # only some benchmarks
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import threading
+import statistics
+from typing import Callable, Dict
+
+# Constants
+DEFAULT_BASELINE = "tools/baselines/microbench.json"
+DEFAULT_THRESHOLD = 0.25
+TARGET_SECS = 0.2
+REPEATS = 5
+
+FRAME = json.dumps({
+    "metadata": {
+        "message_id": "befa7b53-d79d-478f-86b9-120f112b044e",
+        "message_type": "notification",
+        "message_timestamp": "2022-11-16T10:11:12.464757833Z",
+        "subscription_type": "stream.online",
+        "subscription_version": "1"
+    },
+    "payload": {
+        "subscription": {
+            "id": "f1c2a387-161a-49f9-a165-0f21d7a4e1c4",
+            "status": "enabled",
+            "type": "stream.online",
+            "version": "1",
+            "cost": 0,
+            "condition": {"broadcaster_user_id": "12826"},
+            "transport": {"method": "websocket", "session_id": "AQoQexAWVYKSTIu4ec_2VAxyuhAB"},
+            "created_at": "2022-11-16T10:11:12.464757833Z"
+        },
+        "event": {
+            "id": "9001",
+            "broadcaster_user_id": "12826",
+            "broadcaster_user_login": "twitch",
+            "broadcaster_user_name": "Twitch",
+            "type": "live",
+            "started_at": "2022-11-16T10:11:12.464757833Z"
+        }
+    }
+})
+
+# name -> setup returning the callable to time, registered with @bench
+BENCHMARKS: Dict[str, Callable[[], Callable[[], None]]] = {}
+
+
+def bench(name: str):
+    """Registers a benchmark's setup function"""
+
+    def decorator(setup):
+        BENCHMARKS[name] = setup
+        return setup
+    return decorator
+
+
+#
+# Benchmarks
+#
+
+@bench("queue.push_pop")
+def bench_queue_push_pop():
+    """WorkQueue push then pop, same thread"""
+    from utils.threads import WorkQueue
+
+    queue = WorkQueue()
+    noop = lambda: None  # noqa: E731
+
+    def run():
+        queue.push(noop)
+        queue.pop()
+    return run
+
+
+@bench("queue.handoff")
+def bench_queue_handoff():
+    """WorkQueue push to a waiting worker and back, cross thread"""
+    from utils.threads import WorkQueue
+
+    queue = WorkQueue()
+    done = threading.Semaphore(0)
+
+    def worker():
+        while True:
+            queue.pop()()
+    threading.Thread(target=worker, daemon=True).start()
+
+    def run():
+        queue.push(done.release)
+        done.acquire()
+    return run
+
+
+@bench("db.get_token")
+def bench_db_get_token():
+    """Token read, served from the in-memory cache"""
+    import utils.db as db
+
+    db.init_db(os.path.join(tempfile.mkdtemp(), "bench.db"))
+    db.set_token({"access_token": "a", "expires_in": 3600, "refresh_token": "r"})
+    return db.get_token
+
+
+@bench("db.get_token_uncached")
+def bench_db_get_token_uncached():
+    """Token read, straight from SQLite"""
+    import utils.db as db
+
+    db.init_db(os.path.join(tempfile.mkdtemp(), "bench.db"))
+    db.set_token({"access_token": "a", "expires_in": 3600, "refresh_token": "r"})
+
+    def run():
+        db.token_cache = db._UNLOADED
+        db.get_token()
+    return run
+
+
+@bench("discord.to_dict")
+def bench_discord_to_dict():
+    """DiscordMessage with one embed to a dict"""
+    from discord.discordlib import DiscordMessage, DiscordEmbed
+
+    message = DiscordMessage(
+        content="**Twitch** is now live on Twitch!",
+        embeds=[DiscordEmbed(
+            title="Some stream", description="Playing: Celeste",
+            image="https://example.com/a.jpg", footer="footer",
+            url="https://twitch.tv/twitch", color=0x6441a5
+        )],
+        flags=DiscordMessage.Flags.ALLOW_MENTION_ROLE
+    )
+    return message.to_dict
+
+
+@bench("discord.from_dict")
+def bench_discord_from_dict():
+    """DiscordMessage with one embed from a dict"""
+    from discord.discordlib import DiscordMessage, DiscordEmbed
+
+    data = DiscordMessage(
+        content="**Twitch** is now live on Twitch!",
+        embeds=[DiscordEmbed(title="Some stream", description="Playing: Celeste", color=0x6441a5)],
+        id="1"
+    ).to_dict()
+    return lambda: DiscordMessage.from_dict(data)
+
+
+@bench("discord.render")
+def bench_discord_render():
+    """Go-live template render, what the handler actually sends"""
+    from discord.routing import Destination
+
+    template = Destination("https://discord.com/api/webhooks/1/bench").template("Twitch", "twitch")
+    return lambda: template.render(title="Some stream", game="Celeste", thumbnail="https://example.com/a.jpg")
+
+
+@bench("eventsub.decode")
+def bench_eventsub_decode():
+    """EventSub notification frame to its event dict"""
+    from twitch.envelope import decode_envelope
+
+    return lambda: decode_envelope(FRAME).event
+
+
+@bench("config.get_value")
+def bench_config_get_value():
+    """Nested config key lookup, falling through env to the file"""
+    from utils.config import Config
+
+    # Skip the constructor, it exits on missing mandatory keys
+    config = Config.__new__(Config)
+    data = {"twitch": {"clientid": "abc"}}
+    return lambda: config.get_value(data, "twitch.clientid", "")
+
+
+#
+# Runner
+#
+
+def measure(run: Callable[[], None]):
+    """Returns best and median ns per call over several timed repeats"""
+
+    # Calibrate loops so each repeat takes about TARGET_SECS
+    loops = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(loops):
+            run()
+        elapsed = time.perf_counter() - start
+        if elapsed >= TARGET_SECS / 10:
+            break
+        loops *= 10
+    loops = max(1, int(loops * TARGET_SECS / elapsed))
+
+    timings = []
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        for _ in range(loops):
+            run()
+        timings.append((time.perf_counter() - start) / loops * 1e9)
+
+    return {"best_ns": min(timings), "median_ns": statistics.median(timings), "loops": loops}
+
+
+def run_all(patterns):
+    """Runs every benchmark whose name contains one of the patterns"""
+
+    results = {}
+    for name, setup in BENCHMARKS.items():
+        if patterns and not any(p in name for p in patterns):
+            continue
+        results[name] = measure(setup())
+        print(f"{name:<24} {results[name]['best_ns']:>10.0f} ns/op")
+    return results
+
+
+def compare(results: dict, baseline: dict, threshold: float):
+    """Prints each benchmark against the baseline, returns names that regressed"""
+
+    regressed = []
+    print()
+    for name, result in results.items():
+        old = baseline.get("results", {}).get(name)
+        if old is None:
+            print(f"{name:<24} {'(new)':>10}")
+            continue
+
+        change = result["best_ns"] / old["best_ns"] - 1
+        flag = ""
+        if change > threshold:
+            regressed.append(name)
+            flag = "  REGRESSED"
+        print(f"{name:<24} {change:>+10.1%}{flag}")
+    return regressed
+
+
+def main():
+    """CLI Entrypoint"""
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-k", dest="patterns", action="append", default=[], help="only run matching benchmarks")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE, help="baseline JSON file")
+    parser.add_argument("--save", action="store_true", help="write results as the new baseline")
+    parser.add_argument("--compare", action="store_true", help="fail if slower than the baseline")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD, help="allowed slowdown, 0.25 = 25%%")
+    args = parser.parse_args()
+
+    results = run_all(args.patterns)
+
+    status = 0
+    if args.compare:
+        if not os.path.exists(args.baseline):
+            print(f"No baseline at {args.baseline}, run with --save first")
+            return 2
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressed = compare(results, baseline, args.threshold)
+        if regressed:
+            print(f"\n{len(regressed)} benchmark(s) regressed past {args.threshold:.0%}: {', '.join(regressed)}")
+            status = 1
+
+    if args.save:
+        os.makedirs(os.path.dirname(args.baseline) or ".", exist_ok=True)
+        with open(args.baseline, "w") as f:
+            json.dump({
+                "python": sys.version.split()[0],
+                "machine": platform.platform(),
+                "created": time.time(),
+                "results": results,
+            }, f, indent=4)
+        print(f"\nSaved baseline to {args.baseline}")
+
+    return status
+
+
+if __name__ == "__main__":
+    exit(main())
@@ -0,0 +1,547 @@
+#!/usr/bin/env python3
+"""
+Offline stand-in for Twitch and Discord
+- EventSub WebSocket, with welcome, keepalive and notification frames
+- EventSub subscription REST, Helix users/streams and OAuth
+- A Discord webhook sink that times each go-live post
+
+Run the bot in DEBUG mode against it:
+
+    python -m tools.simulator --channels 50
+    DEBUG=1 TWITCH_EVENTSUB=http://127.0.0.1:8080 \\
+    DISCORD_WEBHOOK_BASE=http://127.0.0.1:8080/api/webhooks \\
+    CONFIG__DISCORD__WEBHOOK=http://127.0.0.1:8080/api/webhooks/1/golive \\
+    waitress-serve --port 8090 --call twitchbot:main
+"""
+
+import json
+import time
+import uuid
+import random
+import logging
+import argparse
+import threading
+import urllib.parse
+from collections import deque
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Deque, Dict, List, Tuple
+
+from websockets.sync.server import serve
+from websockets.exceptions import ConnectionClosed
+
+# Constants
+DEFAULT_HTTP_PORT = 8080
+DEFAULT_WS_PORT = 8081
+USER_ID_BASE = 1000
+GAMES = ["Just Chatting", "Minecraft", "Celeste", "Tetris Effect", "Outer Wilds"]
+
+
+def timestamp(at: float = None):
+    """RFC3339 timestamp, as Twitch formats them"""
+
+    at = time.time() if at is None else at
+    return datetime.fromtimestamp(at, timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+
+def percentile(values: List[float], q: float):
+    """Nearest-rank percentile, q in [0, 1]"""
+
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+class Channel:
+    """A fake broadcaster"""
+
+    __slots__ = ("id", "login", "name", "stream_id", "title", "game", "started_at")
+
+    def __init__(self, index: int):
+        self.id = str(USER_ID_BASE + index)
+        self.login = f"channel{index}"
+        self.name = f"Channel{index}"
+        self.stream_id = None
+        self.title = ""
+        self.game = ""
+        self.started_at = None
+
+    def user(self):
+        """Helix user object"""
+
+        return {
+            "id": self.id,
+            "login": self.login,
+            "display_name": self.name,
+            "type": "",
+            "broadcaster_type": "affiliate",
+            "description": "",
+            "profile_image_url": "",
+            "offline_image_url": "",
+            "created_at": timestamp(0),
+        }
+
+    def stream(self):
+        """Helix stream object"""
+
+        return {
+            "id": self.stream_id,
+            "user_id": self.id,
+            "user_login": self.login,
+            "user_name": self.name,
+            "game_id": "0",
+            "game_name": self.game,
+            "type": "live",
+            "title": self.title,
+            "viewer_count": random.randint(0, 1000),
+            "started_at": timestamp(self.started_at),
+            "language": "en",
+            "thumbnail_url": (
+                f"https://static-cdn.jtvnw.net/previews-ttv/live_user_{self.login}-{{width}}x{{height}}.jpg"
+            ),
+            "tags": [],
+            "is_mature": False,
+        }
+
+
+class Socket:
+    """One connected EventSub WebSocket"""
+
+    def __init__(self, ws, session_id: str):
+        self.ws = ws
+        self.session_id = session_id
+        self.lock = threading.Lock()
+
+    def send(self, message_type: str, payload: dict, subscription_type: str = None):
+        """Sends a frame, returns False if the socket is gone"""
+
+        metadata = {
+            "message_id": str(uuid.uuid4()),
+            "message_type": message_type,
+            "message_timestamp": timestamp(),
+        }
+        if subscription_type is not None:
+            metadata["subscription_type"] = subscription_type
+            metadata["subscription_version"] = payload["subscription"]["version"]
+
+        try:
+            with self.lock:
+                self.ws.send(json.dumps({"metadata": metadata, "payload": payload}))
+            return True
+        except ConnectionClosed:
+            return False
+
+
+class Simulator:
+    """
+    Fakes enough of Twitch and Discord to run the bot end to end
+    Go-live posts reaching the sink are matched to the event that caused them
+    """
+
+    def __init__(
+            self,
+            channels: int = 50,
+            http_port: int = DEFAULT_HTTP_PORT,
+            ws_port: int = DEFAULT_WS_PORT,
+            keepalive: int = 10,
+            discord_delay: float = 0.0
+            ):
+        """Constructor"""
+
+        self.channels = [Channel(i) for i in range(channels)]
+        self.by_id = {c.id: c for c in self.channels}
+        self.by_login = {c.login: c for c in self.channels}
+        self.http_port = http_port
+        self.ws_port = ws_port
+        self.keepalive = keepalive
+        self.discord_delay = discord_delay
+
+        self._lock = threading.Lock()
+        self._sockets: Dict[str, Socket] = {}
+        self._subs: Dict[str, Tuple[str, str, str]] = {}  # sub id -> (session, type, broadcaster)
+        self._routes: Dict[Tuple[str, str], Tuple[str, dict]] = {}  # (type, broadcaster) -> (session, sub)
+        self._pending: Dict[str, Deque[float]] = {}  # login -> go-live send times
+        self._http = None
+        self._ws = None
+
+        # Metrics
+        self.sent = 0
+        self.delivered = 0
+        self.status_posts = 0
+        self.latencies: List[float] = []
+        self.first_sent = None
+        self.last_delivered = None
+
+    #
+    # Lifecycle
+    #
+
+    def start(self):
+        """Starts the HTTP and WebSocket servers on background threads"""
+
+        self._http = ThreadingHTTPServer(("127.0.0.1", self.http_port), make_handler(self))
+        self._http.daemon_threads = True
+        self._ws = serve(self.handle_ws, "127.0.0.1", self.ws_port, compression=None)
+        threading.Thread(target=self._http.serve_forever, name="Sim-HTTP", daemon=True).start()
+        threading.Thread(target=self._ws.serve_forever, name="Sim-WS", daemon=True).start()
+        logging.info(f"Simulating Twitch on :{self.http_port} and :{self.ws_port}")
+
+    def stop(self):
+        """Stops both servers"""
+
+        if self._http is not None:
+            self._http.shutdown()
+        if self._ws is not None:
+            self._ws.shutdown()
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.http_port}"
+
+    @property
+    def subscriptions(self):
+        with self._lock:
+            return len(self._subs)
+
+    #
+    # EventSub
+    #
+
+    def handle_ws(self, ws):
+        """Runs one EventSub socket until the client leaves"""
+
+        socket = Socket(ws, str(uuid.uuid4()))
+        with self._lock:
+            self._sockets[socket.session_id] = socket
+        socket.send("session_welcome", {"session": {
+            "id": socket.session_id,
+            "status": "connected",
+            "keepalive_timeout_seconds": self.keepalive,
+            "reconnect_url": None,
+            "connected_at": timestamp(),
+        }})
+
+        # Clients never send anything, recv just waits for them to go
+        try:
+            while True:
+                try:
+                    ws.recv(self.keepalive * 0.8)
+                except TimeoutError:
+                    socket.send("session_keepalive", {})
+        except ConnectionClosed:
+            pass
+        finally:
+            self._drop_session(socket.session_id)
+
+    def _drop_session(self, session_id: str):
+        """Twitch deletes a socket's subscriptions when it closes"""
+
+        with self._lock:
+            self._sockets.pop(session_id, None)
+            for sub_id, (session, kind, broadcaster_id) in list(self._subs.items()):
+                if session == session_id:
+                    del self._subs[sub_id]
+                    self._routes.pop((kind, broadcaster_id), None)
+
+    def subscribe(self, body: dict):
+        """Creates a subscription, returns the Helix response or None"""
+
+        session_id = body.get("transport", {}).get("session_id")
+        condition = body.get("condition", {})
+        broadcaster_id = next(iter(condition.values()), None)
+        with self._lock:
+            if session_id not in self._sockets:
+                return None
+
+            sub = {
+                "id": str(uuid.uuid4()),
+                "status": "enabled",
+                "type": body["type"],
+                "version": body.get("version", "1"),
+                "condition": condition,
+                "created_at": timestamp(),
+                "transport": {"method": "websocket", "session_id": session_id},
+                "cost": 0,
+            }
+            self._subs[sub["id"]] = (session_id, body["type"], broadcaster_id)
+            self._routes[(body["type"], broadcaster_id)] = (session_id, sub)
+            total = len(self._subs)
+
+        return {"data": [sub], "total": total, "total_cost": 0, "max_total_cost": 10000}
+
+    def unsubscribe(self, sub_id: str):
+        """Deletes a subscription, returns whether it existed"""
+
+        with self._lock:
+            found = self._subs.pop(sub_id, None)
+            if found is not None:
+                self._routes.pop((found[1], found[2]), None)
+            return found is not None
+
+    def notify(self, kind: str, channel: Channel, event: dict):
+        """Sends a notification to whichever socket subscribed to it"""
+
+        with self._lock:
+            session_id, sub = self._routes.get((kind, channel.id), (None, None))
+            socket = self._sockets.get(session_id)
+        if socket is None:
+            return False
+        return socket.send("notification", {"subscription": sub, "event": event}, kind)
+
+    def go_live(self, channel: Channel):
+        """Takes a channel offline if needed, then live with a new stream"""
+
+        if channel.stream_id is not None:
+            self.go_offline(channel)
+
+        channel.stream_id = str(random.randint(10 ** 10, 10 ** 11))
+        channel.title = f"Stream {channel.stream_id}"
+        channel.game = random.choice(GAMES)
+        channel.started_at = time.time()
+
+        sent_at = time.time()
+        with self._lock:
+            self._pending.setdefault(channel.login, deque()).append(sent_at)
+        ok = self.notify("stream.online", channel, {
+            "id": channel.stream_id,
+            "broadcaster_user_id": channel.id,
+            "broadcaster_user_login": channel.login,
+            "broadcaster_user_name": channel.name,
+            "type": "live",
+            "started_at": timestamp(channel.started_at),
+        })
+
+        with self._lock:
+            if ok:
+                self.sent += 1
+                if self.first_sent is None:
+                    self.first_sent = sent_at
+            else:
+                self._pending[channel.login].pop()
+        return ok
+
+    def go_offline(self, channel: Channel):
+        """Ends a channel's stream"""
+
+        channel.stream_id = None
+        return self.notify("stream.offline", channel, {
+            "broadcaster_user_id": channel.id,
+            "broadcaster_user_login": channel.login,
+            "broadcaster_user_name": channel.name,
+        })
+
+    def fire(self, rate: float, duration: float):
+        """
+        Sends go-live events at 'rate' per sec for 'duration' secs
+        Channels take turns, returns how many were sent
+        """
+
+        count = int(rate * duration)
+        start = time.monotonic()
+        sent = 0
+        for i in range(count):
+            delay = start + i / rate - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            sent += self.go_live(self.channels[i % len(self.channels)])
+        return sent
+
+    #
+    # Discord
+    #
+
+    def on_webhook(self, body: dict):
+        """Records a webhook post, matching go-lives to their events"""
+
+        now = time.time()
+        embeds = body.get("embeds") or [{}]
+        login = embeds[0].get("url", "").rsplit("/", 1)[-1]
+        with self._lock:
+            pending = self._pending.get(login)
+            if not pending:
+                self.status_posts += 1
+                return
+            self.latencies.append(now - pending.popleft())
+            self.delivered += 1
+            self.last_delivered = now
+
+    def wait_drained(self, timeout: float):
+        """Waits for every sent go-live to reach the sink, returns success"""
+
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            with self._lock:
+                if self.delivered >= self.sent:
+                    return True
+            time.sleep(0.05)
+        return False
+
+    def reset(self):
+        """Clears delivery metrics"""
+
+        with self._lock:
+            self.sent = self.delivered = 0
+            self.latencies = []
+            self.first_sent = self.last_delivered = None
+            self._pending.clear()
+
+    def stats(self):
+        """Throughput and latency of go-lives so far"""
+
+        with self._lock:
+            latencies = list(self.latencies)
+            elapsed = (self.last_delivered or 0) - (self.first_sent or 0)
+            return {
+                "sent": self.sent,
+                "delivered": self.delivered,
+                "throughput": self.delivered / elapsed if elapsed > 0 else None,
+                "p50": percentile(latencies, 0.50),
+                "p99": percentile(latencies, 0.99),
+                "max": max(latencies) if latencies else None,
+            }
+
+    #
+    # Helix
+    #
+
+    def users(self, query: Dict[str, List[str]]):
+        """Helix /users, no filters means the logged-in user"""
+
+        if "id" not in query and "login" not in query:
+            return [self.channels[0].user()]
+        found = [self.by_id[i] for i in query.get("id", []) if i in self.by_id]
+        found += [self.by_login[l.lower()] for l in query.get("login", []) if l.lower() in self.by_login]
+        return [c.user() for c in found]
+
+    def streams(self, query: Dict[str, List[str]]):
+        """Helix /streams, only channels that are live"""
+
+        found = [self.by_id[i] for i in query.get("user_id", []) if i in self.by_id]
+        return [c.stream() for c in found if c.stream_id is not None]
+
+
+def make_handler(sim: Simulator):
+    """Builds the HTTP request handler bound to a simulator"""
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True
+        wbufsize = -1  # headers and body go out in one write
+
+        def log_message(self, format, *args):
+            logging.debug(format % args)
+
+        def reply(self, status: int, body=None, headers: dict = None):
+            data = json.dumps(body).encode() if body is not None else b""
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            for key, value in (headers or {}).items():
+                self.send_header(key, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def body(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            raw = self.rfile.read(length) if length else b""
+            try:
+                return json.loads(raw) if raw else {}
+            except ValueError:
+                return dict(urllib.parse.parse_qsl(raw.decode()))
+
+        def route(self):
+            url = urllib.parse.urlsplit(self.path)
+            return url.path.rstrip("/"), urllib.parse.parse_qs(url.query)
+
+        def do_GET(self):
+            path, query = self.route()
+            limits = {
+                "Ratelimit-Limit": "800",
+                "Ratelimit-Remaining": "799",
+                "Ratelimit-Reset": str(int(time.time()) + 60),
+            }
+            if path == "/mock/users":
+                return self.reply(200, {"data": sim.users(query)}, limits)
+            if path == "/mock/streams":
+                return self.reply(200, {"data": sim.streams(query), "pagination": {}}, limits)
+            if path == "/auth/validate":
+                channel = sim.channels[0]
+                return self.reply(200, {
+                    "client_id": "simulator",
+                    "login": channel.login,
+                    "user_id": channel.id,
+                    "scopes": [],
+                    "expires_in": 3600,
+                })
+            return self.reply(404, {"error": "Not Found"})
+
+        def do_POST(self):
+            path, _ = self.route()
+            body = self.body()
+            if path in ("/auth/authorize", "/auth/token"):
+                return self.reply(200, {
+                    "access_token": uuid.uuid4().hex,
+                    "refresh_token": uuid.uuid4().hex,
+                    "expires_in": 3600,
+                    "scope": [],
+                    "token_type": "bearer",
+                })
+            if path == "/eventsub/subscriptions":
+                res = sim.subscribe(body)
+                if res is None:
+                    return self.reply(400, {"error": "Bad Request", "message": "unknown session"})
+                return self.reply(202, res)
+            if path.startswith("/api/webhooks/"):
+                if sim.discord_delay:
+                    time.sleep(sim.discord_delay)
+                sim.on_webhook(body)
+                return self.reply(200, dict(body, id=str(uuid.uuid4().int >> 64)), {
+                    "X-RateLimit-Limit": "5",
+                    "X-RateLimit-Remaining": "4",
+                    "X-RateLimit-Reset-After": "0.4",
+                })
+            return self.reply(404, {"error": "Not Found"})
+
+        def do_DELETE(self):
+            path, query = self.route()
+            if path == "/eventsub/subscriptions":
+                found = sim.unsubscribe(query.get("id", [""])[0])
+                return self.reply(204 if found else 404)
+            return self.reply(404, {"error": "Not Found"})
+
+    return Handler
+
+
+def main():
+    """Runs the simulator standalone, optionally firing go-lives"""
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--channels", type=int, default=50, help="number of fake broadcasters")
+    parser.add_argument("--http-port", type=int, default=DEFAULT_HTTP_PORT)
+    parser.add_argument("--ws-port", type=int, default=DEFAULT_WS_PORT)
+    parser.add_argument("--rate", type=float, default=0, help="go-lives per sec, once subscribed")
+    parser.add_argument("--duration", type=float, default=10, help="secs to fire go-lives for")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)-15s | %(message)s")
+    sim = Simulator(args.channels, args.http_port, args.ws_port)
+    sim.start()
+
+    try:
+        if args.rate > 0:
+            logging.info("Waiting for the bot to subscribe...")
+            while sim.subscriptions == 0:
+                time.sleep(0.5)
+            time.sleep(2)
+            logging.info(f"Sent {sim.fire(args.rate, args.duration)} go-lives")
+            sim.wait_drained(30)
+            logging.info(json.dumps(sim.stats()))
+        while True:
+            time.sleep(60)
+    except KeyboardInterrupt:
+        sim.stop()
+
+
+if __name__ == "__main__":
+    exit(main())
@@ -0,0 +1,84 @@
+import logging
+import threading
+from typing import Callable, Dict, List, Optional
+
+from utils.threads import queue, Job
+
+
+class LookupBatcher:
+    """
+    Coalesces single-ID lookups made close together into one Helix request
+    - Lookups never block, they're queued from the receive path
+    - The first one schedules a flush `window` secs later, a full batch goes right away
+    - One request at a time, whatever queues up meanwhile goes in the next
+    - Each callback gets only its own result, or None, on a worker
+    """
+
+    def __init__(
+            self,
+            fetch: Callable[[List[str]], Optional[List[dict]]],
+            key: str,
+            window: float = 0.01,
+            size: int = 100
+            ):
+        """Constructor"""
+
+        self.fetch = fetch
+        self.key = key
+        self.window = window
+        self.size = size
+        self._pending: Dict[str, List[Callable]] = {}
+        self._flush: Job = None
+        self._inflight = False
+        self._lock = threading.Lock()
+
+        # Metrics
+        self.lookups = 0
+        self.batches = 0
+
+    def submit(self, item_id: str, callback: Callable[[Optional[dict]], None]):
+        """Queues a lookup, its callback is pushed to the workers with the result"""
+
+        with self._lock:
+            self.lookups += 1
+            self._pending.setdefault(item_id, []).append(callback)
+
+            # A request's in flight, it sends whatever's queued once done
+            if self._inflight:
+                return
+
+            if len(self._pending) >= self.size:
+                if self._flush is not None:
+                    self._flush.cancel()
+                self._flush = queue.push(self.flush, priority=queue.PRIORITY_HIGH)
+            elif self._flush is None:
+                self._flush = queue.push_later(self.window, self.flush, priority=queue.PRIORITY_HIGH)
+
+    def flush(self):
+        """Sends everything queued so far, then fans out the results"""
+
+        with self._lock:
+            if self._inflight:
+                return
+            self._flush = None
+            batch, self._pending = self._pending, {}
+            if len(batch) == 0:
+                return
+            self._inflight = True
+
+        self.batches += 1
+        try:
+            results = self.fetch(list(batch.keys()))
+        except Exception:
+            logging.exception("Batched lookup raised!")
+            results = None
+        finally:
+            with self._lock:
+                self._inflight = False
+                if self._pending and self._flush is None:
+                    self._flush = queue.push(self.flush, priority=queue.PRIORITY_HIGH)
+
+        found = {r[self.key]: r for r in results or []}
+        for item_id, callbacks in batch.items():
+            for callback in callbacks:
+                queue.push(callback, found.get(item_id), priority=queue.PRIORITY_HIGH)
@@ -0,0 +1,88 @@
+import time
+import threading
+from collections import OrderedDict
+from typing import Hashable
+
+
+class CacheEntry:
+    """A cached response, with its ETag and expiry"""
+
+    __slots__ = ("value", "etag", "expires")
+
+    def __init__(self, value, etag: str, expires: float):
+        self.value = value
+        self.etag = etag
+        self.expires = expires
+
+    def fresh(self, now: float):
+        return now < self.expires
+
+
+class TTLCache:
+    """
+    Thread-safe LRU cache whose entries expire after a TTL
+    Expired entries are kept until evicted, so their ETag can revalidate them
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 60.0):
+        """Constructor"""
+
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[Hashable, CacheEntry]" = OrderedDict()
+        self._lock = threading.Lock()
+
+        # Metrics
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+
+    def get(self, key: Hashable):
+        """
+        Returns the entry for a key, fresh or not, or None
+        Only fresh entries count as hits
+        """
+
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self._data.move_to_end(key)
+            if entry.fresh(time.monotonic()):
+                self.hits += 1
+            else:
+                self.misses += 1
+            return entry
+
+    def set(self, key: Hashable, value, etag: str = None, ttl: float = None):
+        """Stores a value, evicting the least recently used if full"""
+
+        expires = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = CacheEntry(value, etag, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def touch(self, key: Hashable, ttl: float = None):
+        """Marks an entry fresh again, after a 304"""
+
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                entry.expires = time.monotonic() + (self.ttl if ttl is None else ttl)
+                self.revalidated += 1
+
+    def invalidate(self, key: Hashable = None):
+        """Drops one key, or everything if no key is given"""
+
+        with self._lock:
+            if key is None:
+                self._data.clear()
+            else:
+                self._data.pop(key, None)
+
+    def __len__(self):
+        return len(self._data)
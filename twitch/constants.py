@@ -4,13 +4,47 @@ import logging
 DEBUG = os.environ.get("DEBUG", False)
 
 if DEBUG:
-    TWITCH_WS = "ws://127.0.0.1:8081/ws"
-    TWITCH_HELIX = "http://localhost:8080/mock"
-    TWITCH_AUTH = "http://localhost:8080/auth"
-    TWITCH_EVENTSUB = "http://127.0.0.1:8081"
+    # Overridable, e.g. to point at tools/simulator.py
+    TWITCH_WS = os.environ.get("TWITCH_WS", "ws://127.0.0.1:8081/ws")
+    TWITCH_HELIX = os.environ.get("TWITCH_HELIX", "http://localhost:8080/mock")
+    TWITCH_AUTH = os.environ.get("TWITCH_AUTH", "http://localhost:8080/auth")
+    TWITCH_EVENTSUB = os.environ.get("TWITCH_EVENTSUB", "http://127.0.0.1:8081")
     logging.warning("Using debug Twitch endpoints!")
 else:
     TWITCH_WS = "wss://eventsub.wss.twitch.tv/ws"
     TWITCH_HELIX = "https://api.twitch.tv/helix"
     TWITCH_AUTH = "https://id.twitch.tv/oauth2"
     TWITCH_EVENTSUB = TWITCH_HELIX
+
+# EventSub WebSocket limits, per Twitch docs
+EVENTSUB_MAX_SESSIONS = 3
+EVENTSUB_MAX_SUBS_PER_SESSION = 300
+EVENTSUB_WELCOME_TIMEOUT = 10.0
+
+# Token upkeep timings, in seconds
+TOKEN_REFRESH_MARGIN = 600
+TOKEN_REFRESH_JITTER = 120
+TOKEN_REFRESH_RETRY = 60
+TOKEN_VALIDATE_INTERVAL = 3600
+
+# Helix response cache, TTLs in seconds
+HELIX_CACHE_SIZE = 4096
+HELIX_USER_TTL = 300.0
+HELIX_STREAM_TTL = 15.0
+
+# Helix rate limiting & batching
+HELIX_MAX_RETRIES = 3
+HELIX_BATCH_WINDOW = 0.01
+
+# EventSub reconnects, in seconds
+EVENTSUB_DEFAULT_KEEPALIVE = 10.0
+EVENTSUB_KEEPALIVE_GRACE = 2.0
+EVENTSUB_BACKOFF_BASE = 0.25
+EVENTSUB_BACKOFF_MAX = 30.0
+
+# EventSub outbox
+OUTBOX_COMMIT_TIMEOUT = 1.0
+
+# EventSub handler retries, kept in the outbox until they succeed
+NOTIFY_MAX_ATTEMPTS = 5
+NOTIFY_RETRY_BASE = 1.0
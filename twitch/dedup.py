@@ -0,0 +1,68 @@
+import time
+import threading
+from collections import OrderedDict
+
+from utils.db import get_seen, prune_seen
+
+
+class DedupIndex:
+    """
+    Time-windowed LRU of recently seen keys
+    - check() is O(1), recording keys it hasn't seen
+    - Keys older than the window, or past maxsize, are forgotten
+    - Optionally persisted to the DB so restarts keep the window,
+      new keys are written with their notification's outbox row
+    """
+
+    def __init__(self, window: float = 600.0, maxsize: int = 10000):
+        """Constructor"""
+
+        self.window = window
+        self.maxsize = maxsize
+        self.persist = False
+        self._seen: "OrderedDict[str, float]" = OrderedDict()
+        self._lock = threading.Lock()
+
+        # Metrics
+        self.duplicates = 0
+
+    def enable_persistence(self):
+        """Loads the window from the DB, new keys should now go to the outbox"""
+
+        cutoff = time.time() - self.window
+        prune_seen(cutoff)
+        with self._lock:
+            for key, seen in get_seen(cutoff):
+                self._seen[key] = seen
+            self.persist = True
+
+    def check(self, *keys: str):
+        """
+        Returns True if any key was seen within the window
+        Otherwise records all of them and returns False
+        """
+
+        now = time.time()
+        with self._lock:
+            self._expire(now)
+            if any(key in self._seen for key in keys):
+                self.duplicates += 1
+                return True
+            for key in keys:
+                self._seen[key] = now
+            # Trim again so new keys can't push it past maxsize
+            self._expire(now)
+        return False
+
+    def _expire(self, now: float):
+        """Drops the oldest keys while stale or over size"""
+
+        cutoff = now - self.window
+        while self._seen:
+            key, seen = next(iter(self._seen.items()))
+            if seen > cutoff and len(self._seen) <= self.maxsize:
+                break
+            self._seen.popitem(last=False)
+
+    def __len__(self):
+        return len(self._seen)
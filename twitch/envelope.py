@@ -0,0 +1,135 @@
+import re
+import json
+import time
+from datetime import datetime, timezone
+
+from utils import jsoncodec
+
+# Typed decoding, if msgspec is installed
+try:
+    import msgspec
+
+    class _Metadata(msgspec.Struct):
+        message_id: str = ""
+        message_type: str = ""
+        message_timestamp: str = ""
+        subscription_type: str = None
+
+    class _Frame(msgspec.Struct):
+        metadata: _Metadata
+        payload: msgspec.Raw = msgspec.Raw(b"{}")
+
+    _frame_decoder = msgspec.json.Decoder(_Frame)
+
+except ImportError:
+    msgspec = None
+
+# Twitch sends metadata as the first key, only trust it there so nested keys never match
+_METADATA = re.compile(r'\s*\{\s*"metadata"\s*:\s*')
+_scanner = json.JSONDecoder()
+
+
+class Envelope:
+    """
+    A decoded EventSub frame
+    Metadata is decoded up front, the payload only when first accessed
+    """
+
+    __slots__ = ("raw", "message_id", "message_type", "message_timestamp",
+                 "subscription_type", "_payload")
+
+    def __init__(
+            self,
+            raw,
+            message_id: str,
+            message_type: str,
+            message_timestamp: str = "",
+            subscription_type: str = None,
+            payload=None
+            ):
+
+        self.raw = raw
+        self.message_id = message_id
+        self.message_type = message_type
+        self.message_timestamp = message_timestamp
+        self.subscription_type = subscription_type
+        self._payload = payload
+
+    @staticmethod
+    def from_metadata(raw, metadata: dict, payload=None):
+        """Builds an Envelope from a decoded metadata dict"""
+
+        return Envelope(
+            raw,
+            metadata.get("message_id", ""),
+            metadata.get("message_type", ""),
+            metadata.get("message_timestamp", ""),
+            metadata.get("subscription_type"),
+            payload
+        )
+
+    def __repr__(self):
+        return f"Envelope(type='{self.message_type}', " +\
+               f"subscription='{self.subscription_type}')"
+
+    @property
+    def payload(self) -> dict:
+        """The frame's payload, decoded on first use"""
+
+        payload = self._payload
+        if payload is None:
+            payload = jsoncodec.loads(self.raw)["payload"]
+        elif not isinstance(payload, dict):
+            payload = msgspec.json.decode(payload)
+        self._payload = payload
+        return payload
+
+    @property
+    def sent_at(self) -> float:
+        """When Twitch sent the frame, as a unix timestamp"""
+
+        # Twitch sends UTC with nanoseconds, more than fromisoformat takes before 3.11
+        try:
+            base, _, frac = self.message_timestamp.rstrip("Z").partition(".")
+            sent_at = datetime.fromisoformat(base).replace(tzinfo=timezone.utc).timestamp()
+            return sent_at + float("0." + frac) if frac.isdigit() else sent_at
+        except (AttributeError, ValueError):
+            return time.time()
+
+    @property
+    def session(self) -> dict:
+        return self.payload["session"]
+
+    @property
+    def subscription(self) -> dict:
+        return self.payload["subscription"]
+
+    @property
+    def event(self) -> dict:
+        return self.payload["event"]
+
+
+def decode_envelope(raw) -> Envelope:
+    """
+    Decodes an EventSub frame's metadata, leaving the payload for later
+    - msgspec: typed decode, payload kept as raw bytes
+    - orjson: a full decode is cheaper than a partial one
+    - stdlib: only the metadata object is scanned, if it's the first key of a str frame
+    """
+
+    if msgspec is not None:
+        frame = _frame_decoder.decode(raw)
+        meta = frame.metadata
+        return Envelope(
+            raw, meta.message_id, meta.message_type,
+            meta.message_timestamp, meta.subscription_type, frame.payload
+        )
+
+    if jsoncodec.BACKEND == "json" and isinstance(raw, str):
+        match = _METADATA.match(raw)
+        if match is not None:
+            metadata, _ = _scanner.raw_decode(raw, match.end())
+            return Envelope.from_metadata(raw, metadata)
+
+    frame = jsoncodec.loads(raw)
+    return Envelope.from_metadata(raw, frame["metadata"], frame.get("payload", {}))
@@ -0,0 +1,210 @@
+import logging
+from typing import Callable, Dict, List, Tuple
+
+from utils.db import add_stream_event
+from discord.delivery import deliveries
+from discord.routing import get_routes
+from .rest import lookup_stream, helix_cache, stream_key
+
+
+# Constants
+PREVIEW_URL = "https://static-cdn.jtvnw.net/previews-ttv/live_user_{login}-853x480.jpg"
+
+
+class NotReady(Exception):
+    """
+    Raised by a handler whose data isn't there yet, e.g. Helix lagging behind EventSub
+    It's retried like any failure, and the type's fallback runs once out of attempts
+    """
+
+
+class EventType:
+    """A registered EventSub subscription type and its handler"""
+
+    __slots__ = ("name", "version", "handler", "condition", "dedup_key", "prefetch", "optional", "fallback")
+
+    def __init__(
+            self,
+            name: str,
+            version: str,
+            handler: Callable[..., None],
+            condition: str,
+            dedup_key: Callable[[dict], str],
+            prefetch: Callable[[dict, Callable], None] = None,
+            optional: bool = False
+            ):
+
+        self.name = name
+        self.version = version
+        self.handler = handler
+        self.condition = condition
+        self.dedup_key = dedup_key
+        self.prefetch = prefetch
+        self.optional = optional
+        self.fallback: Callable[[dict, float], None] = None
+
+    def __repr__(self):
+        return f"EventType(name='{self.name}', version='{self.version}')"
+
+    def conditions(self, broadcaster_id: str):
+        """Subscription condition for a broadcaster"""
+        return {self.condition: broadcaster_id}
+
+
+class EventRegistry:
+    """
+    Maps (message_type, subscription_type) to handlers
+    - Lookups are a single dict get, unknown types return None
+    - Optional types are only subscribed once enabled, each costs a subscription per broadcaster
+    """
+
+    def __init__(self):
+        """Constructor"""
+        self._types: Dict[Tuple[str, str], EventType] = {}
+        self.enabled = set()
+
+    def register(
+            self,
+            name: str,
+            version: str = "1",
+            message_type: str = "notification",
+            condition: str = "broadcaster_user_id",
+            dedup_key: Callable[[dict], str] = None,
+            prefetch: Callable[[dict, Callable], None] = None,
+            optional: bool = False
+            ):
+        """
+        Decorator that registers a handler for a subscription type
+        Notification types are subscribed for every broadcaster, optional ones only if enabled
+        If set, prefetch(event, then) starts a lookup without blocking, from the receive path
+        The handler then runs once it calls back, getting its result as a third argument
+        """
+
+        def decorator(func: Callable[..., None]):
+            self._types[(message_type, name)] = EventType(
+                name, version, func, condition, dedup_key, prefetch, optional
+            )
+            return func
+        return decorator
+
+    def fallback(self, name: str, message_type: str = "notification"):
+        """
+        Decorator that registers what to do once a type's handler runs out of attempts
+        It only gets the event, so must make do with what the payload carries
+        """
+
+        def decorator(func: Callable[[dict, float], None]):
+            self._types[(message_type, name)].fallback = func
+            return func
+        return decorator
+
+    def enable(self, names: List[str]):
+        """Subscribes to these optional types too, warning about unknown ones"""
+
+        known = {t.name for t in self.subscriptions(everything=True)}
+        for name in names:
+            if name not in known:
+                logging.warning(f"Unknown EventSub type '{name}', ignoring!")
+        self.enabled = set(names) & known
+
+    def get(self, message_type: str, subscription_type: str):
+        """Returns the registered EventType, or None"""
+        return self._types.get((message_type, subscription_type))
+
+    def subscriptions(self, everything: bool = False):
+        """Notification types to subscribe broadcasters to, optional ones only if enabled"""
+        return [
+            t for (kind, _), t in self._types.items()
+            if kind == "notification" and (everything or not t.optional or t.name in self.enabled)
+        ]
+
+
+# Static Initialization
+events = EventRegistry()
+
+
+#
+# Handlers
+#
+
+@events.register(
+    "stream.online",
+    dedup_key=lambda e: f"stream:{e['broadcaster_user_id']}:{e['id']}",
+    prefetch=lambda e, then: lookup_stream(e['broadcaster_user_id'], then)
+)
+def on_stream_online(event: dict, sent_at: float, stream: dict):
+    """Posts a go-live notification to Discord and records it"""
+
+    # We got a message! Weeeee!
+    # The user's stream was looked up along with everyone else's going live
+    # Helix often lags behind EventSub for the first few seconds, or the lookup failed
+    if stream is None:
+        raise NotReady(f"No stream for {event['broadcaster_user_login']} yet")
+
+    # Keep a record of the stream
+    # NOTE: First, so if posting fails, a retry only repeats this and never a post
+    # Keyed by stream, so those retries don't add rows
+    add_stream_event(
+        event['broadcaster_user_id'], "online", sent_at,
+        stream['id'], stream['title'], stream['game_name']
+    )
+
+    thumbnail = stream['thumbnail_url'].replace("{width}x{height}", "853x480")
+    post_golive(event, sent_at, stream['title'], stream['game_name'], thumbnail)
+
+
+@events.fallback("stream.online")
+def on_stream_online_fallback(event: dict, sent_at: float):
+    """Posts a go-live without the stream's title or game, Helix never had it"""
+
+    login = event['broadcaster_user_login']
+    logging.warning(f"Posting {login}'s go-live without their stream info!")
+    # EventSub's event ID is the stream ID, so this shares the normal path's row
+    add_stream_event(event['broadcaster_user_id'], "online", sent_at, event['id'])
+    post_golive(
+        event, sent_at,
+        f"{event['broadcaster_user_name']} is live on Twitch!", "Unknown",
+        PREVIEW_URL.format(login=login)
+    )
+
+
+def post_golive(event: dict, sent_at: float, title: str, game: str, thumbnail: str):
+    """Fans a go-live out to every routed webhook, each has its own delivery lane"""
+
+    name = event['broadcaster_user_name']
+    login = event['broadcaster_user_login']
+    deliveries.push_many([
+        (destination.url, destination.template(name, login).render(
+            title=title,
+            game=game,
+            thumbnail=thumbnail
+        ))
+        for destination in get_routes().lookup(event['broadcaster_user_id'], login)
+    ], event['broadcaster_user_id'], sent_at)
+
+
+@events.register("stream.offline")
+def on_stream_offline(event: dict, sent_at: float):
+    """Forgets the cached stream of a broadcaster who went offline"""
+
+    helix_cache.invalidate(stream_key(event['broadcaster_user_id']))
+    add_stream_event(event['broadcaster_user_id'], "offline", sent_at)
+    logging.info(f"{event['broadcaster_user_name']} went offline!")
+
+
+@events.register("channel.update", version="2", optional=True)
+def on_channel_update(event: dict, sent_at: float):
+    """Forgets the cached stream, its title or category just changed"""
+
+    helix_cache.invalidate(stream_key(event['broadcaster_user_id']))
+    logging.info(f"{event['broadcaster_user_name']} updated their channel: {event['title']}")
+
+
+@events.register("channel.raid", condition="to_broadcaster_user_id", optional=True)
+def on_channel_raid(event: dict, sent_at: float):
+    """Logs incoming raids"""
+
+    logging.info(
+        f"{event['from_broadcaster_user_name']} raided "
+        f"{event['to_broadcaster_user_name']} with {event['viewers']} viewers!"
+    )
@@ -1,11 +1,27 @@
 import os
+import time
+import random
 import logging
-import requests
+import threading
 import urllib.parse
 
 from utils.config import get_config
-from utils.db import get_token, set_token, clear_token
-from .constants import TWITCH_AUTH
+from utils.http import get_transport
+from utils.threads import queue
+from utils.metrics import metrics
+from utils.health import health
+from utils.db import get_token, peek_token, set_token, set_token_user, clear_token
+from .constants import TWITCH_AUTH, TOKEN_REFRESH_MARGIN, TOKEN_REFRESH_JITTER, \
+    TOKEN_REFRESH_RETRY, TOKEN_VALIDATE_INTERVAL
+
+# Static
+refresh_lock = threading.Lock()
+schedule_lock = threading.Lock()  # guards refresh_job and validate_job
+refresh_job = None
+validate_job = None
+token_refreshes = metrics.counter("twitchbot_token_refreshes_total", "Token refreshes by status", ("status",))
+metrics.gauge("twitchbot_token_expiry_seconds", "Secs until the token expires", lambda: token_expiry())
+health.register("token", lambda: token_health())
 
 
 def request_token(code: str):
@@ -23,9 +39,9 @@ def request_token(code: str):
             "user_id": "40764486",  # hardcoded
             "scope": ""
         })
-        res = requests.post(f'{TWITCH_AUTH}/authorize?' + params)
+        res = get_transport().post(f'{TWITCH_AUTH}/authorize?' + params)
     else:
-        res = requests.post(f'{TWITCH_AUTH}/token', data={
+        res = get_transport().post(f'{TWITCH_AUTH}/token', data={
             "grant_type": "authorization_code",
             "client_id": config.t_clientid,
             "client_secret": config.t_secret,
@@ -41,38 +57,50 @@ def request_token(code: str):
         logging.error(res.json())
         return None
 
-    # Else, set db
-    set_token(res.json())
+    # Else, set db, keyed by user once validated
+    set_token(res.json(), user_id="")
+    validate_token()
+    schedule_refresh()
     return "Ok"
 
 
 def refresh_token():
     """
     Refreshes the token using the values stored in the DB
+    Only one refresh runs at a time
     """
 
+    with refresh_lock:
+        return _refresh_token()
+
+
+def _refresh_token():
+    """Refresh body, see refresh_token"""
+
     # Get token
     token = get_token()
     if token is None:
         return None
 
     # If recovering from a dev run and refresh is blank
-    if 'refresh' not in token:
+    if not token['refresh']:
         clear_token()
         return None
 
     # Send request
     config = get_config()
-    res = requests.post(f'{TWITCH_AUTH}/token', data={
+    res = get_transport().post(f'{TWITCH_AUTH}/token', data={
         "grant_type": "refresh_token",
         "client_id": config.t_clientid,
         "client_secret": config.t_secret,
-        "refresh_token": token.refresh,
+        "refresh_token": token['refresh'],
         "redirect_uri": urllib.parse.urljoin(
             config.hostname, "callback"
         ),
     })
 
+    token_refreshes.inc(str(res.status_code))
+
     # if bad refresh token
     if res.status_code == 400:
         logging.error("Bad refresh token! User must log in again!")
@@ -87,6 +115,7 @@ def refresh_token():
 
     # Else, set db
     set_token(res.json())
+    schedule_refresh()
     return "Ok"
 
 
@@ -102,7 +131,7 @@ def validate_token():
         return None
 
     # Send request
-    res = requests.get(f'{TWITCH_AUTH}/validate', headers={
+    res = get_transport().get(f'{TWITCH_AUTH}/validate', headers={
         "Authorization": f"Bearer {token['access']}",
     })
 
@@ -121,5 +150,83 @@ def validate_token():
         logging.error(res.json())
         return None
 
-    # We good
+    # We good, key the token by its user
+    set_token_user(res.json().get('user_id', ""))
     return "Ok"
+
+
+def schedule_refresh(delay: float = None):
+    """
+    (Re)schedules the proactive refresh
+    By default runs a jittered margin ahead of the token's expiry
+    NOTE: Locked, the proactive timer and a 401 can both reschedule at once
+    """
+    global refresh_job
+
+    with schedule_lock:
+        if refresh_job is not None:
+            refresh_job.cancel()
+            refresh_job = None
+
+        token = get_token()
+        if token is None:
+            return None
+
+        if delay is None:
+            delay = token['expires'] - time.time() - TOKEN_REFRESH_MARGIN
+            delay -= random.uniform(0, TOKEN_REFRESH_JITTER)
+        delay = max(delay, TOKEN_REFRESH_RETRY)
+
+        logging.info(f"Next token refresh in {delay:.0f}s")
+        refresh_job = queue.push_later(delay, proactive_refresh, priority=queue.PRIORITY_HIGH)
+        return refresh_job
+
+
+def proactive_refresh():
+    """Job that refreshes the token before it expires"""
+
+    logging.info("Proactively refreshing token...")
+    try:
+        status = refresh_token()
+    except Exception:
+        logging.exception("Token refresh raised!")
+        status = None
+
+    # Transient failure and the token still exists, try again soon
+    if status is None and get_token() is not None:
+        schedule_refresh(TOKEN_REFRESH_RETRY)
+
+
+def token_expiry():
+    """Secs until the current token expires, or None"""
+
+    token = get_token()
+    return token['expires'] - time.time() if token is not None else None
+
+
+def token_health():
+    """Secs until the cached token expires, fails if it already has"""
+
+    token = peek_token()
+    if token is None:
+        return {"ok": True, "logged_in": False, "expires_in": None}
+
+    expires_in = token['expires'] - time.time()
+    return {"ok": expires_in > 0, "logged_in": True, "expires_in": expires_in}
+
+
+def start_token_upkeep():
+    """
+    Starts background token upkeep
+    - Refreshes ahead of expiry
+    - Validates hourly, as Twitch requires
+    """
+    global validate_job
+
+    with schedule_lock:
+        if validate_job is None:
+            validate_job = queue.push_every(
+                TOKEN_VALIDATE_INTERVAL, validate_token,
+                priority=queue.PRIORITY_LOW
+            )
+    schedule_refresh()
@@ -0,0 +1,120 @@
+import time
+import heapq
+import random
+import threading
+from typing import List, Tuple
+
+
+class HelixRateLimiter:
+    """
+    Token bucket shared by all Helix calls
+    - Refills continuously, resyncs from Ratelimit-* response headers
+    - Waiters are served by priority, then FIFO
+    """
+
+    PRIORITY_NOTIFY = 0
+    PRIORITY_DEFAULT = 1
+    PRIORITY_DASHBOARD = 2
+
+    def __init__(self, limit: int = 800, period: float = 60.0):
+        """Constructor"""
+
+        self.limit = limit
+        self.period = period
+        self._tokens = float(limit)
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._waiters: List[Tuple[int, int]] = []
+        self._seq = 0
+        self._condition = threading.Condition()
+
+        # Metrics
+        self.throttled = 0
+        self.throttled_time = 0.0
+        self.retries = 0
+
+    def _refill(self, now: float):
+        """Adds tokens for the time passed since the last refill"""
+
+        rate = self.limit / self.period
+        self._tokens = min(self.limit, self._tokens + (now - self._updated) * rate)
+        self._updated = now
+
+    def acquire(self, priority: int = PRIORITY_DEFAULT):
+        """Blocks until this caller may send a request"""
+
+        with self._condition:
+            self._seq += 1
+            me = (priority, self._seq)
+            heapq.heappush(self._waiters, me)
+            start = time.monotonic()
+
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+
+                # Only the highest priority waiter may take a token
+                wait_for = None
+                if self._waiters[0] == me:
+                    if now < self._blocked_until:
+                        wait_for = self._blocked_until - now
+                    elif self._tokens < 1:
+                        wait_for = (1 - self._tokens) * self.period / self.limit
+                    else:
+                        break
+                self._condition.wait(wait_for)
+
+            heapq.heappop(self._waiters)
+            self._tokens -= 1
+            self._condition.notify_all()
+
+            # Metrics
+            waited = now - start
+            if waited > 0.001:
+                self.throttled += 1
+                self.throttled_time += waited
+
+    def update(self, headers: dict):
+        """Resyncs the bucket from Helix's Ratelimit-* response headers"""
+
+        try:
+            limit = int(headers["Ratelimit-Limit"])
+            remaining = int(headers["Ratelimit-Remaining"])
+            reset = float(headers["Ratelimit-Reset"])
+        except (KeyError, ValueError):
+            return
+
+        with self._condition:
+            self.limit = limit
+            self._tokens = float(remaining)
+            self._updated = time.monotonic()
+
+            # Bucket's dry, hold everyone until Twitch says it resets
+            if remaining == 0:
+                self.block(reset - time.time())
+
+    def block(self, delay: float):
+        """Holds all waiters for a while, e.g. after a 429"""
+
+        with self._condition:
+            until = time.monotonic() + max(delay, 0)
+            self._blocked_until = max(self._blocked_until, until)
+            self._condition.notify_all()
+
+    def backoff(self, attempt: int, headers: dict):
+        """
+        Blocks the bucket after a 429
+        Uses Ratelimit-Reset if given, else jittered exponential backoff
+        """
+
+        self.retries += 1
+        try:
+            delay = float(headers["Ratelimit-Reset"]) - time.time()
+        except (KeyError, ValueError):
+            delay = 0.5 * (2 ** attempt)
+        self.block(delay + random.uniform(0, 0.25))
+
+    def waiting(self):
+        """Number of callers waiting on a token"""
+        with self._condition:
+            return len(self._waiters)
@@ -1,10 +1,18 @@
+import time
 import logging
-import requests
 import urllib.parse
 
 from utils.config import get_config
+from utils.http import get_transport
 from utils.db import get_token
-from .constants import TWITCH_EVENTSUB, TWITCH_HELIX, TWITCH_AUTH
+from utils.metrics import metrics
+from utils.threads import queue
+from .cache import TTLCache
+from .batch import LookupBatcher
+from .ratelimit import HelixRateLimiter
+from .constants import TWITCH_EVENTSUB, TWITCH_HELIX, TWITCH_AUTH, \
+    HELIX_CACHE_SIZE, HELIX_USER_TTL, HELIX_STREAM_TTL, HELIX_MAX_RETRIES, \
+    HELIX_BATCH_WINDOW
 
 
 def format_auth_url():
@@ -25,9 +33,40 @@ def format_auth_url():
     return TWITCH_AUTH + "/authorize?" + params
 
 
-def get_cur_user():
+def helix_request(method: str, url: str, priority: int = HelixRateLimiter.PRIORITY_DEFAULT, **kwargs):
     """
-    Gets data from API on current user
+    Sends a request to Helix through the shared rate limiter
+    Retries 429s with backoff, returns the last response
+    """
+
+    endpoint = urllib.parse.urlsplit(url).path.rsplit("/", 1)[-1]
+    for attempt in range(HELIX_MAX_RETRIES + 1):
+        helix_limiter.acquire(priority)
+        start = time.perf_counter()
+        res = get_transport().request(method, url, **kwargs)
+        helix_seconds.observe(time.perf_counter() - start, endpoint)
+        helix_requests.inc(endpoint, str(res.status_code))
+        helix_limiter.update(res.headers)
+
+        if res.status_code != 429:
+            break
+
+        logging.warning(f"Helix rate limited, attempt {attempt + 1}!")
+        helix_limiter.backoff(attempt, res.headers)
+
+    return res
+
+
+def helix_get(
+        path: str,
+        params: list = None,
+        ttl: float = None,
+        what: str = "Helix",
+        priority: int = HelixRateLimiter.PRIORITY_DEFAULT
+        ):
+    """
+    Sends a GET to Helix, returning its 'data' list
+    If ttl is set, responses are cached and revalidated by ETag
     Returns None if an error is occurred
     """
 
@@ -35,53 +74,135 @@ def get_cur_user():
     if token is None:
         return None
 
+    # Serve from cache while fresh
+    key = (path, tuple(params or ()))
+    entry = helix_cache.get(key) if ttl else None
+    if entry is not None and entry.fresh(time.monotonic()):
+        return entry.value
+
     config = get_config()
-    res = requests.get(f'{TWITCH_HELIX}/users', headers={
+    headers = {
         "Authorization": f"Bearer {token['access']}",
         "Client-Id": config.t_clientid
-    })
+    }
+    if entry is not None and entry.etag:
+        headers["If-None-Match"] = entry.etag
+
+    res = helix_request("GET", f'{TWITCH_HELIX}{path}', priority, params=params, headers=headers)
+
+    # Unchanged since we cached it
+    if res.status_code == 304 and entry is not None:
+        helix_cache.touch(key, ttl)
+        return entry.value
 
     # If bad response, error
     if res.status_code != 200:
-        logging.error(f"User data failed with code {res.status_code}!")
+        logging.error(f"{what} failed with code {res.status_code}!")
         logging.error(res.json())
         return None
 
-    return res.json()['data'][0]
+    # Don't cache empty results, they're usually Helix lagging behind
+    data = res.json()['data']
+    if ttl and data:
+        helix_cache.set(key, data, res.headers.get("ETag"), ttl)
+    return data
 
 
-def get_stream(user_id):
+def get_cur_user(priority: int = HelixRateLimiter.PRIORITY_DASHBOARD):
     """
-    Gets data from API on user's stream
+    Gets data from API on current user
     Returns None if an error is occurred
     """
 
-    token = get_token()
-    if token is None:
+    data = helix_get("/users", ttl=HELIX_USER_TTL, what="User data", priority=priority)
+    if not data:
         return None
 
-    config = get_config()
-    res = requests.get(
-        f'{TWITCH_HELIX}/streams?user_id={user_id}',
-        headers={
-            "Authorization": f"Bearer {token['access']}",
-            "Client-Id": config.t_clientid
-        }
-    )
+    return data[0]
 
-    # If bad response, error
-    if res.status_code != 200:
-        logging.error(f"User data failed with code {res.status_code}!")
-        logging.error(res.json())
-        return None
 
-    logging.info(f"Successfully fetched stream info for {user_id} via REST!")
-    return res.json()['data'][0]
+def get_users(ids: list = None, logins: list = None):
+    """
+    Gets data from API on a list of users, by ID or login
+    Returns None if an error is occurred
+    """
+
+    # Helix only accepts 100 users per request
+    params = [("id", i) for i in ids or []] + \
+        [("login", login) for login in logins or []]
+
+    users = []
+    for i in range(0, len(params), 100):
+        data = helix_get("/users", params[i:i + 100], ttl=HELIX_USER_TTL, what="User data")
+        if data is None:
+            return None
+        users += data
+
+    return users
 
 
-def sub_to_event(ws_session: str, event: str, conditions: dict):
+def get_streams(user_ids: list):
     """
-    Gets data from API on current user
+    Gets data from API on many users' streams, 100 per request
+    Only live streams are returned, each is cached for get_stream
+    Returns None if an error is occurred
+    """
+
+    streams = []
+    for i in range(0, len(user_ids), 100):
+        params = [("user_id", u) for u in user_ids[i:i + 100]] + [("first", "100")]
+        data = helix_get(
+            "/streams", params,
+            what="Stream data", priority=HelixRateLimiter.PRIORITY_NOTIFY
+        )
+        if data is None:
+            return None
+
+        for stream in data:
+            helix_cache.set(stream_key(stream['user_id']), [stream], ttl=HELIX_STREAM_TTL)
+        streams += data
+
+    logging.info(f"Fetched {len(streams)}/{len(user_ids)} streams via REST!")
+    return streams
+
+
+def stream_key(user_id):
+    """Cache key of a single user's stream"""
+    return ("/streams", (("user_id", user_id),))
+
+
+def get_stream(user_id):
+    """
+    Gets data from API on user's stream
+    Returns None if an error is occurred, or they aren't live
+    """
+
+    entry = helix_cache.get(stream_key(user_id))
+    if entry is not None and entry.fresh(time.monotonic()):
+        return entry.value[0]
+
+    streams = get_streams([user_id])
+    return streams[0] if streams else None
+
+
+def lookup_stream(user_id, callback):
+    """
+    Looks up a user's stream without blocking
+    Lookups made close together share one batched request
+    'callback' gets the stream, or None, on a worker
+    """
+
+    entry = helix_cache.get(stream_key(user_id))
+    if entry is not None and entry.fresh(time.monotonic()):
+        queue.push(callback, entry.value[0], priority=queue.PRIORITY_HIGH)
+        return
+
+    stream_batcher.submit(user_id, callback)
+
+
+def sub_to_event(ws_session: str, event: str, conditions: dict, version: str = "1"):
+    """
+    Subscribes a WebSocket session to an EventSub event
     Returns None if an error is occurred
     """
 
@@ -90,8 +211,8 @@ def sub_to_event(ws_session: str, event: str, conditions: dict):
         return None
 
     config = get_config()
-    res = requests.post(
-        f"{TWITCH_EVENTSUB}/eventsub/subscriptions",
+    res = helix_request(
+        "POST", f"{TWITCH_EVENTSUB}/eventsub/subscriptions",
         headers={
             "Authorization": f"Bearer {token['access']}",
             "Client-Id": config.t_clientid,
@@ -99,7 +220,7 @@ def sub_to_event(ws_session: str, event: str, conditions: dict):
         },
         json={
             "type": event,
-            "version": "1",
+            "version": version,
             "condition": conditions,
             "transport": {
                 "method": "websocket",
@@ -117,3 +238,64 @@ def sub_to_event(ws_session: str, event: str, conditions: dict):
     # log and return
     logging.info(f"Successfully subscribed WebSocket {ws_session} to '{event}' via REST!")
     return res.json()
+
+
+def unsub_from_event(sub_id: str):
+    """
+    Deletes an EventSub subscription
+    Returns None if an error is occurred
+    """
+
+    token = get_token()
+    if token is None:
+        return None
+
+    config = get_config()
+    res = helix_request(
+        "DELETE", f"{TWITCH_EVENTSUB}/eventsub/subscriptions",
+        params={"id": sub_id},
+        headers={
+            "Authorization": f"Bearer {token['access']}",
+            "Client-Id": config.t_clientid
+        }
+    )
+
+    # If bad response, error
+    if res.status_code != 204:
+        logging.error(f"EventSub delete subscription failed with code {res.status_code}!")
+        return None
+
+    # log and return
+    logging.info(f"Successfully deleted subscription {sub_id} via REST!")
+    return "Ok"
+
+
+# Static
+helix_cache = TTLCache(HELIX_CACHE_SIZE)
+helix_limiter = HelixRateLimiter()
+stream_batcher = LookupBatcher(get_streams, key="user_id", window=HELIX_BATCH_WINDOW)
+helix_requests = metrics.counter(
+    "twitchbot_helix_requests_total", "Helix requests by endpoint and status", ("endpoint", "status")
+)
+helix_seconds = metrics.histogram("twitchbot_helix_request_seconds", "Helix request latency", ("endpoint",))
+metrics.gauge("twitchbot_helix_waiting", "Helix calls waiting on the rate limiter", lambda: helix_limiter.waiting())
+metrics.counter_func(
+    "twitchbot_helix_throttled_total", "Helix calls that had to wait on the rate limiter",
+    lambda: helix_limiter.throttled
+)
+metrics.counter_func(
+    "twitchbot_helix_throttled_seconds_total", "Time Helix calls spent waiting on the rate limiter",
+    lambda: helix_limiter.throttled_time
+)
+metrics.counter_func("twitchbot_helix_retries_total", "Helix calls retried after a 429", lambda: helix_limiter.retries)
+metrics.gauge("twitchbot_helix_cache_entries", "Cached Helix responses", lambda: len(helix_cache))
+metrics.counter_func(
+    "twitchbot_helix_cache_lookups_total", "Helix cache lookups, by result",
+    lambda: {("hit",): helix_cache.hits, ("miss",): helix_cache.misses, ("revalidated",): helix_cache.revalidated},
+    ("result",)
+)
+metrics.counter_func(
+    "twitchbot_helix_batched_lookups_total", "Stream lookups, and the batched requests they were folded into",
+    lambda: {("lookups",): stream_batcher.lookups, ("requests",): stream_batcher.batches},
+    ("kind",)
+)
@@ -1,98 +1,827 @@
-import json
+import time
+import random
 import logging
+import functools
 import threading
-from websockets.sync import client
-from websockets.exceptions import ConnectionClosedError
+from typing import Callable, Dict, List
 
+from utils.aio import get_runtime, to_io
+from utils.lazy import lazy_import
 from utils.config import get_config
-from discord.webhooks import generate_webhook
-from discord.discordlib import DiscordMessage, DiscordEmbed
-from .rest import get_cur_user, sub_to_event, get_stream
-from .constants import TWITCH_WS
+from utils.metrics import metrics
+from utils.threads import queue
+from utils.outbox import outbox, OutboxEntry
+from utils.health import health
+from utils.shards import get_shards
+from utils.db import add_subscriptions, remove_subscriptions, clear_subscriptions, get_broadcasters, \
+    peek_token, reload_token
+from discord.delivery import deliveries
+from .dedup import DedupIndex
+from .envelope import decode_envelope
+from .events import events, EventType, NotReady
+from .rest import get_cur_user, get_users, sub_to_event, unsub_from_event
+from .constants import TWITCH_WS, EVENTSUB_MAX_SESSIONS, \
+    EVENTSUB_MAX_SUBS_PER_SESSION, EVENTSUB_WELCOME_TIMEOUT, \
+    EVENTSUB_DEFAULT_KEEPALIVE, EVENTSUB_KEEPALIVE_GRACE, \
+    EVENTSUB_BACKOFF_BASE, EVENTSUB_BACKOFF_MAX, OUTBOX_COMMIT_TIMEOUT, \
+    NOTIFY_MAX_ATTEMPTS, NOTIFY_RETRY_BASE
+
+# Only needed once a WebSocket opens, so kept off the startup path
+asyncio = lazy_import("asyncio")
+client = lazy_import("websockets.sync.client")
+aio_client = lazy_import("websockets.client")
+exceptions = lazy_import("websockets.exceptions")
 
 STOP_EVTLOOP_EVENT = threading.Event()
 
 
+class BaseEventSubSession:
+    """
+    A single EventSub WebSocket connection
+    - Holds subscriptions for many broadcasters at once
+    - Follows session_reconnect handoffs, keeping its subscriptions
+    - Reconnects with backoff when the socket dies or goes quiet
+    Subclasses run the receive loop, on a thread or on the asyncio runtime
+    """
+
+    def __init__(self, name: str, manager: "SubscriptionManager"):
+        """Constructor"""
+
+        self.name = name
+        self.manager = manager
+        self.session_id = None
+        self.subscriptions: Dict[str, List[str]] = {}  # broadcaster id -> sub ids
+        self.costs: Dict[str, int] = {}  # broadcaster id -> cost of its subs
+        self.sub_count = 0
+        self.slot = None  # shared session slot, when sharded
+
+        # Connection state
+        self.state = "connecting"
+        self.keepalive_timeout = EVENTSUB_DEFAULT_KEEPALIVE
+        self.last_message = 0.0
+        self.reconnect_url = None
+        self.reconnects = 0
+        self._attempt = 0
+        self._ws = None
+        self._ready = threading.Event()
+        self._closed = threading.Event()
+
+    def __repr__(self):
+        return f"{type(self).__name__}(name='{self.name}', " +\
+               f"id='{self.session_id}', " +\
+               f"state='{self.state}', " +\
+               f"subs={self.sub_count})"
+
+    def has_capacity(self):
+        """Whether this session can take another subscription"""
+
+        if self._closed.is_set() or self.state != "connected":
+            return False
+        if self.sub_count + len(events.subscriptions()) > EVENTSUB_MAX_SUBS_PER_SESSION:
+            return False
+        return True
+
+    def wait_ready(self):
+        """Blocks until the welcome message arrives, returns success"""
+        self._ready.wait(EVENTSUB_WELCOME_TIMEOUT)
+        return self.session_id is not None
+
+    def subscribe(self, broadcaster_id: str):
+        """
+        Subscribes a broadcaster to every registered event on this session
+        Returns None if none of them could be subscribed
+        NOTE: Call with the manager's lock held, cost is tracked there
+        """
+
+        sub_ids = []
+        rows = []
+        cost = 0
+        for event_type in events.subscriptions():
+            res = sub_to_event(
+                self.session_id,
+                event=event_type.name,
+                conditions=event_type.conditions(broadcaster_id),
+                version=event_type.version
+            )
+            if res is None:
+                logging.error(f"Failed to subscribe {broadcaster_id} to '{event_type.name}'!")
+                continue
+
+            # Cost is per token, so the manager tracks it across sessions
+            sub_ids.append(res['data'][0]['id'])
+            rows.append((sub_ids[-1], broadcaster_id, event_type.name, event_type.version, self.session_id))
+            cost += res['data'][0].get('cost', 1)
+            self.manager.update_cost(res)
+
+        if len(sub_ids) == 0:
+            return None
+
+        add_subscriptions(rows)
+        self.subscriptions[broadcaster_id] = sub_ids
+        self.costs[broadcaster_id] = cost
+        self.sub_count += len(sub_ids)
+        return sub_ids
+
+    def unsubscribe(self, broadcaster_id: str):
+        """Removes a broadcaster's subscriptions from this session"""
+
+        sub_ids = self.subscriptions.pop(broadcaster_id, [])
+        self.manager.release_cost(self.costs.pop(broadcaster_id, 0))
+        self.sub_count -= len(sub_ids)
+        for sub_id in sub_ids:
+            unsub_from_event(sub_id)
+        remove_subscriptions(sub_ids)
+
+    def start(self):
+        """Starts the receive loop"""
+        raise NotImplementedError()
+
+    def spawn(self, handler: Callable):
+        """Runs a handler off the receive loop, so the socket keeps being read"""
+        raise NotImplementedError()
+
+    def close(self):
+        """Tells the session to stop, interrupting any wait on the socket"""
+        raise NotImplementedError()
+
+    def is_open(self):
+        """Whether the receive loop should keep going"""
+        return not self._closed.is_set() and not STOP_EVTLOOP_EVENT.is_set()
+
+    def recv_timeout(self):
+        """How long the socket may stay quiet before we call it dead"""
+        return self.keepalive_timeout + EVENTSUB_KEEPALIVE_GRACE
+
+    def backoff(self):
+        """Jittered exponential delay before the next reconnect attempt"""
+
+        delay = min(EVENTSUB_BACKOFF_MAX, EVENTSUB_BACKOFF_BASE * (2 ** self._attempt))
+        self._attempt += 1
+        return random.uniform(delay / 2, delay)
+
+    def on_welcome(self, raw: str, handoff: bool = False):
+        """
+        Records the session from a welcome message
+        Returns whether subscriptions must be recreated
+        """
+
+        session = decode_envelope(raw).session
+        old_id = self.session_id
+
+        self.session_id = session['id']
+        self.keepalive_timeout = session.get('keepalive_timeout_seconds') or self.keepalive_timeout
+        self.last_message = time.monotonic()
+        self.state = "connected"
+        self._attempt = 0
+        logging.info(f"Websocket ID: {self.session_id}")
+        self._ready.set()
+
+        # A handoff keeps the same session, a fresh connect starts empty
+        if handoff:
+            eventsub_reconnects.inc("handoff")
+        return not handoff and old_id is not None and len(self.subscriptions) > 0
+
+    def on_message(self, raw: str):
+        """
+        Parses a message, returns a handler to run for it or None
+        The handler must be run by the caller
+        """
+
+        # Decode metadata, the payload waits until someone needs it
+        self.last_message = time.monotonic()
+        message = decode_envelope(raw)
+        message_type = message.message_type
+        eventsub_frames.inc(message_type)
+
+        # Keepalives only need to reset the timer above
+        if message_type == "session_keepalive":
+            return None
+
+        # if a notification we have a handler for...
+        if message_type == "notification":
+            event_type = events.get(message_type, message.subscription_type)
+            if event_type is None:
+                return None
+            event = message.event
+
+            # Sharded, and the broadcaster has moved to another shard
+            if not owns_event(event):
+                logging.info(f"Dropping notification {message.message_id}, another shard owns it")
+                return None
+
+            # EventSub is at-least-once, drop replays before doing any work
+            keys = [f"msg:{message.message_id}"]
+            if event_type.dedup_key is not None:
+                keys.append(event_type.dedup_key(event))
+            if dedup.check(*keys):
+                logging.info(f"Dropping duplicate notification {message.message_id}")
+                return None
+
+            # Log it before handling, so a crash can't lose it
+            entry = outbox.append(message.message_id, message.subscription_type, raw, keys if dedup.persist else ())
+            return dispatch(Notification(entry, event_type, event, message.sent_at))
+
+        # Twitch is moving us, reconnect_url takes over this session
+        if message_type == "session_reconnect":
+            self.reconnect_url = message.session['reconnect_url']
+
+        # Twitch dropped a subscription on its end
+        elif message_type == "revocation":
+            sub = message.subscription
+            broadcaster_id = next(iter(sub['condition'].values()), None)
+            logging.warning(f"Subscription '{sub['type']}' for {broadcaster_id} was revoked!")
+            queue.push(self.manager.remove_broadcaster, broadcaster_id)
+
+        return None
+
+    def on_disconnect(self):
+        """Forgets the socket, returns secs to wait before reconnecting"""
+
+        self._ws = None
+        self.reconnect_url = None
+        self._ready.clear()
+        if not self.is_open():
+            return 0
+        self.state = "reconnecting"
+        self.reconnects += 1
+        eventsub_reconnects.inc("dropped")
+        return self.backoff()
+
+    def on_closed(self):
+        """Cleans up once the session is done for good"""
+
+        self.state = "closed"
+        self._closed.set()
+        self._ready.set()
+        self.manager.on_session_closed(self)
+        logging.info("Finished session loop!")
+
+
+class EventSubSession(BaseEventSubSession):
+    """An EventSub session whose receive loop runs on its own thread"""
+
+    def start(self):
+        """Spawns the receive loop"""
+        threading.Thread(target=self.run, name=self.name, daemon=True).start()
+
+    def spawn(self, handler: Callable):
+        """Runs a handler on a worker, so the socket keeps being read"""
+        queue.push(run_handler, handler, priority=queue.PRIORITY_HIGH)
+
+    def close(self):
+        """Tells the session to stop, interrupting any wait on the socket"""
+
+        self._closed.set()
+        ws = self._ws
+        if ws is not None:
+            ws.close()
+
+    def run(self):
+        """
+        Main session receive loop
+        NOTE: This function should never be called directly
+        """
+
+        logging.info("Starting Websocket Loop...")
+        try:
+            while self.is_open():
+                try:
+                    self._ws = client.connect(TWITCH_WS, open_timeout=EVENTSUB_WELCOME_TIMEOUT)
+                    if self.on_welcome(self._ws.recv(EVENTSUB_WELCOME_TIMEOUT)):
+                        self.manager.resubscribe(self)
+                    self.listen()
+
+                except (exceptions.WebSocketException, TimeoutError, OSError) as e:
+                    if self.is_open():
+                        logging.error("The WebSocket connection was lost!")
+                        logging.error(repr(e))
+
+                finally:
+                    if self._ws is not None:
+                        self._ws.close()
+
+                # Back off, unless we're done
+                delay = self.on_disconnect()
+                if delay:
+                    logging.info(f"Reconnecting in {delay:.2f}s...")
+                    self._closed.wait(delay)
+
+        finally:
+            self.on_closed()
+
+    def listen(self):
+        """Reads messages until the socket dies or goes quiet"""
+
+        while self.is_open():
+
+            # Keepalives reset this, silence means the socket's dead
+            raw = self._ws.recv(self.recv_timeout())
+
+            handler = self.on_message(raw)
+            if handler is not None:
+                self.spawn(handler)
+
+            if self.reconnect_url is not None:
+                self.handoff()
+
+    def handoff(self):
+        """Moves to reconnect_url, then drains and drops the old socket"""
+
+        logging.info(f"Following reconnect to {self.reconnect_url}...")
+        old = self._ws
+        new = client.connect(self.reconnect_url, open_timeout=EVENTSUB_WELCOME_TIMEOUT)
+        self.on_welcome(new.recv(EVENTSUB_WELCOME_TIMEOUT), handoff=True)
+        self.reconnect_url = None
+        self._ws = new
+
+        # Anything the old socket still had is ours to handle
+        try:
+            while True:
+                handler = self.on_message(old.recv(0))
+                if handler is not None:
+                    self.spawn(handler)
+        except (exceptions.ConnectionClosed, TimeoutError):
+            pass
+        old.close()
+
+
+class AsyncEventSubSession(BaseEventSubSession):
+    """
+    An EventSub session run as a task on the asyncio runtime
+    Handlers run on the runtime's executor, so receiving never waits on them
+    """
+
+    def __init__(self, name: str, manager: "SubscriptionManager"):
+        """Constructor"""
+
+        super().__init__(name, manager)
+        self._tasks = set()
+        self._wakeup = None
+
+    def start(self):
+        """Schedules the receive loop on the runtime"""
+        get_runtime().submit(self.run_async())
+
+    def close(self):
+        """Tells the session to stop, interrupting any wait on the socket"""
+
+        self._closed.set()
+        loop = get_runtime().loop
+        if self._ws is not None:
+            asyncio.run_coroutine_threadsafe(self._ws.close(), loop)
+        if self._wakeup is not None:
+            loop.call_soon_threadsafe(self._wakeup.set)
+
+    def spawn(self, handler: Callable):
+        """Runs a handler on the executor, keeping a ref till it's done"""
+
+        task = asyncio.ensure_future(to_io(run_handler, handler))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def run_async(self):
+        """
+        Main session receive coroutine
+        NOTE: This function should never be called directly
+        """
+
+        logging.info(f"Starting Websocket Loop for {self.name}...")
+        self._wakeup = asyncio.Event()
+        try:
+            while self.is_open():
+                try:
+                    self._ws = await aio_client.connect(TWITCH_WS, open_timeout=EVENTSUB_WELCOME_TIMEOUT)
+                    welcome = await asyncio.wait_for(self._ws.recv(), EVENTSUB_WELCOME_TIMEOUT)
+                    if self.on_welcome(welcome):
+                        await to_io(self.manager.resubscribe, self)
+                    await self.listen_async()
+
+                except (exceptions.WebSocketException, asyncio.TimeoutError, OSError) as e:
+                    if self.is_open():
+                        logging.error("The WebSocket connection was lost!")
+                        logging.error(repr(e))
+
+                finally:
+                    if self._ws is not None:
+                        await self._ws.close()
+
+                # Back off, unless we're done
+                delay = self.on_disconnect()
+                if delay:
+                    logging.info(f"Reconnecting in {delay:.2f}s...")
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), delay)
+                    except asyncio.TimeoutError:
+                        pass
+
+        finally:
+            # Takes the manager's lock, which may be held while waiting on this loop
+            await to_io(self.on_closed)
+
+    async def listen_async(self):
+        """Reads messages until the socket dies or goes quiet"""
+
+        while self.is_open():
+
+            # Keepalives reset this, silence means the socket's dead
+            raw = await asyncio.wait_for(self._ws.recv(), self.recv_timeout())
+
+            handler = self.on_message(raw)
+            if handler is not None:
+                self.spawn(handler)
+
+            if self.reconnect_url is not None:
+                await self.handoff_async()
+
+    async def handoff_async(self):
+        """Moves to reconnect_url, then drains and drops the old socket"""
+
+        logging.info(f"Following reconnect to {self.reconnect_url}...")
+        old = self._ws
+        new = await aio_client.connect(self.reconnect_url, open_timeout=EVENTSUB_WELCOME_TIMEOUT)
+        welcome = await asyncio.wait_for(new.recv(), EVENTSUB_WELCOME_TIMEOUT)
+        self.on_welcome(welcome, handoff=True)
+        self.reconnect_url = None
+        self._ws = new
+
+        # Anything the old socket still had is ours to handle
+        while old.messages:
+            handler = self.on_message(old.messages.popleft())
+            if handler is not None:
+                self.spawn(handler)
+        await old.close()
+
+
+def run_handler(handler: Callable):
+    """Runs a message handler, logging instead of killing the loop"""
+
+    try:
+        handler()
+    except Exception:
+        logging.exception("EventSub handler raised!")
+
+
+class Notification:
+    """An EventSub notification being handled, and how many times it's been tried"""
+
+    __slots__ = ("entry", "event_type", "event", "sent_at", "attempts")
+
+    def __init__(self, entry: OutboxEntry, event_type: EventType, event: dict, sent_at: float):
+        self.entry = entry
+        self.event_type = event_type
+        self.event = event
+        self.sent_at = sent_at
+        self.attempts = 0
+
+    def __repr__(self):
+        return f"Notification(type='{self.event_type.name}', attempts={self.attempts})"
+
+
+def dispatch(notification: Notification):
+    """
+    Starts handling a notification
+    Types with a prefetch start their lookup here, on the receive path, so lookups batch
+    Returns a handler the caller must run, or None if the lookup will run it
+    """
+
+    handler = functools.partial(handle_notification, notification)
+    prefetch = notification.event_type.prefetch
+    if prefetch is None:
+        return handler
+    prefetch(notification.event, handler)
+    return None
+
+
+def handle_notification(notification: Notification, *prefetched):
+    """
+    Runs a notification handler once its outbox entry is on disk
+    - The entry is only done once the handler succeeds, failures are retried with backoff
+    - On the last attempt, the type's fallback runs if the handler fails again
+    """
+
+    entry = notification.entry
+    if not entry.wait(OUTBOX_COMMIT_TIMEOUT):
+        logging.warning(f"{entry} isn't committed yet, handling anyway!")
+
+    event_type = notification.event_type
+    notification.attempts += 1
+    try:
+        try:
+            event_type.handler(notification.event, notification.sent_at, *prefetched)
+        except Exception:
+            if notification.attempts < NOTIFY_MAX_ATTEMPTS or event_type.fallback is None:
+                raise
+
+            # Out of attempts, make do with what the event carries
+            logging.warning(f"{notification} is out of attempts, falling back!")
+            event_type.fallback(notification.event, notification.sent_at)
+
+    except NotReady as e:
+        logging.info(f"{notification} isn't ready, {e}")
+        retry_notification(notification)
+        return
+    except Exception:
+        logging.exception(f"Handling {notification} raised!")
+        retry_notification(notification)
+        return
+    outbox.done(entry)
+
+
+def retry_notification(notification: Notification):
+    """
+    Dispatches a failed notification again after a jittered exponential delay
+    After NOTIFY_MAX_ATTEMPTS it's left in the outbox, for the next start to retry
+    """
+
+    if notification.attempts >= NOTIFY_MAX_ATTEMPTS:
+        logging.error(f"Giving up on {notification} until restart, it's kept in the outbox!")
+        return
+
+    delay = NOTIFY_RETRY_BASE * (2 ** (notification.attempts - 1))
+    delay = random.uniform(delay / 2, delay)
+    logging.info(f"Retrying {notification} in {delay:.2f}s...")
+    queue.push_later(delay, redispatch, notification, priority=queue.PRIORITY_HIGH)
+
+
+def redispatch(notification: Notification):
+    """Dispatches a notification again, on this worker unless it waits on a lookup"""
+
+    handler = dispatch(notification)
+    if handler is not None:
+        run_handler(handler)
+
+
+def owns_event(event: dict):
+    """Whether this process should handle an event, always true unless sharded"""
+
+    shards = get_shards()
+    if shards is None:
+        return True
+    broadcaster_id = event.get('broadcaster_user_id')
+    return broadcaster_id is None or shards.owns(broadcaster_id)
+
+
+def replay_outbox(entries: List[OutboxEntry]):
+    """Hands notifications a previous run never finished back to the workers"""
+
+    for entry in entries:
+        event_type = events.get("notification", entry.kind)
+        if event_type is None:
+            outbox.done(entry)
+            continue
+
+        # Remember them, so a redelivery from Twitch isn't handled twice
+        message = decode_envelope(entry.raw)
+        event = message.event
+        keys = [f"msg:{entry.message_id}"]
+        if event_type.dedup_key is not None:
+            keys.append(event_type.dedup_key(event))
+        dedup.check(*keys)
+
+        handler = dispatch(Notification(entry, event_type, event, message.sent_at))
+        if handler is not None:
+            queue.push(run_handler, handler, priority=queue.PRIORITY_HIGH)
+
+
+class SubscriptionManager:
+    """
+    Packs broadcaster subscriptions into as few EventSub sessions as possible
+    - New sessions are only opened when the current ones are full
+    - Subscription cost is budgeted per token, across every session
+    """
+
+    def __init__(self):
+        """Constructor"""
+
+        self._sessions: List[BaseEventSubSession] = []
+        self._broadcasters: Dict[str, BaseEventSubSession] = {}
+        self._lock = threading.RLock()
+        self._counter = 0
+
+        # Cost budget, as last reported by Twitch
+        self.total_cost = 0
+        self.max_total_cost = None
+
+    @property
+    def broadcasters(self):
+        """IDs of all currently subscribed broadcasters"""
+        with self._lock:
+            return list(self._broadcasters.keys())
+
+    @property
+    def sessions(self):
+        """All currently open sessions"""
+        with self._lock:
+            return list(self._sessions)
+
+    def has_budget(self):
+        """Whether the token's subscription cost budget has room left"""
+        return self.max_total_cost is None or self.total_cost < self.max_total_cost
+
+    def update_cost(self, res: dict):
+        """Takes the token's cost from a subscribe response, it's authoritative"""
+
+        with self._lock:
+            self.total_cost = res.get('total_cost', self.total_cost)
+            self.max_total_cost = res.get('max_total_cost', self.max_total_cost)
+
+    def release_cost(self, cost: int):
+        """Estimates the cost freed by dropped subscriptions, until Twitch next reports it"""
+
+        with self._lock:
+            self.total_cost = max(0, self.total_cost - cost)
+
+    def _open_session(self):
+        """Spawns a new session and waits for its welcome"""
+
+        # Twitch counts sockets per token, so shards share the limit
+        shards = get_shards()
+        slot = None
+        if shards is None and len(self._sessions) >= EVENTSUB_MAX_SESSIONS:
+            logging.error("All EventSub sessions are full!")
+            return None
+        if shards is not None:
+            slot = shards.take_slot()
+            if slot is None:
+                logging.error("All EventSub sessions are full, across every shard!")
+                return None
+
+        self._counter += 1
+        session_cls = AsyncEventSubSession if get_runtime() else EventSubSession
+        session = session_cls(f"EventSub-{self._counter}", self)
+        session.slot = slot
+        self._sessions.append(session)
+        session.start()
+
+        if not session.wait_ready():
+            logging.error(f"{session.name} never received a welcome!")
+            session.close()
+            return None
+
+        return session
+
+    def add_broadcaster(self, broadcaster_id: str):
+        """
+        Subscribes to a broadcaster on the first session with room
+        Returns None if an error is occurred
+        """
+
+        with self._lock:
+            if broadcaster_id in self._broadcasters:
+                return self._broadcasters[broadcaster_id]
+
+            # No session can subscribe anything once the budget's spent
+            if not self.has_budget():
+                logging.error(f"EventSub cost budget is spent ({self.total_cost}/{self.max_total_cost})!")
+                return None
+
+            # Find a session with room, else open one
+            session = next((s for s in self._sessions if s.has_capacity()), None)
+            if session is None:
+                session = self._open_session()
+                if session is None:
+                    return None
+
+            # Don't keep an empty session around, Twitch drops unused sockets
+            if session.subscribe(broadcaster_id) is None:
+                if len(session.subscriptions) == 0:
+                    session.close()
+                return None
+
+            self._broadcasters[broadcaster_id] = session
+            logging.info(f"Subscribed to {broadcaster_id} on {session.name}!")
+            return session
+
+    def remove_broadcaster(self, broadcaster_id: str):
+        """Unsubscribes from a broadcaster, closing its session if now empty"""
+
+        with self._lock:
+            session = self._broadcasters.pop(broadcaster_id, None)
+            if session is None:
+                return None
+
+            session.unsubscribe(broadcaster_id)
+            logging.info(f"Unsubscribed from {broadcaster_id} on {session.name}!")
+
+            if len(session.subscriptions) == 0:
+                session.close()
+            return session
+
+    def stop(self):
+        """Closes every session and forgets all broadcasters"""
+
+        with self._lock:
+            for session in self._sessions:
+                session.close()
+            self._broadcasters.clear()
+
+    def resubscribe(self, session: BaseEventSubSession):
+        """
+        Recreates a session's subscriptions after a fresh reconnect
+        Twitch drops them all when a socket dies
+        """
+
+        with self._lock:
+            broadcasters = list(session.subscriptions.keys())
+            remove_subscriptions([i for ids in session.subscriptions.values() for i in ids])
+            self.release_cost(sum(session.costs.values()))
+            session.subscriptions.clear()
+            session.costs.clear()
+            session.sub_count = 0
+
+            for broadcaster_id in broadcasters:
+                if session.subscribe(broadcaster_id) is None:
+                    logging.error(f"Failed to resubscribe to {broadcaster_id}!")
+                    self._broadcasters.pop(broadcaster_id, None)
+
+            logging.info(f"Resubscribed {len(session.subscriptions)} broadcasters on {session.name}!")
+            if len(session.subscriptions) == 0:
+                session.close()
+
+    def health(self):
+        """
+        State and last message age of each session
+        Fails if any is down or quiet too long, or none are open while logged in
+        NOTE: Reads without the lock, so probes never wait on a Helix call
+        """
+
+        now = time.monotonic()
+        sessions = {}
+        for session in list(self._sessions):
+            age = now - session.last_message if session.last_message else None
+            sessions[session.name] = {
+                "ok": session.state == "connected" and age is not None and age <= session.recv_timeout(),
+                "state": session.state,
+                "subs": session.sub_count,
+                "last_message_age": age,
+                "keepalive_timeout": session.keepalive_timeout,
+            }
+
+        shards = get_shards()
+        expected = peek_token() is not None and not STOP_EVTLOOP_EVENT.is_set() and \
+            (shards is None or len(shards.owned) > 0)
+        ok = all(s["ok"] for s in sessions.values()) and (len(sessions) > 0 or not expected)
+        return {"ok": ok, "sessions": sessions, "broadcasters": len(self._broadcasters)}
+
+    def on_session_closed(self, session: BaseEventSubSession):
+        """Called by a session when its socket is gone"""
+
+        with self._lock:
+            if session in self._sessions:
+                self._sessions.remove(session)
+            remove_subscriptions([i for ids in session.subscriptions.values() for i in ids])
+            self.release_cost(sum(session.costs.values()))
+            session.costs.clear()
+            for broadcaster_id, owner in list(self._broadcasters.items()):
+                if owner is session:
+                    del self._broadcasters[broadcaster_id]
+
+        shards = get_shards()
+        if shards is not None and session.slot is not None:
+            shards.free_slot(session.slot)
+            session.slot = None
+
+
 def ws_event_loop():
     """
-    Main Socket Connect Functions
-    Returns Session ID
+    Main Socket Connect Function
+    Subscribes the logged-in user and all configured broadcasters
     """
 
     # Import event & reset
     global STOP_EVTLOOP_EVENT
     STOP_EVTLOOP_EVENT.clear()
 
-    # Init Webhook
-    logging.info("Initializing Discord Webhook...")
-    config = get_config()
-    webhook = generate_webhook(config.d_webhook)
-
-    # Create connection
-    logging.info("Starting Websocket Loop...")
-    try:
-        with client.connect(TWITCH_WS) as ws:
+    # Get User ID
+    user = get_cur_user()
+    if user is None:
+        logging.error("Twitch Auth Error!")
+        return None
 
-            # Get Session ID
-            welcome = json.loads(ws.recv())
-            sess_id = welcome['payload']['session']['id']
-            logging.info(f"Websocket ID: {sess_id}")
+    # Resolve configured broadcasters
+    config = get_config()
+    users = get_users(logins=config.t_broadcasters)
+    if users is None:
+        logging.error("Failed to resolve configured broadcasters!")
+        users = []
 
-            # Get User ID
-            user = get_cur_user()
-            if user is None:
-                logging.error("Twitch Auth Error!")
-                return None
+    # Sharded, the shards split them and each subscribes to its own
+    broadcaster_ids = [b['id'] for b in [user] + users]
+    shards = get_shards()
+    if shards is not None:
+        shards.watch(broadcaster_ids)
+        logging.info("Finished ws_event_loop, handed broadcasters to shards!")
+        return None
 
-            # Send off Sub Request
-            sub_to_event(
-                sess_id,
-                event="stream.online",
-                conditions={
-                    "broadcaster_user_id": user['id']
-                }
-            )
+    # Subscriptions from a previous run died with its sockets
+    clear_subscriptions()
 
-            # Start Listening
-            while not STOP_EVTLOOP_EVENT.is_set():
+    # Pack them into sessions, along with those added at runtime
+    broadcaster_ids += [b['id'] for b in get_broadcasters()]
+    for broadcaster_id in dict.fromkeys(broadcaster_ids):
+        manager.add_broadcaster(broadcaster_id)
 
-                # Get message on timeout
-                try:
-                    raw = ws.recv(5.0)
-                except TimeoutError:
-                    continue
-
-                # Parse JSON
-                message = json.loads(raw)
-
-                # if a stream online message...
-                if message['metadata']['message_type'] == "notification" and \
-                        message['metadata']['subscription_type'] == "stream.online":
-
-                    # We got a message! Weeeee!
-                    # Get user Stream
-                    stream = get_stream(user['id'])
-
-                    # Send webhook
-                    webhook.send_rich(DiscordMessage(
-                        content=f"**{user['display_name']}** is now live on Twitch!",
-                        embeds=[
-                            DiscordEmbed(
-                                title=f"{stream['title']}",
-                                description=f"Playing: {stream['game_name']}",
-                                image=stream['thumbnail_url'].replace("{width}x{height}", "853x480"),
-                                footer="This message is from Azure's Twitchbot!",
-                                url=f"https://twitch.tv/{user['login']}",
-                                color=0x6441a5
-                            )
-                        ]
-                    ))
-
-            logging.info("Finished ws_event_loop!")
-
-    except ConnectionClosedError as e:
-        logging.error("The WebSocket connection was closed!")
-        logging.error(e)
+    logging.info("Finished ws_event_loop!")
 
 
 def stop_ws_event_loop():
@@ -102,3 +831,84 @@ def stop_ws_event_loop():
     """
     global STOP_EVTLOOP_EVENT
     STOP_EVTLOOP_EVENT.set()
+    if get_shards() is not None:
+        get_shards().unwatch_all()
+    manager.stop()
+
+
+def watch_broadcaster(broadcaster_id: str):
+    """
+    Watches a broadcaster at runtime, on whichever shard owns it if sharded
+    Returns None if an error is occurred
+    """
+
+    shards = get_shards()
+    if shards is None:
+        return manager.add_broadcaster(broadcaster_id)
+    shards.add(broadcaster_id)
+    return broadcaster_id
+
+
+def unwatch_broadcaster(broadcaster_id: str):
+    """Stops watching a broadcaster at runtime, returns None if it wasn't watched"""
+
+    shards = get_shards()
+    if shards is None:
+        return manager.remove_broadcaster(broadcaster_id)
+    return broadcaster_id if shards.remove(broadcaster_id) else None
+
+
+def start_shards():
+    """
+    Joins the other shards, subscribing to whatever broadcasters this one is given
+    Work queued by dead shards is sent and handled here
+    """
+
+    def on_claim(rows: List[dict], notifications: List[dict]):
+        deliveries.restore(rows)
+        replay_outbox(outbox.restore(notifications))
+
+    # Subscriptions from this shard's previous run died with its sockets
+    clear_subscriptions()
+
+    global login_seen
+    login_seen = (peek_token() or {}).get('access')
+    get_shards().start(manager.add_broadcaster, manager.remove_broadcaster, on_claim, sync_login)
+
+
+def sync_login():
+    """
+    Follows logins and logouts made on other shards, they share the token table
+    Runs on every shard tick
+    """
+    global login_seen
+
+    token = reload_token()
+    access = token['access'] if token is not None else None
+    if access == login_seen:
+        return
+    login_seen = access
+
+    shards = get_shards()
+    if access is not None and not shards.active:
+        logging.info("Another shard logged in, starting up...")
+        queue.push(ws_event_loop)
+    elif access is None and shards.active:
+        logging.info("Another shard logged out, stopping...")
+        stop_ws_event_loop()
+
+
+# Static Initialization
+login_seen = None
+manager = SubscriptionManager()
+dedup = DedupIndex()
+eventsub_frames = metrics.counter("twitchbot_eventsub_frames_total", "EventSub frames by message type", ("type",))
+eventsub_reconnects = metrics.counter(
+    "twitchbot_eventsub_reconnects_total", "EventSub reconnects by reason", ("reason",)
+)
+metrics.gauge("twitchbot_eventsub_sessions", "Open EventSub sessions", lambda: len(manager.sessions))
+metrics.counter_func(
+    "twitchbot_eventsub_duplicates_total", "Duplicate EventSub notifications dropped",
+    lambda: dedup.duplicates
+)
+health.register("eventsub", manager.health)
@@ -2,65 +2,151 @@
 
 import atexit
 import logging
-from flask import Flask
 from pathlib import Path
 
+# NOTE: First, so every import after it is counted in the startup timings
+from utils.startup import startup
+from flask import Flask
+
 from utils.logging import configure_logging
 configure_logging()
 
 from routes import routes  # noqa: E402
-from twitch.oauth import validate_token  # noqa: E402
-from twitch.websocket import ws_event_loop  # noqa: E402
+from twitch.oauth import validate_token, start_token_upkeep  # noqa: E402
+from twitch.websocket import ws_event_loop, replay_outbox, dedup, start_shards  # noqa: E402
+from twitch.events import events  # noqa: E402
+from twitch.constants import EVENTSUB_MAX_SESSIONS  # noqa: E402
 from utils.db import init_db  # noqa: E402
-from utils.config import init_config  # noqa: E402
-from utils.threads import WorkerThread, queue  # noqa: E402
+from utils.config import init_config, get_config  # noqa: E402
+from utils.http import init_transport  # noqa: E402
+from utils.threads import start_workers, queue  # noqa: E402
+from utils.outbox import start_outbox, outbox  # noqa: E402
+from utils.aio import start_runtime  # noqa: E402
+from utils.shards import init_shards, get_shards  # noqa: E402
 from discord.webhooks import send_status_notif  # noqa: E402
+from discord.delivery import start_senders  # noqa: E402
+from discord.routing import init_routes  # noqa: E402
+
+# Constants
+STARTUP_RETRY = 30
 
 
 def main():
     """Main Entrypoint"""
 
     logging.info("Starting up...")
+    startup.mark("imports")
 
     # Read config
-    logging.info("Reading config...")
-    Path("data").mkdir(parents=True, exist_ok=True)
-    config = init_config("data/config.json")
-
-    # Send Status Webhook
-    send_status_notif("Starting up!")
+    with startup.phase("config"):
+        logging.info("Reading config...")
+        Path("data").mkdir(parents=True, exist_ok=True)
+        config = init_config("data/config.json")
 
-    # Init Twitch Database
-    logging.info("Initializing Twitch DB...")
-    init_db("data/twitch.db")
+        # Set up pooled HTTP sessions
+        init_transport(config.http_pool_size, config.http_timeout)
 
-    # Start Worker Thread
-    logging.info("Spawning Worker Thread...")
-    WorkerThread("Worker-1").start()
+        # Subscribe to the optional EventSub types asked for
+        events.enable(config.t_events)
 
-    # Validate Twitch Token
-    status = validate_token()
-    if status is not None:
-        logging.info("Found valid cached token! Using...")
-        send_status_notif("Found cached token, using!")
-        queue.push(ws_event_loop)
+    # Init Twitch Database
+    with startup.phase("db"):
+        logging.info("Initializing Twitch DB...")
+        init_db("data/twitch.db")
+        if config.t_dedup_persist:
+            dedup.enable_persistence()
+
+        # Sharded, only this shard's queues get restored below
+        if config.shard_enabled:
+            init_shards(config.shard_id, config.shard_backend, EVENTSUB_MAX_SESSIONS)
+
+        # Load go-live routes
+        init_routes()
+
+    # Start Discord Senders, resending anything left over
+    with startup.phase("senders"):
+        logging.info("Spawning Discord Senders...")
+        start_senders()
+
+    # Start the outbox writer
+    with startup.phase("outbox"):
+        logging.info("Spawning Outbox Writer...")
+        unhandled = start_outbox()
+
+    # Start Worker Threads, finishing what the last run didn't
+    with startup.phase("workers"):
+        logging.info(f"Spawning {config.workers} Worker Threads...")
+        start_workers(config.workers)
+        replay_outbox(unhandled)
+
+    # Start asyncio runtime, if asked
+    # NOTE: Before the shards, whose first tick may already open sessions
+    if config.runtime == "async":
+        with startup.phase("runtime"):
+            logging.info("Starting asyncio runtime...")
+            start_runtime(config.workers)
+
+    # Join the other shards, taking over work dead ones left behind
+    if config.shard_enabled:
+        with startup.phase("shards"):
+            start_shards()
+
+    # Talk to Discord and Twitch, in the background unless asked not to
+    if config.startup == "blocking":
+        connect()
     else:
-        logging.warn("No cached token found or token didn't pass validation! Must re-auth!")
-        send_status_notif(f"Auth failed, must reauth!\nVisit: {config.hostname}", warn=True)
+        queue.push(connect, priority=queue.PRIORITY_HIGH)
 
     # Configure webapp
-    web = Flask(__name__)
-    web.register_blueprint(routes)
+    with startup.phase("webapp"):
+        web = Flask(__name__)
+        web.register_blueprint(routes)
 
     # Configure exit
     atexit.register(at_exit)
 
     # Return main webapp
+    startup.mark_serving()
     return web
 
 
+def connect():
+    """
+    Startup network work, kept out of main() so HTTP binds right away
+    - Sends status webhooks as their own jobs, so a slow Discord holds up nothing
+    - Validates the cached token, connecting to EventSub if it's good
+    """
+
+    config = get_config()
+    queue.push(send_status_notif, "Starting up!")
+
+    # Validate Twitch Token, retrying if Twitch can't be reached
+    try:
+        with startup.phase("validate"):
+            status = validate_token()
+    except Exception:
+        logging.exception(f"Token validation raised! Retrying in {STARTUP_RETRY}s...")
+        queue.push_later(STARTUP_RETRY, connect, priority=queue.PRIORITY_HIGH)
+        return
+
+    if status is not None:
+        logging.info("Found valid cached token! Using...")
+        queue.push(send_status_notif, "Found cached token, using!")
+        queue.push(ws_event_loop)
+    else:
+        logging.warn("No cached token found or token didn't pass validation! Must re-auth!")
+        queue.push(send_status_notif, f"Auth failed, must reauth!\nVisit: {config.hostname}", warn=True)
+
+    # Keep token fresh in the background
+    start_token_upkeep()
+    startup.mark_finished()
+
+
 def at_exit():
     """Exit function, cleanup"""
+    outbox.flush()
+    if get_shards() is not None:
+        get_shards().stop()
     send_status_notif("Bot has been killed!", error=True)
 
 
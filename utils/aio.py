@@ -0,0 +1,82 @@
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Coroutine
+
+from utils.lazy import lazy_import
+
+# Only needed with the async runtime, so kept off the startup path
+asyncio = lazy_import("asyncio")
+
+
+class AsyncRuntime(threading.Thread):
+    """
+    Runs a single asyncio event loop on its own thread
+    Blocking calls made from coroutines go to a small, bounded executor
+    """
+
+    def __init__(self, name: str = "AsyncLoop", io_threads: int = 4):
+        """Constructor"""
+
+        super().__init__()
+        self.name = name
+        self.daemon = True
+
+        self.loop = asyncio.new_event_loop()
+        self.executor = ThreadPoolExecutor(io_threads, thread_name_prefix="AsyncIO")
+        self._ready = threading.Event()
+
+    def run(self):
+        """
+        Main loop thread
+        NOTE: This function should never be called directly
+        """
+
+        logging.info("Starting event loop...")
+        asyncio.set_event_loop(self.loop)
+        self.loop.set_default_executor(self.executor)
+        self.loop.call_soon(self._ready.set)
+        self.loop.run_forever()
+
+    def wait_ready(self, timeout: float = None):
+        """Blocks until the loop is running"""
+        return self._ready.wait(timeout)
+
+    def submit(self, coro: Coroutine) -> Future:
+        """
+        Schedules a coroutine from any thread
+        Returns a concurrent Future for its result
+        """
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def call(self, coro: Coroutine, timeout: float = None):
+        """Runs a coroutine from a non-loop thread and waits on its result"""
+        return self.submit(coro).result(timeout)
+
+    def stop(self):
+        """Stops the loop and its executor"""
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.executor.shutdown(wait=False)
+
+
+async def to_io(func: Callable, *args):
+    """Runs a blocking function on the runtime's executor"""
+    return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+
+# static
+runtime: AsyncRuntime = None
+
+
+def start_runtime(io_threads: int):
+    """Starts the static asyncio runtime"""
+    global runtime
+    runtime = AsyncRuntime(io_threads=io_threads)
+    runtime.start()
+    runtime.wait_ready()
+    return runtime
+
+
+def get_runtime():
+    """Returns the running runtime, or None when in threaded mode"""
+    return runtime
@@ -23,28 +23,46 @@ class Config:
         # Load values
         # NOTE: If reusing this in future projects, only edit this section here!
         self.hostname = self.get_value(confdata, "hostname", "http://localhost:8080")
+        self.workers = int(self.get_value(confdata, "workers", 4))
+        self.runtime = self.get_value(confdata, "runtime", "threads")
+        self.startup = self.get_value(confdata, "startup", "background")
+        self.http_pool_size = int(self.get_value(confdata, "http.pool_size", 20))
+        self.http_timeout = float(self.get_value(confdata, "http.timeout", 10.0))
         self.d_webhook = self.get_value(confdata, "discord.webhook", "", mandatory=True)
+        self.d_routes = self.get_value(confdata, "discord.routes", [])
         self.d_status_hook = self.get_value(confdata, "discord.status", self.d_webhook)
         self.t_clientid = self.get_value(confdata, "twitch.clientid", "", mandatory=True)
         self.t_secret = self.get_value(confdata, "twitch.secret", "", mandatory=True)
+        self.t_broadcasters = self.get_value(confdata, "twitch.broadcasters", [])
+        self.t_events = self.get_value(confdata, "twitch.events", [])
+        self.t_dedup_persist = str(self.get_value(confdata, "twitch.dedup_persist", False)).lower() == "true"
+        self.shard_enabled = str(self.get_value(confdata, "shard.enabled", False)).lower() == "true"
+        self.shard_id = self.get_value(confdata, "shard.id", "")
+        self.shard_backend = self.get_value(confdata, "shard.backend", "sqlite")
+        self.admin_secret = self.get_value(confdata, "admin.secret", "")
 
     def get_value(
             self,
             file: dict,
             key: str,
-            default: str,
+            default,
             mandatory: bool = False
             ):
         """
         Main function for parsing config key values
         - Accepts string of format "value" or "object.value"
         - Prioritizes env over file, for Docker
+        - List values are comma separated, or a JSON array, in env
         """
 
         # First, try environment variables
         env_var = self.CONFIG_PREFIX + key.upper().replace(".", "__")
         env_value = os.environ.get(env_var)
         if env_value is not None:
+            if isinstance(default, list):
+                if env_value.lstrip().startswith("["):
+                    return json.loads(env_value)
+                return [v.strip() for v in env_value.split(",") if v.strip()]
             return env_value
 
         # Then, try config file
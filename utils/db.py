@@ -1,61 +1,571 @@
+import time
 import sqlite3
+import threading
+from typing import List, Tuple
+
+from .migrations import migrate
+from .histogram import Histogram
 
 # Static
 db_path = None
+db = None
+db_lock = threading.RLock()
+
+# Shard this process queues work under, "" when not sharded
+shard_id = ""
+
+# Token cache, so reads never touch the DB
+_UNLOADED = object()
+token_cache = _UNLOADED
 
 
 def get_db():
-    """Gets an initialized DB object"""
+    """
+    Gets the shared, long-lived DB object
+    NOTE: Hold db_lock while using it, it's shared across threads
+    """
+    global db
 
-    db = sqlite3.connect(db_path)
-    db.row_factory = sqlite3.Row
+    if db is None:
+        db = sqlite3.connect(db_path, check_same_thread=False)
+        db.row_factory = sqlite3.Row
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
     return db
 
 
 def init_db(path: str):
     """Initializes database"""
 
-    global db_path
+    global db_path, db, token_cache
     db_path = path
+    db = None
+    token_cache = _UNLOADED
 
-    db = get_db()
-    cur = db.cursor()
-    cur.execute(
-        "CREATE TABLE IF NOT EXISTS " +
-        "twitch_token(type, access, expires, refresh)"
-    )
-    db.commit()
+    with db_lock:
+        db = get_db()
+        migrate(db)
 
     return db
 
 
-def set_token(data: dict):
-    """Sets the row accordingly to the parsed JSON passed in"""
+def set_shard(new_id: str):
+    """Sets the shard whose subscriptions, deliveries and outbox this process owns"""
+    global shard_id
+    shard_id = new_id
+
+
+def set_token(data: dict, user_id: str = None):
+    """
+    Sets the user's row accordingly to the parsed JSON passed in
+    Defaults to the current token's user, who may not be known yet
+    NOTE: 'expires' is stored as an absolute unix timestamp
+    """
+    global token_cache
+
+    if user_id is None:
+        current = get_token()
+        user_id = current['user_id'] if current is not None else ""
+
+    now = time.time()
+    token = {
+        'user_id': user_id,
+        'type': 'bearer',
+        'access': data['access_token'],
+        'expires': now + data['expires_in'],
+        'refresh': data['refresh_token'],
+        'updated': now
+    }
 
-    db = get_db()
-    cur = db.cursor()
-    cur.execute(
-        "INSERT OR REPLACE INTO "
-        "twitch_token(type, access, expires, refresh) "
-        "values (?, ?, ?, ?)",
-        ('bearer', data['access_token'], data['expires_in'], data['refresh_token'])
-    )
-    db.commit()
+    # Write through
+    with db_lock:
+        db = get_db()
+        db.execute(
+            "INSERT OR REPLACE INTO "
+            "twitch_token(user_id, type, access, expires, refresh, updated) "
+            "values (:user_id, :type, :access, :expires, :refresh, :updated)",
+            token
+        )
+        db.commit()
+        token_cache = token
+
+
+def set_token_user(user_id: str):
+    """Keys the current token by its now known Twitch user ID"""
+    global token_cache
+
+    with db_lock:
+        token = get_token()
+        if token is None or token['user_id'] == user_id:
+            return
+
+        db = get_db()
+        db.execute("DELETE FROM twitch_token WHERE user_id = ?", (user_id,))
+        db.execute("UPDATE twitch_token SET user_id = ? WHERE user_id = ?", (user_id, token['user_id']))
+        db.commit()
+        token_cache = dict(token, user_id=user_id)
 
 
 def get_token():
-    """Fetches row from DB"""
+    """Fetches the most recent token, from cache if loaded, else from DB"""
+    global token_cache
+
+    if token_cache is not _UNLOADED:
+        return token_cache
+
+    with db_lock:
+        cur = get_db().cursor()
+        cur.execute("SELECT * FROM twitch_token ORDER BY updated DESC LIMIT 1")
+        row = cur.fetchone()
+        token_cache = dict(row) if row is not None else None
+        return token_cache
 
-    db = get_db()
-    cur = db.cursor()
-    cur.execute("SELECT * FROM twitch_token")
-    return cur.fetchone()
+
+def reload_token():
+    """Drops the cached token and reads it again, picking up other processes' logins"""
+    global token_cache
+
+    with db_lock:
+        token_cache = _UNLOADED
+        return get_token()
+
+
+def peek_token():
+    """Returns the cached token without ever touching the DB, None if not loaded"""
+    return token_cache if token_cache is not _UNLOADED else None
 
 
 def clear_token():
-    """Deletes row from DB"""
+    """Deletes the current token's row from DB"""
+    global token_cache
+
+    with db_lock:
+        token = get_token()
+        if token is not None:
+            db = get_db()
+            db.execute("DELETE FROM twitch_token WHERE user_id = ?", (token['user_id'],))
+            db.commit()
+        token_cache = _UNLOADED
+
+
+def store_broadcaster(broadcaster_id: str, login: str = None, name: str = None):
+    """Remembers a broadcaster added at runtime"""
+
+    with db_lock:
+        db = get_db()
+        db.execute("DELETE FROM broadcasters WHERE login = ? AND id != ?", (login, broadcaster_id))
+        db.execute(
+            "INSERT OR REPLACE INTO broadcasters(id, login, name, added) values (?, ?, ?, ?)",
+            (broadcaster_id, login, name, time.time())
+        )
+        db.commit()
+
+
+def forget_broadcaster(broadcaster_id: str):
+    """
+    Forgets a broadcaster, along with their subscriptions and destinations
+    Returns whether they were stored
+    """
+
+    with db_lock:
+        db = get_db()
+        cur = db.execute("DELETE FROM broadcasters WHERE id = ?", (broadcaster_id,))
+        db.execute("DELETE FROM subscriptions WHERE broadcaster_id = ?", (broadcaster_id,))
+        db.execute("DELETE FROM destinations WHERE broadcaster_id = ?", (broadcaster_id,))
+        db.commit()
+        return cur.rowcount > 0
+
+
+def get_broadcasters():
+    """Fetches all stored broadcasters, oldest first"""
+
+    with db_lock:
+        cur = get_db().cursor()
+        cur.execute("SELECT * FROM broadcasters ORDER BY added")
+        return [dict(row) for row in cur.fetchall()]
+
+
+def add_subscriptions(rows: List[Tuple[str, str, str, str, str]]):
+    """Records (id, broadcaster_id, type, version, session_id) EventSub subscriptions"""
+
+    now = time.time()
+    with db_lock:
+        db = get_db()
+        db.executemany(
+            "INSERT OR REPLACE INTO subscriptions(id, broadcaster_id, type, version, session_id, created, shard) "
+            "values (?, ?, ?, ?, ?, ?, ?)",
+            [row + (now, shard_id) for row in rows]
+        )
+        db.commit()
+
+
+def remove_subscriptions(sub_ids: List[str]):
+    """Forgets EventSub subscriptions"""
+
+    with db_lock:
+        db = get_db()
+        db.executemany("DELETE FROM subscriptions WHERE id = ?", [(i,) for i in sub_ids])
+        db.commit()
+
+
+def clear_subscriptions():
+    """Forgets all of this shard's EventSub subscriptions, they die with their sockets"""
+
+    with db_lock:
+        db = get_db()
+        db.execute("DELETE FROM subscriptions WHERE shard = ?", (shard_id,))
+        db.commit()
+
+
+def get_destinations():
+    """Fetches all stored go-live destinations"""
+
+    with db_lock:
+        cur = get_db().cursor()
+        cur.execute("SELECT * FROM destinations ORDER BY id")
+        return [dict(row) for row in cur.fetchall()]
+
+
+def add_deliveries(rows: List[Tuple[str, str]], broadcaster_id: str = None, origin: float = None):
+    """
+    Persists many (url, payload) messages in one commit, returns their row IDs
+    'origin' is when the triggering event happened, for latency tracking
+    """
+
+    now = time.time()
+    with db_lock:
+        db = get_db()
+        cur = db.cursor()
+        ids = []
+        for url, payload in rows:
+            cur.execute(
+                "INSERT INTO discord_delivery(url, payload, created, broadcaster_id, origin, shard) "
+                "values (?, ?, ?, ?, ?, ?)",
+                (url, payload, now, broadcaster_id, origin, shard_id)
+            )
+            ids.append(cur.lastrowid)
+        db.commit()
+        return ids
+
+
+def finish_delivery(row_id: int, status: int, attempts: int):
+    """
+    Moves a Discord message into the history, once sent or given up on
+    Successful sends also count towards their broadcaster's latency buckets
+    Returns (broadcaster_id, latency), latency is None if unknown or failed
+    """
+
+    now = time.time()
+    with db_lock:
+        db = get_db()
+        row = db.execute(
+            "SELECT broadcaster_id, origin FROM discord_delivery WHERE id = ?", (row_id,)
+        ).fetchone()
+        if row is None:
+            return None, None
+
+        latency = None
+        if row['origin'] is not None and status is not None and status < 300:
+            latency = max(now - row['origin'], 0.0)
+            db.execute(
+                "INSERT INTO latency_buckets(broadcaster_id, bucket, count, total, max) "
+                "values (?, ?, 1, ?, ?) ON CONFLICT(broadcaster_id, bucket) DO UPDATE SET "
+                "count = count + 1, total = total + excluded.total, max = max(max, excluded.max)",
+                (row['broadcaster_id'] or "", Histogram.bucket(latency), latency, latency)
+            )
+
+        db.execute(
+            "INSERT INTO delivery_history(broadcaster_id, url, status, attempts, created, finished, latency) "
+            "SELECT broadcaster_id, url, ?, ?, created, ?, ? FROM discord_delivery WHERE id = ?",
+            (status, attempts, now, latency, row_id)
+        )
+        db.execute("DELETE FROM discord_delivery WHERE id = ?", (row_id,))
+        db.commit()
+        return row['broadcaster_id'], latency
+
+
+def get_latency_buckets():
+    """Fetches (broadcaster_id, bucket, count, total, max) latency aggregates"""
+
+    with db_lock:
+        cur = get_db().cursor()
+        cur.execute("SELECT broadcaster_id, bucket, count, total, max FROM latency_buckets")
+        return [tuple(row) for row in cur.fetchall()]
+
+
+def get_deliveries():
+    """Fetches this shard's undelivered Discord messages, oldest first"""
+
+    with db_lock:
+        cur = get_db().cursor()
+        cur.execute("SELECT * FROM discord_delivery WHERE shard = ? ORDER BY id", (shard_id,))
+        return [dict(row) for row in cur.fetchall()]
+
+
+def get_seen(since: float):
+    """Fetches dedup keys seen after a time, oldest first"""
+
+    with db_lock:
+        cur = get_db().cursor()
+        cur.execute("SELECT key, seen FROM eventsub_seen WHERE seen > ? ORDER BY seen", (since,))
+        return [(row['key'], row['seen']) for row in cur.fetchall()]
+
+
+def prune_seen(before: float):
+    """Deletes dedup keys seen before a time"""
+
+    with db_lock:
+        db = get_db()
+        db.execute("DELETE FROM eventsub_seen WHERE seen <= ?", (before,))
+        db.commit()
+
+
+def commit_outbox(rows: List[Tuple[str, str, str]], done: List[int], seen: List[str] = ()):
+    """
+    Group commit for the EventSub outbox
+    Appends (message_id, type, raw) rows, deletes finished IDs and records dedup keys in one transaction
+    Returns the new row IDs
+    """
+
+    now = time.time()
+    with db_lock:
+        db = get_db()
+        cur = db.cursor()
+        ids = []
+        for message_id, kind, raw in rows:
+            cur.execute(
+                "INSERT INTO eventsub_outbox(message_id, type, raw, created, shard) values (?, ?, ?, ?, ?)",
+                (message_id, kind, raw, now, shard_id)
+            )
+            ids.append(cur.lastrowid)
+        if done:
+            cur.executemany("DELETE FROM eventsub_outbox WHERE id = ?", [(i,) for i in done])
+        if seen:
+            cur.executemany("INSERT OR REPLACE INTO eventsub_seen(key, seen) values (?, ?)", [(k, now) for k in seen])
+        db.commit()
+        return ids
+
+
+def get_outbox():
+    """Fetches this shard's unfinished EventSub notifications, oldest first"""
+
+    with db_lock:
+        cur = get_db().cursor()
+        cur.execute("SELECT * FROM eventsub_outbox WHERE shard = ? ORDER BY id", (shard_id,))
+        return [dict(row) for row in cur.fetchall()]
+
+
+def add_stream_event(
+        broadcaster_id: str,
+        kind: str,
+        at: float,
+        stream_id: str = None,
+        title: str = None,
+        game: str = None
+        ):
+    """
+    Appends a go-live or offline event to the stream history
+    Ignored if the stream already has one of this kind, so retries never add another
+    """
+
+    with db_lock:
+        db = get_db()
+        db.execute(
+            "INSERT OR IGNORE INTO stream_history(broadcaster_id, stream_id, kind, at, title, game) "
+            "values (?, ?, ?, ?, ?, ?)",
+            (broadcaster_id, stream_id, kind, at, title, game)
+        )
+        db.commit()
+
+
+def get_stream_history(broadcaster_id: str = None, since: float = 0, until: float = None, limit: int = 100):
+    """Fetches stream history within a time range, newest first"""
+
+    query = "SELECT * FROM stream_history WHERE at >= ? AND at < ?"
+    params = [since, until if until is not None else float("inf")]
+    if broadcaster_id is not None:
+        query += " AND broadcaster_id = ?"
+        params.append(broadcaster_id)
+    query += " ORDER BY at DESC LIMIT ?"
+    params.append(limit)
+
+    with db_lock:
+        cur = get_db().cursor()
+        cur.execute(query, params)
+        return [dict(row) for row in cur.fetchall()]
+
+
+def heartbeat_member(member_id: str, host: str, ttl: float):
+    """Marks a shard alive for the next 'ttl' secs, returns whether it already was"""
+
+    now = time.time()
+    with db_lock:
+        db = get_db()
+        row = db.execute("SELECT expires FROM shard_members WHERE id = ?", (member_id,)).fetchone()
+        db.execute(
+            "INSERT INTO shard_members(id, host, started, expires) values (?, ?, ?, ?) "
+            "ON CONFLICT(id) DO UPDATE SET host = excluded.host, expires = excluded.expires",
+            (member_id, host, now, now + ttl)
+        )
+        db.commit()
+        return row is not None and row['expires'] >= now
+
+
+def get_members():
+    """Fetches the IDs of all live shards holding an EventSub session slot"""
+
+    now = time.time()
+    with db_lock:
+        cur = get_db().cursor()
+        cur.execute(
+            "SELECT id FROM shard_members WHERE expires >= ? AND id IN "
+            "(SELECT owner FROM shard_slots WHERE expires >= ?) ORDER BY id",
+            (now, now)
+        )
+        return [row['id'] for row in cur.fetchall()]
+
+
+def leave_member(member_id: str):
+    """
+    Frees a shard's leases and marks it dead, for a clean shutdown
+    It's left for claim_orphans, so whatever it still had queued gets sent
+    """
+
+    with db_lock:
+        db = get_db()
+        db.execute("DELETE FROM shard_leases WHERE owner = ?", (member_id,))
+        db.execute("DELETE FROM shard_slots WHERE owner = ?", (member_id,))
+        db.execute("UPDATE shard_members SET expires = 0 WHERE id = ?", (member_id,))
+        db.commit()
+
+
+def claim_orphans(member_id: str, unsharded: bool = False):
+    """
+    Takes over undelivered Discord messages and unfinished EventSub notifications from dead shards
+    Runs in one write transaction, so only one live shard ever claims a dead one
+    Also claims the unsharded queues if asked, when switching to sharding
+    Returns (dead shard IDs, discord_delivery rows, eventsub_outbox rows)
+    """
+
+    now = time.time()
+    with db_lock:
+        db = get_db()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            dead = [row['id'] for row in db.execute(
+                "SELECT id FROM shard_members WHERE expires < ? AND id != ?", (now, member_id)
+            ).fetchall()]
+            db.executemany("DELETE FROM shard_members WHERE id = ?", [(i,) for i in dead])
+            db.executemany("DELETE FROM shard_leases WHERE owner = ?", [(i,) for i in dead])
+            db.executemany("DELETE FROM shard_slots WHERE owner = ?", [(i,) for i in dead])
+
+            deliveries, notifications = [], []
+            for orphan in (dead + [""] if unsharded else dead):
+                deliveries += [dict(row) for row in db.execute(
+                    "SELECT * FROM discord_delivery WHERE shard = ? ORDER BY id", (orphan,)
+                ).fetchall()]
+                notifications += [dict(row) for row in db.execute(
+                    "SELECT * FROM eventsub_outbox WHERE shard = ? ORDER BY id", (orphan,)
+                ).fetchall()]
+                db.execute("UPDATE discord_delivery SET shard = ? WHERE shard = ?", (member_id, orphan))
+                db.execute("UPDATE eventsub_outbox SET shard = ? WHERE shard = ?", (member_id, orphan))
+                db.execute("DELETE FROM subscriptions WHERE shard = ?", (orphan,))
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+        return dead, deliveries, notifications
+
+
+def renew_leases(owner: str, ttl: float):
+    """Extends every lease a shard holds, returns the broadcaster IDs it still holds"""
+
+    now = time.time()
+    with db_lock:
+        db = get_db()
+        db.execute("UPDATE shard_leases SET expires = ? WHERE owner = ?", (now + ttl, owner))
+        db.commit()
+        cur = db.execute("SELECT broadcaster_id FROM shard_leases WHERE owner = ?", (owner,))
+        return [row['broadcaster_id'] for row in cur.fetchall()]
+
+
+def acquire_leases(broadcaster_ids: List[str], owner: str, ttl: float):
+    """
+    Takes leases on broadcasters that are free, expired or already ours
+    Returns the broadcaster IDs acquired
+    """
+
+    now = time.time()
+    acquired = []
+    with db_lock:
+        db = get_db()
+        for broadcaster_id in broadcaster_ids:
+            cur = db.execute(
+                "INSERT INTO shard_leases(broadcaster_id, owner, expires) values (?, ?, ?) "
+                "ON CONFLICT(broadcaster_id) DO UPDATE SET owner = excluded.owner, expires = excluded.expires "
+                "WHERE shard_leases.owner = excluded.owner OR shard_leases.expires < ?",
+                (broadcaster_id, owner, now + ttl, now)
+            )
+            if cur.rowcount > 0:
+                acquired.append(broadcaster_id)
+        db.commit()
+        return acquired
+
+
+def release_leases(broadcaster_ids: List[str], owner: str):
+    """Gives up a shard's leases on broadcasters"""
+
+    with db_lock:
+        db = get_db()
+        db.executemany(
+            "DELETE FROM shard_leases WHERE broadcaster_id = ? AND owner = ?",
+            [(i, owner) for i in broadcaster_ids]
+        )
+        db.commit()
+
+
+def claim_slot(owner: str, slots: int, ttl: float):
+    """
+    Takes the lowest free or expired of 'slots' EventSub session slots
+    Returns the slot number, or None if all are taken
+    """
+
+    now = time.time()
+    with db_lock:
+        db = get_db()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            db.execute("DELETE FROM shard_slots WHERE expires < ?", (now,))
+            taken = {row['slot'] for row in db.execute("SELECT slot FROM shard_slots").fetchall()}
+            slot = next((i for i in range(slots) if i not in taken), None)
+            if slot is not None:
+                db.execute(
+                    "INSERT INTO shard_slots(slot, owner, expires) values (?, ?, ?)",
+                    (slot, owner, now + ttl)
+                )
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+        return slot
+
+
+def renew_slots(owner: str, ttl: float):
+    """Extends every session slot a shard holds, returns the slots it still holds"""
+
+    now = time.time()
+    with db_lock:
+        db = get_db()
+        db.execute("UPDATE shard_slots SET expires = ? WHERE owner = ?", (now + ttl, owner))
+        db.commit()
+        cur = db.execute("SELECT slot FROM shard_slots WHERE owner = ? ORDER BY slot", (owner,))
+        return [row['slot'] for row in cur.fetchall()]
+
+
+def release_slot(slot: int, owner: str):
+    """Gives up a shard's session slot"""
 
-    db = get_db()
-    cur = db.cursor()
-    cur.execute("DELETE FROM twitch_token")
-    db.commit()
+    with db_lock:
+        db = get_db()
+        db.execute("DELETE FROM shard_slots WHERE slot = ? AND owner = ?", (slot, owner))
+        db.commit()
@@ -0,0 +1,45 @@
+import logging
+from typing import Callable, Dict, Tuple
+
+
+class HealthRegistry:
+    """
+    Health checks served on /healthz and /readyz
+    - Each check returns a dict of details, with "ok" saying if it passed
+    - Checks must only read in-memory state, they're probed every second
+    - Both report every check, but only liveness checks fail /healthz
+    """
+
+    def __init__(self):
+        """Constructor"""
+        self._checks: Dict[str, Tuple[Callable[[], dict], bool]] = {}
+
+    def __repr__(self):
+        return f"HealthRegistry(checks={list(self._checks)})"
+
+    def register(self, name: str, check: Callable[[], dict], liveness: bool = False):
+        """Adds a check, liveness checks also count towards /healthz"""
+        self._checks[name] = (check, liveness)
+
+    def run(self, readiness: bool = False):
+        """
+        Runs every check, returns whether they passed and each one's details
+        Only liveness checks count unless asked for readiness
+        """
+
+        ok = True
+        results = {}
+        for name, (check, liveness) in self._checks.items():
+            try:
+                result = check()
+            except Exception:
+                logging.exception(f"Health check {name} raised!")
+                result = {"ok": False}
+            if readiness or liveness:
+                ok = ok and result.get("ok", False)
+            results[name] = result
+        return ok, results
+
+
+# Static Initialization
+health = HealthRegistry()
@@ -0,0 +1,100 @@
+import bisect
+import threading
+from typing import Dict, Iterable, List, Tuple
+
+# Log-spaced bucket upper bounds in secs, 10ms up to ~10min, each 25% wider
+BUCKETS: List[float] = [0.01 * 1.25 ** i for i in range(50)]
+
+
+class Histogram:
+    """
+    Fixed-bucket histogram, cheap to update and to query
+    Percentiles are accurate to within a bucket's width
+    """
+
+    __slots__ = ("counts", "count", "total", "max")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def __repr__(self):
+        return f"Histogram(count={self.count})"
+
+    @staticmethod
+    def bucket(value: float):
+        """Index of the bucket a value lands in"""
+        return bisect.bisect_left(BUCKETS, value)
+
+    def record(self, value: float, count: int = 1):
+        """Adds a value"""
+
+        self.counts[self.bucket(value)] += count
+        self.count += count
+        self.total += value * count
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, q: float):
+        """Upper bound of the bucket holding the q-th percentile, q in [0, 1]"""
+
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                return min(BUCKETS[i], self.max) if i < len(BUCKETS) else self.max
+        return self.max
+
+    def summary(self):
+        """Returns count, mean, p50, p99 and max"""
+
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else None,
+            "p50": self.percentile(0.50),
+            "p99": self.percentile(0.99),
+            "max": self.max if self.count else None,
+        }
+
+
+class HistogramSet:
+    """Histograms by key, e.g. one per broadcaster"""
+
+    def __init__(self):
+        """Constructor"""
+
+        self._histograms: Dict[str, Histogram] = {}
+        self._lock = threading.Lock()
+
+    def record(self, key: str, value: float):
+        """Adds a value to a key's histogram"""
+
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.record(value)
+
+    def load(self, rows: Iterable[Tuple[str, int, int, float, float]]):
+        """Restores (key, bucket, count, total, max) rows"""
+
+        with self._lock:
+            for key, bucket, count, total, peak in rows:
+                histogram = self._histograms.get(key)
+                if histogram is None:
+                    histogram = self._histograms[key] = Histogram()
+                histogram.counts[bucket] += count
+                histogram.count += count
+                histogram.total += total
+                histogram.max = max(histogram.max, peak)
+
+    def summary(self):
+        """Returns each key's summary"""
+
+        with self._lock:
+            return {key: h.summary() for key, h in self._histograms.items()}
@@ -0,0 +1,82 @@
+import threading
+
+from utils.lazy import lazy_import
+
+# requests takes ~50ms to import, so it's loaded with the first request
+requests = lazy_import("requests")
+
+
+class Transport:
+    """
+    Shared HTTP session for all outbound calls
+    - Keeps a keep-alive connection pool per host
+    - Applies a default timeout to every request
+    - The underlying requests.Session is created on first use
+    """
+
+    def __init__(
+            self,
+            pool_size: int = 20,
+            max_hosts: int = 10,
+            timeout: float = 10.0,
+            connect_timeout: float = 3.05
+            ):
+        """Constructor"""
+
+        self.pool_size = pool_size
+        self.max_hosts = max_hosts
+        self.timeout = (connect_timeout, timeout)
+        self._session = None
+        self._lock = threading.Lock()
+
+    @property
+    def session(self):
+        """Pooled requests.Session, created on first use"""
+
+        if self._session is None:
+            with self._lock:
+                if self._session is None:
+                    session = requests.Session()
+                    adapter = requests.adapters.HTTPAdapter(
+                        pool_connections=self.max_hosts, pool_maxsize=self.pool_size
+                    )
+                    session.mount("http://", adapter)
+                    session.mount("https://", adapter)
+                    self._session = session
+        return self._session
+
+    def request(self, method, url, **kwargs):
+        """Sends a request, applying the default timeout if none given"""
+        kwargs.setdefault("timeout", self.timeout)
+        return self.session.request(method, url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def patch(self, url, **kwargs):
+        return self.request("PATCH", url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request("DELETE", url, **kwargs)
+
+
+# static
+transport: Transport = None
+
+
+def init_transport(pool_size: int, timeout: float):
+    """Initializes static transport"""
+    global transport
+    transport = Transport(pool_size=pool_size, timeout=timeout)
+    return transport
+
+
+def get_transport():
+    """Returns initialized transport, creating a default one if needed"""
+    global transport
+    if transport is None:
+        transport = Transport()
+    return transport
@@ -0,0 +1,46 @@
+import json
+import logging
+
+# Use the fastest JSON library installed, falling back to stdlib
+try:
+    import orjson
+
+    BACKEND = "orjson"
+
+    def loads(data):
+        """Parses JSON from str or bytes"""
+        return orjson.loads(data)
+
+    def dumps(obj) -> str:
+        """Serializes to a compact JSON str"""
+        return orjson.dumps(obj).decode()
+
+except ImportError:
+    try:
+        import msgspec
+
+        BACKEND = "msgspec"
+        _encoder = msgspec.json.Encoder()
+        _decoder = msgspec.json.Decoder()
+
+        def loads(data):
+            """Parses JSON from str or bytes"""
+            return _decoder.decode(data)
+
+        def dumps(obj) -> str:
+            """Serializes to a compact JSON str"""
+            return _encoder.encode(obj).decode()
+
+    except ImportError:
+        BACKEND = "json"
+        _encoder = json.JSONEncoder(separators=(",", ":"))
+
+        def loads(data):
+            """Parses JSON from str or bytes"""
+            return json.loads(data)
+
+        def dumps(obj) -> str:
+            """Serializes to a compact JSON str"""
+            return _encoder.encode(obj)
+
+logging.debug(f"Using {BACKEND} for JSON")
@@ -0,0 +1,30 @@
+import importlib
+
+
+class LazyModule:
+    """
+    Stands in for a module, only importing it on first attribute access
+    Keeps slow imports (requests, websockets, asyncio) off the startup path
+    """
+
+    def __init__(self, name: str):
+        """Constructor"""
+
+        self._name = name
+        self._module = None
+
+    def __repr__(self):
+        state = "loaded" if self._module is not None else "not loaded"
+        return f"LazyModule(name='{self._name}', {state})"
+
+    def __getattr__(self, attr: str):
+        # NOTE: import_module takes the import lock, so racing threads are fine
+        module = self._module
+        if module is None:
+            module = self._module = importlib.import_module(self._name)
+        return getattr(module, attr)
+
+
+def lazy_import(name: str):
+    """Returns a module that's imported when first used"""
+    return LazyModule(name)
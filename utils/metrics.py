@@ -0,0 +1,232 @@
+import bisect
+import logging
+import threading
+from typing import Callable, Dict, List, Tuple
+
+# Default histogram bucket upper bounds, in secs
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Metric:
+    """
+    Base for sharded metrics
+    - Each thread updates its own shard, so the hot path takes no lock
+    - Scrapes merge every shard, dead threads' counts included
+    """
+
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = ()):
+        """Constructor"""
+
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._local = threading.local()
+        self._shards: List[dict] = []
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return f"{type(self).__name__}(name='{self.name}')"
+
+    def _shard(self) -> dict:
+        """This thread's shard, registered on first use"""
+
+        try:
+            return self._local.values
+        except AttributeError:
+            values = self._local.values = {}
+            with self._lock:
+                self._shards.append(values)
+            return values
+
+    def _snapshots(self):
+        """Copies of every shard, dict.copy is atomic under the GIL"""
+
+        with self._lock:
+            shards = list(self._shards)
+        return [shard.copy() for shard in shards]
+
+    def _label_str(self, values: Tuple[str, ...], extra: str = ""):
+        """Formats {label="value",...}"""
+
+        pairs = [f'{k}="{_escape(v)}"' for k, v in zip(self.labels, values)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def render(self) -> List[str]:
+        """Text exposition lines"""
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    """Monotonic count, optionally by labels"""
+
+    kind = "counter"
+
+    def inc(self, *labels: str, amount: float = 1):
+        """Adds to the count for these label values"""
+
+        shard = self._shard()
+        shard[labels] = shard.get(labels, 0) + amount
+
+    def values(self) -> Dict[Tuple[str, ...], float]:
+        """Merged counts by label values"""
+
+        merged = {}
+        for shard in self._snapshots():
+            for key, value in shard.items():
+                merged[key] = merged.get(key, 0) + value
+        return merged
+
+    def render(self):
+        return [
+            f"{self.name}{self._label_str(key)} {_number(value)}"
+            for key, value in sorted(self.values().items())
+        ]
+
+
+class Histogram(Metric):
+    """Bucketed observations, optionally by labels"""
+
+    kind = "histogram"
+
+    def __init__(
+            self,
+            name: str,
+            help: str,
+            labels: Tuple[str, ...] = (),
+            buckets: Tuple[float, ...] = LATENCY_BUCKETS
+            ):
+        """Constructor"""
+
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+
+    def observe(self, value: float, *labels: str):
+        """Records a value for these label values"""
+
+        shard = self._shard()
+        cell = shard.get(labels)
+        if cell is None:
+            # [count per bucket + overflow, sum]
+            cell = shard[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        cell[0][bisect.bisect_left(self.buckets, value)] += 1
+        cell[1] += value
+
+    def values(self) -> Dict[Tuple[str, ...], Tuple[List[int], float]]:
+        """Merged (bucket counts, sum) by label values"""
+
+        merged = {}
+        for shard in self._snapshots():
+            for key, (counts, total) in shard.items():
+                counts = list(counts)
+                if key in merged:
+                    old_counts, old_total = merged[key]
+                    counts = [a + b for a, b in zip(old_counts, counts)]
+                    total += old_total
+                merged[key] = (counts, total)
+        return merged
+
+    def render(self):
+        lines = []
+        for key, (counts, total) in sorted(self.values().items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = 'le="%s"' % ("+Inf" if bound == float("inf") else _number(bound))
+                lines.append(f"{self.name}_bucket{self._label_str(key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{self._label_str(key)} {_number(total)}")
+            lines.append(f"{self.name}_count{self._label_str(key)} {cumulative}")
+        return lines
+
+
+class Gauge(Metric):
+    """
+    Point-in-time value, read from a callback on scrape
+    The callback returns a number, or a dict of label values to numbers
+    """
+
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, read: Callable, labels: Tuple[str, ...] = ()):
+        """Constructor"""
+
+        super().__init__(name, help, labels)
+        self.read = read
+
+    def render(self):
+        value = self.read()
+        if not isinstance(value, dict):
+            value = {(): value}
+        return [
+            f"{self.name}{self._label_str(key)} {_number(v)}"
+            for key, v in sorted(value.items())
+            if v is not None
+        ]
+
+
+class CounterFunc(Gauge):
+    """
+    Monotonic count kept elsewhere, read from a callback on scrape
+    Exported as a counter, so rate() and increase() handle restarts
+    """
+
+    kind = "counter"
+
+
+class Registry:
+    """All metrics exposed on /metrics"""
+
+    def __init__(self):
+        """Constructor"""
+        self._metrics: Dict[str, Metric] = {}
+        self._failing = set()
+
+    def register(self, metric: Metric):
+        """Adds a metric, returns the existing one if the name's taken"""
+        return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name: str, help: str, labels: Tuple[str, ...] = ()) -> Counter:
+        return self.register(Counter(name, help, labels))
+
+    def histogram(self, name: str, help: str, labels: Tuple[str, ...] = (), buckets=LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def gauge(self, name: str, help: str, read: Callable, labels: Tuple[str, ...] = ()) -> Gauge:
+        return self.register(Gauge(name, help, read, labels))
+
+    def counter_func(self, name: str, help: str, read: Callable, labels: Tuple[str, ...] = ()) -> CounterFunc:
+        return self.register(CounterFunc(name, help, read, labels))
+
+    def render(self):
+        """Prometheus text exposition of every metric"""
+
+        lines = []
+        for metric in self._metrics.values():
+            try:
+                body = metric.render()
+            except Exception:
+                # Logged once until it renders again, scrapes shouldn't flood the log
+                if metric.name not in self._failing:
+                    self._failing.add(metric.name)
+                    logging.exception(f"Metric {metric.name} failed to render, leaving it out!")
+                continue
+            self._failing.discard(metric.name)
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(body)
+        return "\n".join(lines) + "\n"
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _number(value) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+# Static Initialization
+metrics = Registry()
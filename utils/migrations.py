@@ -0,0 +1,173 @@
+import time
+import logging
+import sqlite3
+
+# Each entry upgrades the schema by one version, tracked in PRAGMA user_version
+# NOTE: Only ever append here, never edit a migration that has shipped
+MIGRATIONS = [
+    # 1: Original tables
+    """
+    CREATE TABLE IF NOT EXISTS twitch_token(type, access, expires, refresh);
+    CREATE TABLE IF NOT EXISTS discord_delivery(id INTEGER PRIMARY KEY, url, payload, created);
+    CREATE TABLE IF NOT EXISTS eventsub_seen(key TEXT PRIMARY KEY, seen);
+    CREATE TABLE IF NOT EXISTS eventsub_outbox(id INTEGER PRIMARY KEY, message_id, type, raw, created);
+    """,
+
+    # 2: Tokens keyed by user, broadcasters, subscriptions, destinations, history
+    """
+    ALTER TABLE twitch_token RENAME TO twitch_token_old;
+    CREATE TABLE twitch_token(
+        user_id TEXT PRIMARY KEY,
+        type TEXT NOT NULL,
+        access TEXT NOT NULL,
+        expires REAL NOT NULL,
+        refresh TEXT,
+        updated REAL NOT NULL
+    );
+    INSERT INTO twitch_token(user_id, type, access, expires, refresh, updated)
+        SELECT '', type, access, expires, refresh, :now FROM twitch_token_old
+        ORDER BY rowid DESC LIMIT 1;
+    DROP TABLE twitch_token_old;
+
+    CREATE TABLE broadcasters(
+        id TEXT PRIMARY KEY,
+        login TEXT,
+        name TEXT,
+        added REAL NOT NULL
+    );
+    CREATE UNIQUE INDEX broadcasters_login ON broadcasters(login);
+
+    CREATE TABLE subscriptions(
+        id TEXT PRIMARY KEY,
+        broadcaster_id TEXT NOT NULL,
+        type TEXT NOT NULL,
+        version TEXT NOT NULL,
+        session_id TEXT,
+        created REAL NOT NULL
+    );
+    CREATE INDEX subscriptions_broadcaster ON subscriptions(broadcaster_id);
+
+    CREATE TABLE destinations(
+        id INTEGER PRIMARY KEY,
+        broadcaster_id TEXT NOT NULL,
+        url TEXT NOT NULL,
+        content TEXT,
+        flags INTEGER NOT NULL DEFAULT 0,
+        UNIQUE(broadcaster_id, url)
+    );
+
+    ALTER TABLE discord_delivery ADD COLUMN broadcaster_id TEXT;
+    CREATE TABLE delivery_history(
+        id INTEGER PRIMARY KEY,
+        broadcaster_id TEXT,
+        url TEXT NOT NULL,
+        status INTEGER,
+        attempts INTEGER NOT NULL,
+        created REAL NOT NULL,
+        finished REAL NOT NULL
+    );
+    CREATE INDEX delivery_history_broadcaster ON delivery_history(broadcaster_id, finished);
+
+    CREATE INDEX eventsub_seen_seen ON eventsub_seen(seen);
+    """,
+
+    # 3: Stream history and delivery latency aggregates
+    """
+    CREATE TABLE stream_history(
+        id INTEGER PRIMARY KEY,
+        broadcaster_id TEXT NOT NULL,
+        stream_id TEXT,
+        kind TEXT NOT NULL,
+        at REAL NOT NULL,
+        title TEXT,
+        game TEXT
+    );
+    CREATE INDEX stream_history_broadcaster ON stream_history(broadcaster_id, at);
+    CREATE INDEX stream_history_at ON stream_history(at);
+
+    ALTER TABLE discord_delivery ADD COLUMN origin REAL;
+    ALTER TABLE delivery_history ADD COLUMN latency REAL;
+    CREATE TABLE latency_buckets(
+        broadcaster_id TEXT NOT NULL,
+        bucket INTEGER NOT NULL,
+        count INTEGER NOT NULL,
+        total REAL NOT NULL,
+        max REAL NOT NULL,
+        PRIMARY KEY(broadcaster_id, bucket)
+    ) WITHOUT ROWID;
+    """,
+
+    # 4: Sharding, members and broadcaster leases, per-shard queues
+    """
+    CREATE TABLE shard_members(
+        id TEXT PRIMARY KEY,
+        host TEXT,
+        started REAL NOT NULL,
+        expires REAL NOT NULL
+    );
+    CREATE TABLE shard_leases(
+        broadcaster_id TEXT PRIMARY KEY,
+        owner TEXT NOT NULL,
+        expires REAL NOT NULL
+    ) WITHOUT ROWID;
+    CREATE INDEX shard_leases_owner ON shard_leases(owner);
+
+    ALTER TABLE subscriptions ADD COLUMN shard TEXT NOT NULL DEFAULT '';
+    ALTER TABLE discord_delivery ADD COLUMN shard TEXT NOT NULL DEFAULT '';
+    ALTER TABLE eventsub_outbox ADD COLUMN shard TEXT NOT NULL DEFAULT '';
+    CREATE INDEX discord_delivery_shard ON discord_delivery(shard);
+    CREATE INDEX eventsub_outbox_shard ON eventsub_outbox(shard);
+    """,
+
+    # 5: EventSub session slots, shared by every shard on one token
+    """
+    CREATE TABLE shard_slots(
+        slot INTEGER PRIMARY KEY,
+        owner TEXT NOT NULL,
+        expires REAL NOT NULL
+    );
+    CREATE INDEX shard_slots_owner ON shard_slots(owner);
+    """,
+
+    # 6: One history row per stream, however often its go-live is retried
+    """
+    DELETE FROM stream_history WHERE stream_id IS NOT NULL AND id NOT IN (
+        SELECT MIN(id) FROM stream_history WHERE stream_id IS NOT NULL
+        GROUP BY broadcaster_id, stream_id, kind
+    );
+    CREATE UNIQUE INDEX stream_history_stream ON stream_history(broadcaster_id, stream_id, kind);
+    """,
+]
+
+
+def migrate(db: sqlite3.Connection):
+    """
+    Brings the DB up to the latest schema version
+    Each migration runs in its own transaction, so a failed one changes nothing
+    NOTE: Safe to race, each step takes the write lock then re-checks the version,
+    so shards starting together don't run the same migration twice
+    """
+
+    version = db.execute("PRAGMA user_version").fetchone()[0]
+    if version >= len(MIGRATIONS):
+        return version
+
+    for target in range(version + 1, len(MIGRATIONS) + 1):
+        script = MIGRATIONS[target - 1]
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            if db.execute("PRAGMA user_version").fetchone()[0] >= target:
+                db.execute("COMMIT")
+                continue
+
+            logging.info(f"Migrating DB to version {target}...")
+            for statement in script.split(";"):
+                if statement.strip():
+                    db.execute(statement, {"now": time.time()} if ":now" in statement else ())
+            db.execute(f"PRAGMA user_version = {target}")
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+
+    return len(MIGRATIONS)
@@ -0,0 +1,197 @@
+import time
+import logging
+import threading
+from typing import List
+
+from .db import commit_outbox, get_outbox
+from .metrics import metrics
+from .health import health
+
+# Constants
+OUTBOX_WINDOW = 0.005
+OUTBOX_BATCH = 256
+OUTBOX_BACKLOG_MAX = 1000
+
+
+class OutboxEntry:
+    """An EventSub notification that must be handled at least once"""
+
+    __slots__ = ("row_id", "message_id", "kind", "raw", "seen", "finished", "_committed")
+
+    def __init__(self, message_id: str, kind: str, raw: str, row_id: int = None, seen: List[str] = ()):
+        self.row_id = row_id
+        self.message_id = message_id
+        self.kind = kind
+        self.raw = raw
+        self.seen = seen
+        self.finished = False
+        self._committed = threading.Event()
+        if row_id is not None:
+            self._committed.set()
+
+    def __repr__(self):
+        return f"OutboxEntry(id={self.row_id}, type='{self.kind}')"
+
+    def wait(self, timeout: float = None):
+        """Blocks until the entry is on disk"""
+        return self._committed.wait(timeout)
+
+
+class Outbox:
+    """
+    Write-ahead log of EventSub notifications, kept until handled
+    - Appends and completions are group committed by one writer thread
+    - Entries finished before their commit are never written at all
+    - Their dedup keys, if persisted, are written in the same transaction
+    - Whatever is left on startup gets replayed
+    """
+
+    def __init__(self, window: float = OUTBOX_WINDOW, size: int = OUTBOX_BATCH):
+        """Constructor"""
+
+        self.window = window
+        self.size = size
+        self._appends: List[OutboxEntry] = []
+        self._done: List[int] = []
+        self._condition = threading.Condition()
+
+        # Metrics
+        self.appended = 0
+        self.committed = 0
+        self.batches = 0
+        self.last_commit = time.monotonic()
+
+    def append(self, message_id: str, kind: str, raw: str, seen: List[str] = ()):
+        """Queues a notification, and any dedup keys to persist, for the next group commit"""
+
+        entry = OutboxEntry(message_id, kind, raw, seen=seen)
+        with self._condition:
+            self._appends.append(entry)
+            self.appended += 1
+            self._condition.notify()
+        return entry
+
+    def done(self, entry: OutboxEntry):
+        """Marks a notification handled, it's deleted with the next commit"""
+
+        with self._condition:
+            entry.finished = True
+            if entry.row_id is not None:
+                self._done.append(entry.row_id)
+                self._condition.notify()
+
+    def restore(self, rows: List[dict] = None):
+        """Returns the entries a previous run, or a dead shard, never finished"""
+
+        entries = [
+            OutboxEntry(row['message_id'], row['type'], row['raw'], row['id'])
+            for row in (get_outbox() if rows is None else rows)
+        ]
+        if entries:
+            logging.info(f"Restored {len(entries)} unhandled EventSub notifications!")
+        return entries
+
+    def wait_work(self):
+        """Blocks until something needs committing, then gives others a moment to join"""
+
+        with self._condition:
+            while not self._appends and not self._done:
+                self._condition.wait()
+            if len(self._appends) + len(self._done) >= self.size:
+                return
+        time.sleep(self.window)
+
+    def flush(self):
+        """Writes all queued appends and completions in one transaction"""
+
+        with self._condition:
+            appends = [e for e in self._appends if not e.finished]
+            skipped = [e for e in self._appends if e.finished]
+            done = self._done
+            self._appends = []
+            self._done = []
+        seen = [key for e in appends + skipped for key in e.seen]
+
+        if appends or done or seen:
+            try:
+                ids = commit_outbox([(e.message_id, e.kind, e.raw) for e in appends], done, seen)
+            except Exception:
+                # Put everything back for the next attempt
+                with self._condition:
+                    self._appends = appends + skipped + self._appends
+                    self._done = done + self._done
+                raise
+            self.batches += 1
+            self.committed += len(appends)
+            self.last_commit = time.monotonic()
+
+            # Entries finished while we were writing get deleted next time
+            with self._condition:
+                for entry, row_id in zip(appends, ids):
+                    entry.row_id = row_id
+                    if entry.finished:
+                        self._done.append(row_id)
+
+        for entry in appends + skipped:
+            entry._committed.set()
+
+    def pending(self):
+        """Number of appends waiting on a commit"""
+        with self._condition:
+            return len(self._appends)
+
+    def health(self):
+        """Backlog waiting on a commit, fails if the writer's fallen behind"""
+
+        pending = self.pending()
+        return {
+            "ok": pending < OUTBOX_BACKLOG_MAX,
+            "pending": pending,
+            "last_commit_age": time.monotonic() - self.last_commit,
+        }
+
+
+class OutboxThread(threading.Thread):
+    """Group commits the outbox"""
+
+    def __init__(self):
+        """Constructor"""
+
+        super().__init__()
+        self.name = "Outbox"
+        self.daemon = True
+
+    def run(self):
+        """
+        Main thread event loop
+        NOTE: This function should never be called directly
+        """
+        global outbox
+
+        logging.info("Starting...")
+        while True:
+            outbox.wait_work()
+            try:
+                outbox.flush()
+            except Exception:
+                logging.exception("Outbox commit raised!")
+                time.sleep(1)
+
+
+def start_outbox():
+    """Spawns the outbox writer, returns entries left over from the last run"""
+
+    entries = outbox.restore()
+    OutboxThread().start()
+    return entries
+
+
+# Static Initialization
+outbox = Outbox()
+metrics.gauge("twitchbot_outbox_pending", "EventSub notifications waiting on a commit", lambda: outbox.pending())
+metrics.counter_func(
+    "twitchbot_outbox_rows_total", "EventSub notifications appended, and those that were written before being handled",
+    lambda: {("appended",): outbox.appended, ("committed",): outbox.committed}, ("kind",)
+)
+metrics.counter_func("twitchbot_outbox_commits_total", "Outbox group commits", lambda: outbox.batches)
+health.register("outbox", outbox.health)
@@ -0,0 +1,462 @@
+import os
+import time
+import bisect
+import socket
+import hashlib
+import logging
+import threading
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from .db import set_shard, heartbeat_member, get_members, leave_member, claim_orphans, \
+    renew_leases, acquire_leases, release_leases, get_broadcasters, claim_slot, renew_slots, release_slot
+from .threads import queue
+from .metrics import metrics
+from .health import health
+
+# Constants
+SHARD_TTL = 30.0
+SHARD_INTERVAL = 5.0
+SHARD_REPLICAS = 256
+SHARD_SLOTS = 3
+
+
+def _hash(key: str) -> int:
+    """Stable 64-bit hash, the same in every process unlike hash()"""
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big")
+
+
+class HashRing:
+    """
+    Consistent hash of broadcaster IDs onto shards
+    A shard joining or leaving only moves about 1/N of the broadcasters
+    """
+
+    def __init__(self, members: Iterable[str] = (), replicas: int = SHARD_REPLICAS):
+        """Constructor"""
+
+        self.members = sorted(set(members))
+        points = sorted((_hash(f"{m}#{i}"), m) for m in self.members for i in range(replicas))
+        self._hashes = [h for h, _ in points]
+        self._owners = [m for _, m in points]
+
+    def __repr__(self):
+        return f"HashRing(members={self.members})"
+
+    def owner(self, key: str):
+        """The shard a key belongs to, None if there are no shards"""
+
+        if not self._hashes:
+            return None
+        i = bisect.bisect(self._hashes, _hash(key)) % len(self._hashes)
+        return self._owners[i]
+
+
+class ShardBackend:
+    """
+    Where shards meet: membership, broadcaster leases, session slots, and what to watch
+    SQLiteBackend uses the shared DB, subclass this to coordinate elsewhere
+    """
+
+    def heartbeat(self, member_id: str, ttl: float) -> bool:
+        """Marks a shard alive for 'ttl' secs, returns whether it already was"""
+        raise NotImplementedError()
+
+    def members(self) -> List[str]:
+        """IDs of all live shards holding a session slot"""
+        raise NotImplementedError()
+
+    def leave(self, member_id: str):
+        """Frees a shard's leases and marks it dead, so its queued work is claimed"""
+        raise NotImplementedError()
+
+    def reap(self, member_id: str, unsharded: bool = False) -> Tuple[List[str], List[dict], List[dict]]:
+        """
+        Removes dead shards, handing their queued work to this one
+        Returns (dead IDs, discord_delivery rows, eventsub_outbox rows)
+        """
+        raise NotImplementedError()
+
+    def renew(self, member_id: str, ttl: float) -> List[str]:
+        """Extends a shard's leases, returns the broadcasters it still holds"""
+        raise NotImplementedError()
+
+    def acquire(self, broadcaster_ids: List[str], member_id: str, ttl: float) -> List[str]:
+        """Leases free or expired broadcasters, returns those acquired"""
+        raise NotImplementedError()
+
+    def release(self, broadcaster_ids: List[str], member_id: str):
+        """Gives up leases"""
+        raise NotImplementedError()
+
+    def broadcasters(self) -> List[str]:
+        """Broadcasters added at runtime, on any shard"""
+        raise NotImplementedError()
+
+    def claim_slot(self, member_id: str, slots: int, ttl: float) -> Optional[int]:
+        """Takes one of 'slots' EventSub session slots, None if all are taken"""
+        raise NotImplementedError()
+
+    def renew_slots(self, member_id: str, ttl: float) -> List[int]:
+        """Extends a shard's session slots, returns the ones it still holds"""
+        raise NotImplementedError()
+
+    def release_slot(self, slot: int, member_id: str):
+        """Gives up a session slot"""
+        raise NotImplementedError()
+
+
+class SQLiteBackend(ShardBackend):
+    """Coordinates through data/twitch.db, for shards sharing one disk"""
+
+    def __init__(self):
+        """Constructor"""
+        self.host = socket.gethostname()
+
+    def heartbeat(self, member_id, ttl):
+        return heartbeat_member(member_id, self.host, ttl)
+
+    def members(self):
+        return get_members()
+
+    def leave(self, member_id):
+        leave_member(member_id)
+
+    def reap(self, member_id, unsharded=False):
+        return claim_orphans(member_id, unsharded)
+
+    def renew(self, member_id, ttl):
+        return renew_leases(member_id, ttl)
+
+    def acquire(self, broadcaster_ids, member_id, ttl):
+        return acquire_leases(broadcaster_ids, member_id, ttl)
+
+    def release(self, broadcaster_ids, member_id):
+        release_leases(broadcaster_ids, member_id)
+
+    def broadcasters(self):
+        return [b['id'] for b in get_broadcasters()]
+
+    def claim_slot(self, member_id, slots, ttl):
+        return claim_slot(member_id, slots, ttl)
+
+    def renew_slots(self, member_id, ttl):
+        return renew_slots(member_id, ttl)
+
+    def release_slot(self, slot, member_id):
+        release_slot(slot, member_id)
+
+
+class ShardCoordinator:
+    """
+    Splits broadcasters between bot processes
+    - Every shard heartbeats, and the live ones make up a consistent hash ring
+    - A shard only watches broadcasters it holds a lease on, so no two post for one
+    - Leases are given up as soon as the ring moves a broadcaster away,
+      and only taken once the old owner lets go or its lease expires
+    - One live shard claims a dead shard's undelivered messages and notifications
+    - Twitch caps EventSub sockets per client ID and token, not per process,
+      so every socket takes one of 'slots' shared slots. Only shards holding
+      one join the ring, the rest wait on standby until one frees up
+    """
+
+    def __init__(
+            self,
+            member_id: str,
+            backend: ShardBackend,
+            ttl: float = SHARD_TTL,
+            interval: float = SHARD_INTERVAL,
+            slots: int = SHARD_SLOTS
+            ):
+        """Constructor"""
+
+        self.id = member_id
+        self.backend = backend
+        self.ttl = ttl
+        self.interval = interval
+        self.max_slots = slots
+        self.ring = HashRing()
+
+        # What to watch, across all shards
+        self.active = False
+        self.pinned = set()
+
+        # What this shard holds, broadcaster id -> lease expiry
+        self._leases: Dict[str, float] = {}
+        self._slots: Dict[int, bool] = {}  # session slot -> in use
+        self.standby = False
+        self._lock = threading.Lock()
+        self._job = None
+
+        # Callbacks, set by start()
+        self.on_acquire: Callable[[str], None] = None
+        self.on_release: Callable[[str], None] = None
+        self.on_claim: Callable[[List[dict], List[dict]], None] = None
+        self.on_tick: Callable[[], None] = None
+
+        # Metrics
+        self.last_tick = None
+        self.rebalances = 0
+        self.claimed = 0
+
+    def __repr__(self):
+        return f"ShardCoordinator(id='{self.id}', members={len(self.ring.members)}, owned={len(self._leases)})"
+
+    @property
+    def owned(self):
+        """Broadcasters this shard holds a lease on"""
+        return list(self._leases.keys())
+
+    def owns(self, broadcaster_id: str):
+        """
+        Whether this shard may post for a broadcaster
+        NOTE: Checks the lease's expiry too, in case renewals have stalled
+        """
+        expires = self._leases.get(broadcaster_id)
+        return expires is not None and expires > time.time()
+
+    def join(self):
+        """
+        Heartbeats right away, before this shard's queues are restored
+        Otherwise a live shard could reap it and send the same rows
+        """
+        logging.info(f"Joining shards as {self.id}...")
+        self.backend.heartbeat(self.id, self.ttl)
+
+    def start(
+            self,
+            on_acquire: Callable[[str], None],
+            on_release: Callable[[str], None],
+            on_claim: Callable[[List[dict], List[dict]], None],
+            on_tick: Callable[[], None] = None
+            ):
+        """Starts ticking, claiming unsharded leftovers once"""
+
+        self.on_acquire = on_acquire
+        self.on_release = on_release
+        self.on_claim = on_claim
+        self.on_tick = on_tick
+
+        self._claim(unsharded=True)
+        self._job = queue.push_every(self.interval, self.tick, priority=queue.PRIORITY_HIGH)
+        queue.push(self.tick, priority=queue.PRIORITY_HIGH)
+
+    def stop(self):
+        """Leaves the ring, letting the others take over right away"""
+
+        if self._job is not None:
+            self._job.cancel()
+            self._job = None
+        with self._lock:
+            self._drop(self.owned)
+            self.backend.leave(self.id)
+            self._slots = {}
+
+    def watch(self, broadcaster_ids: Iterable[str]):
+        """Watches these broadcasters, plus any added at runtime"""
+
+        with self._lock:
+            self.pinned = set(broadcaster_ids)
+            self.active = True
+        queue.push(self.tick, priority=queue.PRIORITY_HIGH)
+
+    def unwatch_all(self):
+        """Stops watching anything, usually because the user logged out"""
+
+        with self._lock:
+            self.active = False
+            self.pinned = set()
+        queue.push(self.tick, priority=queue.PRIORITY_HIGH)
+
+    def add(self, broadcaster_id: str):
+        """Watches one more broadcaster, whichever shard it lands on"""
+
+        with self._lock:
+            self.pinned.add(broadcaster_id)
+        queue.push(self.tick, priority=queue.PRIORITY_HIGH)
+
+    def remove(self, broadcaster_id: str):
+        """Stops watching a broadcaster, returns whether it was watched"""
+
+        with self._lock:
+            if broadcaster_id not in self.pinned and broadcaster_id not in self._leases:
+                return False
+            self.pinned.discard(broadcaster_id)
+        queue.push(self.tick, priority=queue.PRIORITY_HIGH)
+        return True
+
+    def take_slot(self):
+        """
+        Reserves a session slot for a new socket, an idle one this shard holds or a new one
+        Returns None if every slot is taken, across all shards
+        """
+
+        with self._lock:
+            slot = next((s for s, used in self._slots.items() if not used), None)
+            if slot is None:
+                slot = self.backend.claim_slot(self.id, self.max_slots, self.ttl)
+                if slot is None:
+                    return None
+            self._slots[slot] = True
+            return slot
+
+    def free_slot(self, slot: int):
+        """Frees a closed socket's slot, keeping the last one so this shard stays on the ring"""
+
+        with self._lock:
+            if slot not in self._slots:
+                return
+            if len(self._slots) > 1:
+                del self._slots[slot]
+                self.backend.release_slot(slot, self.id)
+            else:
+                self._slots[slot] = False
+
+    def tick(self):
+        """Heartbeats, reaps dead shards and rebalances, skipped if one's already running"""
+
+        if not self._lock.acquire(blocking=False):
+            return
+        try:
+            self._tick()
+        finally:
+            self._lock.release()
+
+        # NOTE: Unlocked, on_tick can stop the manager, whose lock is held around take_slot()
+        if self.on_tick is not None:
+            self.on_tick()
+
+    def _tick(self):
+        if not self.backend.heartbeat(self.id, self.ttl):
+            logging.error(
+                f"Shard {self.id} stalled for over {self.ttl:.0f}s and was presumed dead! "
+                "Its leases are gone, and messages it had queued may be sent twice"
+            )
+        self._claim()
+        self._renew_slots()
+
+        # Rebuild the ring if anyone joined or left
+        members = self.backend.members()
+        if members != self.ring.members:
+            logging.info(f"Shards changed, now {len(members)}: {', '.join(members)}")
+            self.ring = HashRing(members)
+            self.rebalances += 1
+
+        # Renew what we hold, anything missing was lost while we stalled
+        started = time.time()
+        held = set(self.backend.renew(self.id, self.ttl))
+        pinned, active = set(self.pinned), self.active
+        wanted = (pinned | set(self.backend.broadcasters())) if active else set()
+        mine = {b for b in wanted if self.ring.owner(b) == self.id}
+
+        # Stop posting for anything moved away before letting it go
+        self._drop([b for b in self._leases if b not in held or b not in mine])
+        released = held - mine
+        if released:
+            self.backend.release(list(released), self.id)
+
+        # Take anything moved here, once its old owner lets go or dies
+        acquired = set(self.backend.acquire([b for b in mine if b not in held], self.id, self.ttl))
+        expires = started + self.ttl
+        new = [b for b in (held & mine) | acquired if b not in self._leases]
+        self._leases = {b: expires for b in (held & mine) | acquired}
+        for broadcaster_id in new:
+            queue.push(self.on_acquire, broadcaster_id)
+
+        if new or released:
+            logging.info(
+                f"Shard {self.id} took {len(new)} and gave up {len(released)} broadcasters, "
+                f"holds {len(self._leases)}"
+            )
+        self.last_tick = time.monotonic()
+
+    def _renew_slots(self):
+        """Keeps this shard's session slots, taking one if it has none so it can join the ring"""
+
+        held = set(self.backend.renew_slots(self.id, self.ttl))
+        lost = [s for s in self._slots if s not in held]
+        if lost:
+            logging.error(
+                f"Shard {self.id} stalled and lost session slots {lost}! "
+                "Its sockets may now go over Twitch's limit until they close"
+            )
+        self._slots = {s: self._slots.get(s, False) for s in held}
+
+        if not self._slots:
+            slot = self.backend.claim_slot(self.id, self.max_slots, self.ttl)
+            if slot is not None:
+                self._slots[slot] = False
+                logging.info(f"Shard {self.id} took session slot {slot}")
+            elif not self.standby:
+                logging.warning(f"All {self.max_slots} session slots are taken, shard {self.id} is on standby")
+        self.standby = not self._slots
+
+    def _drop(self, broadcaster_ids: List[str]):
+        """Forgets leases locally and unsubscribes, before they're released"""
+
+        if not broadcaster_ids:
+            return
+        self._leases = {b: e for b, e in self._leases.items() if b not in broadcaster_ids}
+        for broadcaster_id in broadcaster_ids:
+            queue.push(self.on_release, broadcaster_id)
+
+    def _claim(self, unsharded: bool = False):
+        """Takes over work queued by dead shards"""
+
+        dead, deliveries, notifications = self.backend.reap(self.id, unsharded)
+        if dead:
+            logging.warning(f"Shards {', '.join(dead)} died, claimed their queued work")
+        if deliveries or notifications:
+            self.claimed += len(deliveries) + len(notifications)
+            self.on_claim(deliveries, notifications)
+
+    def health(self):
+        """Fails if the last successful tick is older than a lease"""
+
+        age = time.monotonic() - self.last_tick if self.last_tick is not None else None
+        return {
+            "ok": age is not None and age < self.ttl,
+            "id": self.id,
+            "members": len(self.ring.members),
+            "owned": len(self._leases),
+            "slots": sorted(self._slots),
+            "standby": self.standby,
+            "last_tick_age": age,
+        }
+
+
+def init_shards(member_id: str = "", backend: str = "sqlite", slots: int = SHARD_SLOTS):
+    """
+    Initializes the static coordinator, tagging this process' queues with its shard ID
+    NOTE: Call after init_db and before anything restores its queue
+    """
+    global shards
+
+    member_id = member_id or f"{socket.gethostname()}-{os.getpid()}"
+    set_shard(member_id)
+    shards = ShardCoordinator(member_id, BACKENDS[backend](), slots=slots)
+    shards.join()
+    return shards
+
+
+def get_shards():
+    """Returns the static coordinator, None if not sharded"""
+    return shards
+
+
+# Static Initialization
+BACKENDS = {"sqlite": SQLiteBackend}
+shards: ShardCoordinator = None
+metrics.gauge("twitchbot_shard_members", "Live shards", lambda: len(shards.ring.members) if shards else None)
+metrics.gauge(
+    "twitchbot_shard_broadcasters", "Broadcasters this shard holds",
+    lambda: len(shards.owned) if shards else None
+)
+metrics.counter_func(
+    "twitchbot_shard_rebalances_total", "Times the shard ring changed",
+    lambda: shards.rebalances if shards else None
+)
+metrics.gauge(
+    "twitchbot_shard_slots", "EventSub session slots this shard holds",
+    lambda: len(shards._slots) if shards else None
+)
+health.register("shards", lambda: shards.health() if shards else {"ok": True, "enabled": False})
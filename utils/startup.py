@@ -0,0 +1,76 @@
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from typing import Dict
+
+from utils.metrics import metrics
+from utils.health import health
+
+
+class Startup:
+    """
+    Per-phase startup timings
+    - Phases in main() block the HTTP server from binding
+    - Background phases run after, on the worker pool
+    """
+
+    def __init__(self):
+        """Constructor"""
+
+        # NOTE: Created when twitchbot is first imported, so imports count too
+        self.created = time.perf_counter()
+        self.phases: Dict[str, float] = {}
+        self.serving = None
+        self.finished = threading.Event()
+
+    def __repr__(self):
+        return f"Startup(phases={len(self.phases)}, serving={self.serving is not None})"
+
+    @contextmanager
+    def phase(self, name: str):
+        """Times a block as a startup phase"""
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = time.perf_counter() - start
+
+    def mark(self, name: str):
+        """Records the time since startup began as a phase"""
+        self.phases[name] = time.perf_counter() - self.created
+
+    def mark_serving(self):
+        """Records that main() is done and the HTTP server can bind"""
+
+        self.serving = time.perf_counter() - self.created
+        logging.info(
+            f"Ready to serve in {self.serving * 1000:.0f}ms ("
+            + ", ".join(f"{k} {v * 1000:.0f}ms" for k, v in self.phases.items())
+            + ")"
+        )
+
+    def mark_finished(self):
+        """Records that the background phases are done"""
+
+        self.mark("total")
+        self.finished.set()
+        logging.info(f"Startup finished in {self.phases['total'] * 1000:.0f}ms")
+
+    def health(self):
+        """Fails until the background startup phases are done"""
+        return {"ok": self.finished.is_set(), "serving": self.serving}
+
+    def stats(self):
+        """Phase timings in secs"""
+        return {"serving": self.serving, "finished": self.finished.is_set(), "phases": dict(self.phases)}
+
+
+# Static Initialization
+startup = Startup()
+metrics.gauge(
+    "twitchbot_startup_seconds", "Time spent in each startup phase",
+    lambda: {(k,): v for k, v in startup.phases.items()}, ("phase",)
+)
+health.register("startup", startup.health)
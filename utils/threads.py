@@ -1,54 +1,195 @@
+import heapq
 import logging
 import threading
-from typing import List, Callable
+import time
+from collections import deque
+from typing import Callable, Deque, List
+
+from .metrics import metrics
+from .health import health
+
+# Constants
+WORKER_HEARTBEAT = 5.0
+WORKER_STALE = 60.0
+
+
+class Job:
+    """A callable queued for a worker, with its scheduling info"""
+
+    __slots__ = ("func", "args", "kwargs", "priority", "interval",
+                 "run_at", "enqueued", "cancelled")
+
+    def __init__(
+            self,
+            func: Callable,
+            args: tuple = (),
+            kwargs: dict = None,
+            priority: int = 1,
+            interval: float = None
+            ):
+
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs or {}
+        self.priority = priority
+        self.interval = interval
+        self.run_at = 0.0
+        self.enqueued = 0.0
+        self.cancelled = False
+
+    def __repr__(self):
+        return f"Job(func='{self.__name__}', priority={self.priority})"
+
+    def __lt__(self, other: "Job"):
+        return self.run_at < other.run_at
+
+    def __call__(self):
+        return self.func(*self.args, **self.kwargs)
+
+    @property
+    def __name__(self):
+        return getattr(self.func, "__name__", repr(self.func))
+
+    def cancel(self):
+        """Stops a job from running, or a recurring one from running again"""
+        self.cancelled = True
 
 
 class WorkQueue:
-    """A rudimentary work queue"""
+    """
+    A blocking job scheduler
+    - FIFO lanes per priority, lower number runs first
+    - Delayed and recurring jobs, held in a heap until due
+    """
+
+    PRIORITY_HIGH = 0
+    PRIORITY_NORMAL = 1
+    PRIORITY_LOW = 2
 
     def __init__(self):
         """Constructor"""
 
-        self._queue: List[Callable] = []
-        self._queue_lock = threading.Lock()
+        self._lanes: List[Deque[Job]] = [deque(), deque(), deque()]
+        self._timers: List[Job] = []
         self._condition = threading.Condition()
 
-    def push(self, func: Callable):
+    def push(self, func: Callable, *args, priority: int = PRIORITY_NORMAL, **kwargs):
         """
         Function that pushes a Callable to the queue,
-        then notifies all waiting threads
+        then wakes a single waiting thread
         """
 
+        # NOTE: No debug logging here or in pop, it's the hottest path there is
+        job = Job(func, args, kwargs, priority)
         with self._condition:
+            job.enqueued = time.monotonic()
+            self._lanes[priority].append(job)
+            self._condition.notify()
 
-            # atomic write
-            with self._queue_lock:
-                logging.info(f"Pushing job... ({func.__name__})")
-                self._queue.append(func)
+        return job
+
+    def push_later(
+            self,
+            delay: float,
+            func: Callable,
+            *args,
+            priority: int = PRIORITY_NORMAL,
+            interval: float = None,
+            **kwargs
+            ):
+        """
+        Function that pushes a Callable to run after a delay
+        If interval is set, the job reruns every interval seconds
+        Returns the job, which can be cancelled
+        """
 
-            # notify a thread
+        job = Job(func, args, kwargs, priority, interval)
+        logging.debug("Scheduling job in %.2fs... (%r)", delay, job)
+
+        with self._condition:
+            job.run_at = time.monotonic() + delay
+            heapq.heappush(self._timers, job)
+
+            # wake a waiter in case this is now the earliest timer
             self._condition.notify()
 
-    def pop(self):
+        return job
+
+    def push_every(self, interval: float, func: Callable, *args, **kwargs):
+        """Function that pushes a Callable to run every interval seconds"""
+        return self.push_later(interval, func, *args, interval=interval, **kwargs)
+
+    def _release_timers(self, now: float):
+        """Moves due timers onto their lanes, returns secs to next timer"""
+
+        while self._timers:
+            job = self._timers[0]
+            if job.cancelled:
+                heapq.heappop(self._timers)
+                continue
+            if job.run_at > now:
+                return job.run_at - now
+
+            heapq.heappop(self._timers)
+            job.enqueued = now
+            self._lanes[job.priority].append(job)
+        return None
+
+    def done(self, job: Job):
         """
-        Function that waits thread until Callable is available,
-        then returns said callable
+        Called once a popped job has run
+        Recurring jobs are re-armed here, so a slow one never overlaps itself
         """
 
+        if job.interval is None or job.cancelled:
+            return
+
         with self._condition:
+            # schedule the next run off the planned time, so it doesn't drift
+            job.run_at = max(job.run_at + job.interval, time.monotonic())
+            heapq.heappush(self._timers, job)
+            self._condition.notify()
 
-            # wait for notification/timeout, whichever comes first
-            self._condition.wait(timeout=5.0)
+    def pop(self, timeout: float = None):
+        """
+        Function that waits thread until a Job is available,
+        then returns said job, or None on timeout
+        """
+
+        deadline = None if timeout is None else time.monotonic() + timeout
 
-            # atomic read
-            func = None
-            with self._queue_lock:
-                if len(self._queue) > 0:
-                    func = self._queue.pop(0)
-                    logging.info(f"Popping job... ({func.__name__})")
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                next_timer = self._release_timers(now)
 
-            # return callable for thread
-            return func
+                for lane in self._lanes:
+                    # jobs cancelled after reaching a lane never run
+                    while lane and lane[0].cancelled:
+                        lane.popleft()
+                    if lane:
+                        job = lane.popleft()
+                        queue_wait.observe(now - job.enqueued)
+                        return job
+
+                # sleep until pushed, next timer, or timeout
+                wait_for = next_timer
+                if deadline is not None:
+                    if now >= deadline:
+                        return None
+                    left = deadline - now
+                    wait_for = left if wait_for is None else min(wait_for, left)
+                self._condition.wait(wait_for)
+
+    def depth(self):
+        """Number of jobs ready to run, per priority lane"""
+        with self._condition:
+            return [len(lane) for lane in self._lanes]
+
+    def scheduled(self):
+        """Number of delayed and recurring jobs waiting on their timer"""
+        with self._condition:
+            return len(self._timers)
 
 
 class WorkerThread(threading.Thread):
@@ -61,6 +202,10 @@ class WorkerThread(threading.Thread):
         self.name = name
         self.daemon = True
 
+        # Health, beats at least every WORKER_HEARTBEAT secs unless stuck in a job
+        self.heartbeat = time.monotonic()
+        self.job = None
+
     def run(self):
         """
         Main thread event loop
@@ -70,12 +215,59 @@ class WorkerThread(threading.Thread):
 
         logging.info("Starting...")
         while True:
-            func = queue.pop()
-            if callable(func):
-                func()
+            job = queue.pop(WORKER_HEARTBEAT)
+            self.heartbeat = time.monotonic()
+            if not callable(job):
+                continue
+            self.job = job
+            try:
+                job()
+            except Exception:
+                logging.exception(f"Job {job.__name__} raised!")
+            finally:
+                queue.done(job)
+            self.job = None
+            self.heartbeat = time.monotonic()
+
+
+def start_workers(count: int):
+    """Spawns a pool of worker threads on the static queue"""
+
+    started = [WorkerThread(f"Worker-{len(workers) + i + 1}") for i in range(count)]
+    for worker in started:
+        worker.start()
+    workers.extend(started)
+    return started
+
+
+def worker_health():
+    """Heartbeat age and current job of each worker, fails if none are free"""
+
+    now = time.monotonic()
+    details = {
+        worker.name: {
+            "alive": worker.is_alive(),
+            "heartbeat_age": now - worker.heartbeat,
+            "job": worker.job.__name__ if worker.job is not None else None,
+        }
+        for worker in list(workers)
+    }
+    fresh = [d for d in details.values() if d["alive"] and d["heartbeat_age"] < WORKER_STALE]
+    return {"ok": len(fresh) > 0, "workers": details, "depth": queue.depth()}
 
 
 # Static Initialization
 queue = None
 if queue is None:
     queue = WorkQueue()
+workers: List[WorkerThread] = []
+health.register("workers", worker_health, liveness=True)
+queue_wait = metrics.histogram("twitchbot_queue_wait_seconds", "Time jobs wait in the work queue")
+metrics.gauge(
+    "twitchbot_queue_depth", "Jobs ready to run, by priority",
+    lambda: dict(zip([("high",), ("normal",), ("low",)], queue.depth())), ("priority",)
+)
+metrics.gauge(
+    "twitchbot_queue_scheduled", "Delayed and recurring jobs waiting on their timer",
+    lambda: queue.scheduled()
+)